@@ -1,12 +1,28 @@
+import fcntl
+import itertools
 import os
+import stat
 import subprocess
 import time
 import tarfile
 import tempfile
 
+from contextlib import contextmanager
 from dataclasses import dataclass
 
-from db import Database, ClientConfig, File
+from db import Database, ClientConfig, FileWriter, SnapshotStore
+from db.snapshot import UNCHANGED, snapshot_directory
+
+from .codec import BUFFER_SIZE, ArchiveCodec
+from .compressibility import CompressibilityClassifier
+from .encryption import ArchiveEncryption
+from .hasher import ContentHasher
+from .journal import ChangeJournal, journal_directory
+from .pipeline import ArchiveJob, ArchivePipeline
+from .planner import ArchivePlanner, FilePart, entry_size
+from .scanner import Scanner
+from .storage import storage_for
+from .upload import StreamingUpload, UploadAborted
 
 
 @dataclass
@@ -14,6 +30,8 @@ class Backup():
     db: Database
     client_config: ClientConfig
     s3_storage_class: str = "DEEP_ARCHIVE"
+    # Other backups write to the catalog at the same time
+    shared_catalog: bool = False
 
     def __post_init__(self):
         self._get_config_settings()
@@ -21,149 +39,532 @@ class Backup():
         self.backup_frozen_time = time.time()
         self.backup_frozen_time_struct = time.gmtime(self.backup_frozen_time)
 
-        # TODO destroy on exit
-        tmpdir = None
+        tmpdir = tempfile.gettempdir()
         if ClientConfig.TMP_DIR in self.client_config.options and self.client_config.options[ClientConfig.TMP_DIR]:
             tmpdir = self.client_config.options[ClientConfig.TMP_DIR]
-        self.tmp_directory = tempfile.mkdtemp(prefix="deep-freeze-", dir=tmpdir)
-        if not os.path.exists(self.tmp_directory):
-            os.makedirs(self.tmp_directory)
+        # The same for each backup of the root, so that archives built by an interrupted backup are found by the next
+        self.tmp_directory = os.path.join(tmpdir, f"deep-freeze-{self.client_config.state_file_name()}")
 
         self.archive_sequence_nb = 0
 
     def _get_config_settings(self):
         self.cross_devices = self.client_config.options[
             ClientConfig.BACKUPS_CROSS_DEVICES] == ClientConfig.YES
-        # TODO config
-        self.archive_max_size_bytes = 500000000  # 500MB
+        self.scan_threads = max(1, int(self.client_config.options[ClientConfig.SCAN_THREADS]))
+        self.catalog_batch_size = max(1, int(self.client_config.options[ClientConfig.CATALOG_BATCH_SIZE]))
+        self.exclusion_markers = self.client_config.options[ClientConfig.EXCLUSION_MARKERS] == ClientConfig.YES
+        self.journal = None
+        if self.client_config.options[ClientConfig.CHANGE_JOURNAL] == ClientConfig.YES:
+            self.journal = ChangeJournal(journal_directory(self.db.db_path), self.client_config)
+        self.snapshot_store = None
+        if self.client_config.options[ClientConfig.SCAN_DIFF] == ClientConfig.MEMORY:
+            self.snapshot_store = SnapshotStore(self.db, self.client_config,
+                                                int(self.client_config.options[ClientConfig.SNAPSHOT_MAX_FILES]))
+        self.scan_checkpoint_seconds = max(1, int(self.client_config.options[ClientConfig.SCAN_CHECKPOINT_SECONDS]))
+        self.content_dedup = self.client_config.options[ClientConfig.CONTENT_DEDUP] == ClientConfig.YES
+        self.streaming_upload = self.client_config.options[ClientConfig.STREAMING_UPLOAD] == ClientConfig.YES
+        self.archive_builders = max(1, int(self.client_config.options[ClientConfig.ARCHIVE_BUILDERS]))
+        self.archive_uploaders = max(1, int(self.client_config.options[ClientConfig.ARCHIVE_UPLOADERS]))
+        compression_level = None
+        if ClientConfig.COMPRESSION_LEVEL in self.client_config.options and \
+                self.client_config.options[ClientConfig.COMPRESSION_LEVEL]:
+            compression_level = int(self.client_config.options[ClientConfig.COMPRESSION_LEVEL])
+        self.codec = ArchiveCodec(self.client_config.options[ClientConfig.ARCHIVE_CODEC], compression_level)
+        self.stored_codec = ArchiveCodec(ClientConfig.UNCOMPRESSED)
+        self.adaptive_compression = self.client_config.options[ClientConfig.ADAPTIVE_COMPRESSION] == ClientConfig.YES \
+            and self.codec.name != ClientConfig.UNCOMPRESSED
+        self.archive_target_size = max(1, int(self.client_config.options[ClientConfig.ARCHIVE_TARGET_SIZE]))
         self.key_file_path = self.client_config.key_file_path
+        self.encryption = ArchiveEncryption(self.client_config.options[ClientConfig.ENCRYPTION], self.key_file_path)
+        self.storage = storage_for(self.client_config, self.s3_storage_class)
 
     def run(self):
+        with self.locked_tmp_directory():
+            self._run()
+
+    @contextmanager
+    def locked_tmp_directory(self):
+        """
+        Creates the temporary directory, or checks that the existing one is only accessible to the current user:
+        archives are written to it before they are encrypted. It is locked for the whole backup, so that another
+        backup of the root can neither resume nor remove the archives being built and uploaded.
+        """
+        os.makedirs(os.path.dirname(self.tmp_directory), exist_ok=True)
+        try:
+            os.mkdir(self.tmp_directory, 0o700)
+        except FileExistsError:
+            pass
+        try:
+            # Not a symbolic link planted in its place
+            fd = os.open(self.tmp_directory, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+        except OSError as e:
+            raise RuntimeError(f"Unusable temporary directory {self.tmp_directory}: {e}")
+        try:
+            st = os.fstat(fd)
+            if st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != 0o700:
+                raise RuntimeError(f"Temporary directory {self.tmp_directory} must be owned by the current user "
+                                   f"with mode 0700, not by uid {st.st_uid} with mode {stat.S_IMODE(st.st_mode):o}")
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise RuntimeError(f"Temporary directory {self.tmp_directory} is in use by another backup of "
+                                   f"{self.client_config.backup_root}")
+            yield
+        finally:
+            # Releases the lock
+            os.close(fd)
+
+    def _run(self):
         self.prepare_backup()
-        self.db.set_sweep_mark(
-            self.client_config.client_fqdn, self.client_config.backup_root)
-        self.scan()
+        # Directories to rescan, None for the whole root
+        scope = self.journal.claim() if self.journal is not None else None
+        # Directories already recorded by an interrupted scan
+        completed = self.db.get_scan_checkpoint(self.client_config.client_fqdn, self.client_config.backup_root)
+        if completed is not None:
+            print(f"Resuming interrupted scan, {len(completed)} directories already scanned")
+            if self.journal is not None:
+                # Changes journaled since the interruption in directories already scanned are missed
+                self.journal.distrust()
+        snapshot = None
+        if self.snapshot_store is not None and scope is None:
+            snapshot = self.snapshot_store.load(self.db.get_scan_generation(
+                self.client_config.client_fqdn, self.client_config.backup_root))
+        self.scan_generation = self.db.start_scan(
+            self.client_config.client_fqdn, self.client_config.backup_root, resume=completed is not None)
+        self.scan(scope, snapshot, completed)
+        if snapshot is not None:
+            self.db.mark_files_vanished(self.scan_generation, snapshot.unseen_file_ids())
+            snapshot.close()
+        else:
+            self.db.mark_vanished_files(
+                self.client_config.client_fqdn, self.client_config.backup_root,
+                self.scan_generation, self._catalog_scope(scope))
+        renamed = self.db.link_renamed_files(
+            self.client_config.client_fqdn, self.client_config.backup_root, self.scan_generation)
+        print(f"Renamed or moved: {renamed} files linked to their existing archives")
         self.db.update_deleted_files_new_status(
-            self.client_config.client_fqdn, self.client_config.backup_root)
+            self.client_config.client_fqdn, self.client_config.backup_root, self.scan_generation)
         self.db.mark_files_for_backup(
-            self.client_config.client_fqdn, self.client_config.backup_root)
+            self.client_config.client_fqdn, self.client_config.backup_root, self.scan_generation)
+        self.db.end_scan(self.client_config.client_fqdn, self.client_config.backup_root)
         self.backup()
+        # Only now are changes found by the scan safely archived: until then, keep rescanning them
+        if self.journal is not None:
+            self.journal.complete()
+        if self.snapshot_store is not None:
+            self.snapshot_store.save(self.scan_generation)
+
+    def _catalog_scope(self, scope):
+        # The catalog stores paths without the leading slash used by the scanner
+        if scope is None:
+            return None
+        return [(directory[1:], recursive) for directory, recursive in scope]
 
-    # WARN: need to change this if we want simultaneous backups
     def prepare_backup(self):
-        self.db.connection.execute('''delete from file_archive_records
-                                   where status = 'pending_upload'
-                              ''')
-        self.db.connection.execute('''delete from s3_archives
-                                   where status = 'pending_upload'
-                              ''')
+        # Before the scan replaces what the files were when they were archived
+        self.resume_archives()
+        # Parts uploaded by an interrupted backup of a file that was not completed are of no use
+        self.db.connection.execute('''update s3_archives
+                                   set relevant_size = relevant_size - (select sum(far.file_size)
+                                                                        from file_archive_records as far
+                                                                        inner join files as f using (file_id)
+                                                                        inner join directories as d using (directory_id)
+                                                                        where far.archive_id = s3_archives.archive_id
+                                                                        and far.status = 'part_uploaded'
+                                                                        and d.client_fqdn = ?1
+                                                                        and d.backup_root = ?2)
+                                   where archive_id in (select far.archive_id
+                                                        from file_archive_records as far
+                                                        inner join files as f using (file_id)
+                                                        inner join directories as d using (directory_id)
+                                                        where far.status = 'part_uploaded'
+                                                        and d.client_fqdn = ?1
+                                                        and d.backup_root = ?2)
+                              ''', (self.client_config.client_fqdn, self.client_config.backup_root))
+        self.db.connection.execute('''update file_archive_records
+                                   set status = 'abandoned'
+                                   where status = 'part_uploaded'
+                                   and file_id in (select f.file_id
+                                                   from directories as d
+                                                   inner join files as f using (directory_id)
+                                                   where d.client_fqdn = ?
+                                                   and d.backup_root = ?)
+                              ''', (self.client_config.client_fqdn, self.client_config.backup_root))
+        # Rows written by an interrupted scan that will be resumed are kept
         self.db.connection.execute('''update files
                                    set new_size = null,
                                        new_modification = null,
                                        new_status = null
-                                   where new_status is not null
-                              ''')
-
-    def scan(self):
-        self.db.connection.execute("BEGIN")
-        for root, dirs, files in os.walk(self.client_config.backup_root, followlinks=False):
-            relative_root = root.replace(self.client_config.backup_root, "")
-            if not self.cross_devices:
-                dirs[:] = [dir for dir in dirs if not os.path.ismount(
-                    os.path.join(root, dir)) and not self.client_config.is_excluded(relative_root, dir)]
-            for file in files:
-                if not self.client_config.is_excluded(relative_root, file):
-                    File(self.db, self.client_config, root, file).upsert()
+                                   where directory_id in (select directory_id
+                                                          from directories
+                                                          where client_fqdn = ?1
+                                                          and backup_root = ?2)
+                                   and new_status is not null
+                                   and not exists (select 1
+                                                   from scan_checkpoints as c
+                                                   where c.client_fqdn = ?1
+                                                   and c.backup_root = ?2
+                                                   and c.scan_generation = files.scan_generation)
+                              ''', (self.client_config.client_fqdn, self.client_config.backup_root))
+
+    def resume_archives(self):
+        """
+        Completes the uploads of the archives an interrupted backup built, from the temporary directory unless
+        they were uploaded before the interruption. The archives it did not build, or whose file is gone, are
+        discarded along with what their uploads left in storage, and their files archived again.
+        """
+        resumed = 0
+        discarded = []
+        interrupted = self.db.get_interrupted_archives(self.client_config.client_fqdn, self.client_config.backup_root)
+        for archive in interrupted:
+            name = archive["archive_file_name"]
+            path = os.path.join(self.tmp_directory, name + ".enc")
+            # Parts of a file are only of use along with all the others
+            if archive["status"] == "built" and not archive["incomplete_files"]:
+                if self.storage.exists(name + ".enc"):
+                    print(f"Archive {name} was uploaded by an interrupted backup")
+                elif os.path.exists(path):
+                    print(f"Resuming upload of {name}, built by an interrupted backup")
+                    if not self.storage.resumes_uploads:
+                        # The parts of the interrupted upload would otherwise be kept, and billed, indefinitely
+                        self.storage.abort_incomplete_uploads(name + ".enc")
+                    self.storage.upload_file(path, name + ".enc")
+                else:
+                    discarded.append(archive)
+                    continue
+                self.db.archive_uploaded(archive["archive_id"], archive["size"])
+                resumed += 1
+            else:
+                discarded.append(archive)
+        for archive in discarded:
+            self.storage.abort_incomplete_uploads(archive["archive_file_name"] + ".enc")
+        # Streamed uploads may have completed
+        for name, error in self.storage.delete_objects([archive["archive_file_name"] + ".enc"
+                                                        for archive in discarded]).items():
+            if error is not None:
+                print(f"Failed to delete {name}, left by an interrupted backup: {error}")
+        self.db.discard_archives([archive["archive_id"] for archive in discarded])
+        # Whatever remains of the interrupted archives was being built or is now uploaded
+        for archive in interrupted:
+            for path in (os.path.join(self.tmp_directory, archive["archive_file_name"]),
+                         os.path.join(self.tmp_directory, archive["archive_file_name"] + ".enc")):
+                if os.path.exists(path):
+                    os.remove(path)
+        if resumed or discarded:
+            print(f"Interrupted backup: {resumed} archives uploaded, {len(discarded)} discarded")
+
+    def scan(self, scope=None, snapshot=None, completed=None):
+        """
+        Records new and changed files in the catalog. With a snapshot, unchanged files are recognised
+        in memory and the catalog is not consulted for them.
+
+        Progress is committed every scan_checkpoint_seconds along with the directories fully recorded so far,
+        which a resumed scan (completed) only lists. With a shared catalog, rows are also committed after each
+        directory in which they were written, so that concurrent backups are not kept waiting for the write lock
+        until the next checkpoint: a resumed scan lists the directories again and rewrites them.
+        """
+        skip_directories = frozenset([journal_directory(self.db.db_path), snapshot_directory(self.db.db_path)])
+        # The catalog's write-ahead log is checkpointed into the catalog before the catalog is backed up
+        skip_files = frozenset([self.db.db_path + "-wal", self.db.db_path + "-shm"])
+        scanner = Scanner(self.client_config, self.cross_devices, self.scan_threads, self.exclusion_markers,
+                          skip_directories, skip_files)
+        writer = FileWriter(self.db, self.client_config, self.scan_generation, self.catalog_batch_size,
+                            record_seen=snapshot is None)
+        unchanged = 0
+        directories = []
+        next_checkpoint = time.monotonic() + self.scan_checkpoint_seconds
+        flush_count = 0
+        self.db.connection.execute("BEGIN IMMEDIATE")
+        for directory in scanner.walk(scope, frozenset(completed or ())):
+            for entry in directory.entries:
+                if directory.resumed:
+                    if snapshot is not None:
+                        snapshot.mark_seen(entry.rel_path)
+                    else:
+                        writer.mark_seen(entry.rel_path)
+                    continue
+                if snapshot is not None and snapshot.compare(entry.rel_path, entry.size, entry.mtime_ns) == UNCHANGED:
+                    unchanged += 1
+                    continue
+                writer.upsert(entry.rel_path, entry.size, entry.mtime_ns, entry.device, entry.inode)
+            if not directory.resumed:
+                directories.append(directory.rel_root)
+            if time.monotonic() >= next_checkpoint:
+                self._checkpoint_scan(writer, directories)
+                self.db.connection.execute("BEGIN IMMEDIATE")
+                next_checkpoint = time.monotonic() + self.scan_checkpoint_seconds
+            elif self.shared_catalog and writer.flush_count != flush_count:
+                self.db.connection.commit()
+                self.db.connection.execute("BEGIN IMMEDIATE")
+            flush_count = writer.flush_count
+        self._checkpoint_scan(writer, directories)
+        if snapshot is not None:
+            print(f"Snapshot: {unchanged} files unchanged")
+        print(f"Catalog writes: {writer.stats()}")
+
+    def _checkpoint_scan(self, writer: FileWriter, directories):
+        writer.flush()
+        self.db.add_scan_checkpoints(self.client_config.client_fqdn, self.client_config.backup_root,
+                                     self.scan_generation, directories)
         self.db.connection.commit()
+        directories.clear()
 
     def backup(self):
-        tar_size = 0
-        tar_name = None
-        tar_full_path = None
-        tar = None
-        tar_id = None
-        files_to_backup = self.db.get_files_to_backup(self.client_config.client_fqdn,
-                                                      self.client_config.backup_root)
-        files_to_backup_count = len(files_to_backup)
-        for idx, file in enumerate(files_to_backup):
-            if tar_name is None:
-                tar_name = self.new_archive_name() + ".tar.gz"
-                tar_full_path = os.path.join(self.tmp_directory, tar_name)
-                tar_base = os.path.dirname(tar_full_path)
-                print(f"tmpdir: {self.tmp_directory}, tar base: {tar_base}")
-                if not os.path.exists(tar_base):
-                    print(f"tar base: {tar_base} creating")
-                    os.makedirs(tar_base)
-                else:
-                    print(f"tar base: {tar_base} exists")
-                tar = tarfile.open(name=tar_full_path, mode='x:gz')
+        """
+        Archives the files to back up page by page, so that memory use does not depend on their number: each
+        page is hashed, classified and planned before the next one is read, the archives it fills being
+        submitted to the pipeline, which blocks while enough are in flight.
+        """
+        files_to_backup_count = 0
+        hasher = None
+        if self.content_dedup:
+            hasher = ContentHasher(self.db, self.scan_threads)
+        classifier = None
+        if self.adaptive_compression:
+            classifier = CompressibilityClassifier(self.scan_threads)
+        deduplicated_count = 0
+        deduplicated_bytes = 0
+        # Per codec, archives left underfilled by a page are completed with the next ones
+        planners = {codec.name: ArchivePlanner(self.archive_target_size) for codec in (self.codec, self.stored_codec)}
+        # Per codec: archive count, bytes before and after compression, compression seconds
+        self.compression_totals = {}
+        pipeline = ArchivePipeline(self.build_archive, None if self.streaming_upload else self.upload_archive,
+                                   self.archive_built, self.archive_uploaded,
+                                   self.archive_builders, self.archive_uploaders)
+        try:
+            for files_to_backup in self.db.get_files_to_backup(self.client_config.client_fqdn,
+                                                               self.client_config.backup_root):
+                files_to_backup_count += len(files_to_backup)
+                content_hashes = itertools.repeat(None)
+                if hasher is not None:
+                    content_hashes = hasher.hash_files([os.path.join(self.client_config.backup_root,
+                                                                     file.relative_path)
+                                                        for file in files_to_backup])
+                compressible = itertools.repeat(True)
+                if classifier is not None:
+                    compressible = classifier.classify_files([(os.path.join(self.client_config.backup_root,
+                                                                            file.relative_path), file.new_size)
+                                                              for file in files_to_backup])
+                # Files to archive by codec
+                to_archive = {self.codec.name: [], self.stored_codec.name: []}
+                for file, content_hash, worth_compressing in zip(files_to_backup, content_hashes, compressible):
+                    if content_hash is not None and content_hash.size == file.new_size:
+                        archived = self.db.find_archived_content(self.client_config.cloud,
+                                                                 self.client_config.region,
+                                                                 self.client_config.bucket, content_hash.digest,
+                                                                 content_hash.size)
+                        if archived is not None:
+                            archive_id, source_file_id = archived
+                            print(f"{file.relative_path} {file.new_size} -> already in archive {archive_id}")
+                            self.db.add_file_reference(archive_id, source_file_id, file.file_id, file.new_size,
+                                                       file.new_modification, content_hash.digest)
+                            deduplicated_count += 1
+                            deduplicated_bytes += file.new_size
+                            continue
 
-                print(f"New archive: {tar_name}")
-                tar_id = self.db.new_archive(self.client_config.cloud, self.client_config.region,
-                                             self.client_config.bucket, tar_name)
+                    # Already compressed or encrypted files go to separate, uncompressed archives
+                    codec = self.codec if worth_compressing else self.stored_codec
+                    to_archive[codec.name].append((file, content_hash))
 
-            # if (files_to_backup_count > 100 and idx % 10 == 1) or files_to_backup_count <= 100:
-            #     print(f"{file['relative_path']} {file['new_size']} -> {tar_name}",
-            #           end="\r", flush=True)
-            print(f"{file['relative_path']} {file['new_size']} -> {tar_name}")
+                for codec in (self.codec, self.stored_codec):
+                    self.submit_archives(pipeline, codec, planners[codec.name].plan(to_archive[codec.name],
+                                                                                    last=False))
+            for codec in (self.codec, self.stored_codec):
+                self.submit_archives(pipeline, codec, planners[codec.name].plan([]))
+            pipeline.drain()
+        finally:
+            pipeline.close()
+        print(f"Archives: {pipeline.stats()}")
+        for name, planner in planners.items():
+            if planner.archive_count > 0:
+                print(f"Archive plan ({name}): {planner.stats()}")
+        self.print_compression_stats()
 
-            try:
-                tar.add(os.path.join(
-                    self.client_config.backup_root, file["relative_path"]))
-            except FileNotFoundError as e:
-                # File has been deleted in the interim.
-                print(f'File disappeared: {file["relative_path"]}, {e}')
-            except tarfile.TarError as e:
-                # File may be unreadable (permissions), or some other error
-                # TODO Determine cases and handle appropriately
-                print(f'Failed to add {file["relative_path"]}: {e}')
-
-            # File successfully added to the tarball, so account for its size and add to archive index
-            tar_size += file["new_size"]
-            self.db.add_file_to_archive(tar_id, file["file_id"],
-                                        file['new_size'], file['new_modification'])
-
-            if tar_size >= self.archive_max_size_bytes:
-                self.flush_tarball_to_s3(tar, tar_full_path, tar_id, tar_size,
-                                         tar_name)
-                tar_name = None
-                tar_full_path = None
-                tar = None
-                tar_size = 0
-
-        if tar is not None:
-            self.flush_tarball_to_s3(tar, tar_full_path, tar_id, tar_size,
-                                     tar_name)
+        if classifier is not None:
+            classifier.close()
+            print(f"Adaptive compression: {classifier.stats()}")
+
+        if hasher is not None:
+            hasher.close()
+            hit_rate = deduplicated_count * 100 / files_to_backup_count if files_to_backup_count else 0.0
+            print(f"Dedup: {hasher.stats()}; {deduplicated_count} of {files_to_backup_count} files ({hit_rate:.1f}%) "
+                  f"already archived, {deduplicated_bytes} bytes not uploaded")
 
         # Flush output
         # print()
         # print("Backup complete")
 
-    def flush_tarball_to_s3(self, tar: tarfile, tar_full_path: str, tar_id: int, tar_size: int, tar_name: str):
-        tar.close()
-        enc_name = tar_name + '.enc'
-        enc_full_path = tar_full_path + '.enc'
-        # TODO it would be smarter to use asymmetric here; would improve security since we'd encrypt using public keys
-        subprocess.run(
-            f"gpg -c --pinentry-mode=loopback --passphrase-file {self.key_file_path} -o {enc_full_path} {tar_full_path}".split())
+    def submit_archives(self, pipeline: ArchivePipeline, codec: ArchiveCodec, archives):
+        for entries in archives:
+            tar_name = self.new_archive_name(codec.extension)
+            print(f"New archive: {tar_name}")
+            job = ArchiveJob(self.db.new_archive(self.client_config.cloud, self.client_config.region,
+                                                 self.client_config.bucket, tar_name, codec.name,
+                                                 self.encryption.name, self.client_config.client_fqdn,
+                                                 self.client_config.backup_root),
+                             tar_name, codec, entries, sum(entry_size(entry) for entry in entries))
+            pipeline.submit(job)
+
+    def build_archive(self, job: ArchiveJob):
+        """
+        Archive builder stage, runs on a pipeline thread: must not use the database.
+        """
+        start = time.monotonic()
+        job.digests.clear()
+        upload = None
+        if self.streaming_upload:
+            upload = StreamingUpload(self.key_file_path, self.storage, job.name + ".enc",
+                                     gpg=not self.encryption.in_process)
+            output = upload.stdin
+        else:
+            job.path = os.path.join(self.tmp_directory, job.name)
+            tar_base = os.path.dirname(job.path)
+            print(f"tmpdir: {self.tmp_directory}, tar base: {tar_base}")
+            os.makedirs(tar_base, exist_ok=True)
+            # Left by a failed attempt
+            for path in (job.path, job.path + ".enc"):
+                if os.path.exists(path):
+                    os.remove(path)
+            # Encrypted in process, the archive is only written encrypted
+            output = open(job.path + ".enc" if self.encryption.in_process else job.path, "xb")
+        # Encrypted as it is compressed, rather than by gpg once built
+        encryptor = self.encryption.encryptor(output) if self.encryption.in_process else None
+        compressor = job.codec.compressor(encryptor if encryptor is not None else output)
+        tar = tarfile.open(fileobj=compressor, mode='w|', bufsize=BUFFER_SIZE)
+
+        try:
+            for file, content_hash, part in job.files:
+                # if (files_to_backup_count > 100 and idx % 10 == 1) or files_to_backup_count <= 100:
+                #     print(f"{file['relative_path']} {file['new_size']} -> {tar_name}",
+                #           end="\r", flush=True)
+                full_path = os.path.join(self.client_config.backup_root, file.relative_path)
+                try:
+                    if part is None:
+                        print(f"{file.relative_path} {file.new_size} -> {job.name}")
+                        tar.add(full_path)
+                    else:
+                        print(f"{file.relative_path} {file.new_size} part {part.number}/{part.count} -> {job.name}")
+                        self.add_file_part(tar, full_path, part)
+                        continue
+                except FileNotFoundError as e:
+                    # File has been deleted in the interim.
+                    print(f'File disappeared: {file.relative_path}, {e}')
+                except tarfile.TarError as e:
+                    # File may be unreadable (permissions), or some other error
+                    # TODO Determine cases and handle appropriately
+                    print(f'Failed to add {file.relative_path}: {e}')
+
+                # Only trust the hash if what was archived is what was hashed
+                if content_hash is not None and content_hash.size == file.new_size and \
+                        content_hash.still_matches(full_path):
+                    job.digests[file.file_id] = content_hash.digest
+
+            tar.close()
+            compressor.close()
+            if encryptor is not None:
+                encryptor.close()
+        except BaseException as e:
+            # Clean up for a retry, storing nothing of a truncated archive
+            compressor.abort()
+            if upload is not None:
+                upload.abort()
+                # A broken pipe may be due to the streaming upload failing: report why
+                if upload.error is not None and not isinstance(upload.error, UploadAborted):
+                    raise upload.error from e
+            else:
+                output.close()
+                for path in (job.path, job.path + ".enc"):
+                    if os.path.exists(path):
+                        os.remove(path)
+            raise
+        job.uncompressed_bytes = compressor.uncompressed_bytes
+        job.compressed_bytes = compressor.compressed_bytes
+        job.compress_seconds = time.monotonic() - start
+
+        if upload is not None:
+            upload.finish()
+        elif encryptor is not None:
+            output.close()
+        else:
+            output.close()
+            # TODO it would be smarter to use asymmetric here; would improve security since we'd encrypt using public keys
+            subprocess.run(
+                f"gpg -c --pinentry-mode=loopback --passphrase-file {self.key_file_path} -o {job.path}.enc {job.path}".split()
+            ).check_returncode()
+            os.remove(job.path)
+
+    def add_file_part(self, tar: tarfile.TarFile, full_path: str, part: FilePart):
+        tarinfo = tar.gettarinfo(full_path, arcname=f"{full_path}.part{part.number:05d}")
+        tarinfo.size = part.size
+        with open(full_path, "rb") as f:
+            f.seek(part.offset)
+            reader = _PartReader(f, part.size)
+            tar.addfile(tarinfo, reader)
+        if reader.padded:
+            # Backed up again by the next backup, its modification time has changed
+            print(f"File shrank while being archived: {full_path}, part {part.number} padded with zeros")
+
+    def upload_archive(self, job: ArchiveJob):
+        """
+        Archive uploader stage, runs on a pipeline thread: must not use the database.
+        """
         # TODO calc sha256 of the enc file
-        cmd = f"aws --profile {self.client_config.credentials}"
-        cmd += f" s3 cp --storage-class {self.s3_storage_class}"
-        cmd += f" {enc_full_path} s3://{self.client_config.bucket}/{enc_name}"
-        subprocess.run(cmd.split()).check_returncode()
-        self.db.archive_uploaded(tar_id, tar_size)
-        os.remove(tar_full_path)
-        os.remove(enc_full_path)
-
-    def new_archive_name(self) -> str:
+        self.storage.upload_file(job.path + ".enc", job.name + ".enc")
+        os.remove(job.path + ".enc")
+
+    def archive_built(self, job: ArchiveJob):
+        ratio = job.compressed_bytes * 100 / job.uncompressed_bytes if job.uncompressed_bytes else 0.0
+        throughput = job.uncompressed_bytes / job.compress_seconds / 1000000 if job.compress_seconds else 0.0
+        print(f"Archive {job.name} ({job.codec.name}): {job.uncompressed_bytes} bytes compressed to "
+              f"{job.compressed_bytes} ({ratio:.1f}%) in {job.compress_seconds:.1f}s, {throughput:.1f}MB/s")
+        totals = self.compression_totals.setdefault(job.codec.name, [0, 0, 0, 0.0])
+        totals[0] += 1
+        totals[1] += job.uncompressed_bytes
+        totals[2] += job.compressed_bytes
+        totals[3] += job.compress_seconds
+        # Files are accounted for even if they disappeared in the interim
+        self.db.add_files_to_archive(job.archive_id, [
+            (file.file_id, file.new_size, file.new_modification, job.digests.get(file.file_id), None, None)
+            if part is None else
+            (file.file_id, part.size, file.new_modification, None, part.number, part.count)
+            for file, _, part in job.files])
+
+    def print_compression_stats(self):
+        uncompressed = sum(totals[1] for totals in self.compression_totals.values())
+        compressed = sum(totals[2] for totals in self.compression_totals.values())
+        if uncompressed == 0:
+            return
+        for name, (count, codec_uncompressed, codec_compressed, seconds) in self.compression_totals.items():
+            print(f"Compression ({name}): {count} archives, {codec_uncompressed} bytes to {codec_compressed} "
+                  f"({codec_compressed * 100 / codec_uncompressed:.1f}%) in {seconds:.1f}s")
+        print(f"Compression: {uncompressed} bytes to {compressed} ({compressed * 100 / uncompressed:.1f}%)")
+        if not self.adaptive_compression or ClientConfig.UNCOMPRESSED not in self.compression_totals or \
+                self.codec.name not in self.compression_totals:
+            return
+        # Estimated from this run's compressed archives, stored files would have compressed worse than those
+        _, stored, _, _ = self.compression_totals[ClientConfig.UNCOMPRESSED]
+        _, codec_uncompressed, codec_compressed, seconds = self.compression_totals[self.codec.name]
+        saved_seconds = stored * seconds / codec_uncompressed
+        print(f"Adaptive compression: {stored} bytes stored uncompressed, about {saved_seconds:.1f}s of "
+              f"{self.codec.name} compression saved; overall ratio {compressed * 100 / uncompressed:.1f}%, "
+              f"{codec_compressed * 100 / codec_uncompressed:.1f}% for compressed archives")
+
+    def archive_uploaded(self, job: ArchiveJob):
+        self.db.archive_uploaded(job.archive_id, job.size)
+
+    def new_archive_name(self, extension: str) -> str:
         # datetime, client, bkp root, seqnb
         # NB - this shards archives into a hierarchy based on the date to limit per-directory file count
         datetime_str = time.strftime('%Y/%m/%d/%H-%M-%S',
                                      self.backup_frozen_time_struct)
         safe_bkp_root = self.safe_filename(self.client_config.backup_root)
-        self.archive_sequence_nb += 1
-        name = f"{datetime_str}_{self.client_config.client_fqdn}_{safe_bkp_root}_{self.archive_sequence_nb}"
-        return name
+        while True:
+            self.archive_sequence_nb += 1
+            name = f"{datetime_str}_{self.client_config.client_fqdn}_{safe_bkp_root}_{self.archive_sequence_nb}"
+            # A previous backup of the root may have started within the same second
+            if not self.db.archive_exists(self.client_config.cloud, self.client_config.region,
+                                          self.client_config.bucket, name + extension):
+                return name + extension
 
     def safe_filename(self, filename: str) -> str:
         safe = filename.replace("/", "-").replace(".", "-").replace(" ", "-")
@@ -173,3 +574,23 @@ class Backup():
         if safe.endswith("-"):
             safe = safe[:len(safe) - 1]
         return safe
+
+
+class _PartReader():
+    """
+    Reads size bytes of a file from its current position, padded with zeros if the file is shorter.
+    """
+
+    def __init__(self, f, size: int):
+        self.f = f
+        self.remaining = size
+        self.padded = False
+
+    def read(self, n: int) -> bytes:
+        n = min(n, self.remaining)
+        data = self.f.read(n)
+        if len(data) < n:
+            self.padded = True
+            data += bytes(n - len(data))
+        self.remaining -= n
+        return data
@@ -0,0 +1,163 @@
+import gzip
+import shutil
+import subprocess
+import threading
+
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Optional
+
+from db import ClientConfig
+
+# Size of the writes from tarfile to the compressor, and from the compressor to the output
+BUFFER_SIZE = 1024 * 1024
+
+
+class _CountingWriter():
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def write(self, data) -> int:
+        self.fileobj.write(data)
+        self.count += len(data)
+        return len(data)
+
+
+class Compressor(ABC):
+    """
+    Compresses what is written to it into an output file object, which it does not close.
+    """
+
+    def __init__(self, fileobj):
+        self.output = _CountingWriter(fileobj)
+        self.uncompressed_bytes = 0
+
+    @property
+    def compressed_bytes(self) -> int:
+        return self.output.count
+
+    @abstractmethod
+    def write(self, data) -> int:
+        pass
+
+    @abstractmethod
+    def close(self):
+        """
+        Completes the output, raises if compression failed.
+        """
+
+    def abort(self):
+        pass
+
+
+class _StoredCompressor(Compressor):
+    def write(self, data) -> int:
+        self.uncompressed_bytes += len(data)
+        return self.output.write(data)
+
+    def close(self):
+        pass
+
+
+class _GzipCompressor(Compressor):
+    def __init__(self, fileobj, level: int):
+        super().__init__(fileobj)
+        self.gzip = gzip.GzipFile(fileobj=self.output, mode="wb", compresslevel=level)
+
+    def write(self, data) -> int:
+        self.uncompressed_bytes += len(data)
+        return self.gzip.write(data)
+
+    def close(self):
+        self.gzip.close()
+
+
+class _ZstdCompressor(Compressor):
+    """
+    Compresses with the zstd CLI on all cores. Its output is copied to the output file object by a thread.
+    """
+
+    def __init__(self, fileobj, level: int):
+        super().__init__(fileobj)
+        self.zstd = subprocess.Popen(["zstd", "-T0", f"-{level}", "-q", "-c"],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.error = None
+        self.copier = threading.Thread(target=self._copy_output, name="zstd-output", daemon=True)
+        self.copier.start()
+
+    def write(self, data) -> int:
+        self.uncompressed_bytes += len(data)
+        return self.zstd.stdin.write(data)
+
+    def close(self):
+        try:
+            self.zstd.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.copier.join()
+        returncode = self.zstd.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.zstd.args)
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        self.zstd.kill()
+        self.copier.join()
+        self.zstd.wait()
+
+    def _copy_output(self):
+        while True:
+            data = self.zstd.stdout.read(BUFFER_SIZE)
+            if not data:
+                break
+            if self.error is not None:
+                # Keep draining so that zstd doesn't block, close() reports the error
+                continue
+            try:
+                self.output.write(data)
+            except Exception as e:
+                self.error = e
+        self.zstd.stdout.close()
+
+
+@dataclass
+class ArchiveCodec():
+    """
+    Compression of archives, recorded per archive in the catalog so that restores know how to decode each one.
+    """
+
+    name: str
+    level: Optional[int] = None
+
+    EXTENSIONS = {
+        ClientConfig.UNCOMPRESSED: ".tar",
+        ClientConfig.GZIP: ".tar.gz",
+        ClientConfig.ZSTD: ".tar.zst",
+    }
+    DEFAULT_LEVELS = {
+        ClientConfig.UNCOMPRESSED: 0,
+        # As tarfile's "w:gz" mode, used before codecs could be chosen
+        ClientConfig.GZIP: 9,
+        ClientConfig.ZSTD: 3,
+    }
+
+    def __post_init__(self):
+        if self.name not in self.EXTENSIONS:
+            raise ValueError(f"Unknown archive codec: {self.name}")
+        if self.level is None:
+            self.level = self.DEFAULT_LEVELS[self.name]
+        if self.name == ClientConfig.ZSTD and shutil.which("zstd") is None:
+            raise RuntimeError("The zstd archive codec requires the zstd command")
+
+    @property
+    def extension(self) -> str:
+        return self.EXTENSIONS[self.name]
+
+    def compressor(self, fileobj) -> Compressor:
+        if self.name == ClientConfig.ZSTD:
+            return _ZstdCompressor(fileobj, self.level)
+        if self.name == ClientConfig.UNCOMPRESSED:
+            return _StoredCompressor(fileobj)
+        return _GzipCompressor(fileobj, self.level)
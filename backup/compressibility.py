@@ -0,0 +1,96 @@
+import math
+import os
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator, List, Tuple
+
+_UNSAMPLED = "unsampled"
+_EXTENSION = "extension"
+_LOW_ENTROPY = "low_entropy"
+_HIGH_ENTROPY = "high_entropy"
+
+# Formats that are already compressed or encrypted
+INCOMPRESSIBLE_EXTENSIONS = frozenset([
+    # Images
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".heif", ".avif", ".jxl",
+    # Video and audio
+    ".mp4", ".m4v", ".mov", ".mkv", ".webm", ".avi", ".wmv", ".mp3", ".m4a", ".aac", ".ogg", ".opus", ".flac",
+    # Archives and packages
+    ".zip", ".jar", ".war", ".apk", ".whl", ".gz", ".tgz", ".bz2", ".xz", ".txz", ".zst", ".lz4", ".7z", ".rar",
+    ".dmg", ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".odp", ".epub",
+    # Encrypted
+    ".gpg", ".pgp", ".age", ".enc",
+])
+
+
+@dataclass
+class CompressibilityClassifier():
+    """
+    Tells files worth compressing from those already compressed or encrypted: by extension, then by the byte
+    entropy of a sample read from the middle of the file, past any headers. Files smaller than min_size are
+    always compressed, there would be little to save.
+    """
+
+    threads: int
+    min_size: int = 256 * 1024
+    sample_size: int = 64 * 1024
+    # Bits per byte, 8 for random data
+    max_entropy: float = 7.5
+    # Files classified together, bounds how far sampling runs ahead of the caller
+    chunk_size: int = 64
+
+    def __post_init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.by_extension_count = 0
+        self.sampled_count = 0
+        self.by_entropy_count = 0
+
+    def classify_files(self, files: List[Tuple[str, int]]) -> Iterator[bool]:
+        """
+        Yields whether each file, given as path and size, is worth compressing.
+        """
+        for start in range(0, len(files), self.chunk_size):
+            for reason in self.executor.map(self._classify, files[start:start + self.chunk_size]):
+                if reason == _EXTENSION:
+                    self.by_extension_count += 1
+                elif reason in (_LOW_ENTROPY, _HIGH_ENTROPY):
+                    self.sampled_count += 1
+                    if reason == _HIGH_ENTROPY:
+                        self.by_entropy_count += 1
+                yield reason not in (_EXTENSION, _HIGH_ENTROPY)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def stats(self) -> str:
+        return (f"{self.by_extension_count} files incompressible by extension, "
+                f"{self.by_entropy_count} of {self.sampled_count} sampled by entropy")
+
+    def _classify(self, file: Tuple[str, int]) -> str:
+        path, size = file
+        if size < self.min_size:
+            return _UNSAMPLED
+        if os.path.splitext(path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+            return _EXTENSION
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                sample = os.pread(fd, self.sample_size, max(0, size // 2 - self.sample_size // 2))
+            finally:
+                os.close(fd)
+        except OSError:
+            # Left to the archive builder to report
+            return _UNSAMPLED
+        return _HIGH_ENTROPY if entropy(sample) > self.max_entropy else _LOW_ENTROPY
+
+
+def entropy(data: bytes) -> float:
+    """
+    Shannon entropy in bits per byte.
+    """
+    if len(data) == 0:
+        return 0.0
+    total = len(data)
+    return -sum(count / total * math.log2(count / total) for count in Counter(data).values())
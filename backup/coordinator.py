@@ -1,3 +1,8 @@
+import os
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
 from db import Database, ClientConfigFactory, ClientConfig
 
 from .backup import Backup
@@ -5,19 +10,89 @@ from .purge import Purge
 
 
 class Coordinator():
-    def __init__(self):
-        self.db = Database()
+    """
+    Backs up the active client configs, up to concurrent_backups at a time but no more than backups_per_device
+    of roots on the same device, whose disk they would otherwise compete for. Concurrent backups each have a
+    connection of their own to the catalog. The catalog's own backup runs last, alone, so that it captures
+    what the others recorded, and the catalog file is left unchanged while it is archived.
+    """
+
+    def __init__(self, concurrent_backups: int = 1, backups_per_device: int = 1, pragmas=None):
+        self.pragmas = pragmas
+        self.db = Database(pragmas=pragmas)
+        self.concurrent_backups = max(1, concurrent_backups)
+        self.backups_per_device = max(1, backups_per_device)
 
     def run(self):
         ccf = ClientConfigFactory(self.db)
-        client_configs = ccf.get_active_client_configs()
+        client_configs = [cc for cc in ccf.get_active_client_configs()
+                          if cc.options[ClientConfig.MANUAL_ONLY] != ClientConfig.YES]
+        catalog_root = os.path.dirname(self.db.db_path)
+        self.run_concurrently([cc for cc in client_configs if cc.backup_root != catalog_root])
         for cc in client_configs:
-            if cc.options[ClientConfig.MANUAL_ONLY] == ClientConfig.YES:
-                continue
-            print(f"Backing up: {cc}")
-            Backup(self.db, cc).run()
-            print(f"Purging obsolete archives: {cc}")
-            Purge(self.db, cc).run()
+            if cc.backup_root == catalog_root:
+                with self.db.frozen():
+                    self.backup(self.db, cc)
+
+    def run_concurrently(self, client_configs):
+        """
+        Once a backup fails no other is started, and the first failure is raised when the running ones end.
+        """
+        if self.concurrent_backups == 1:
+            for cc in client_configs:
+                self.backup(self.db, cc)
+            return
+        pending = list(client_configs)
+        # Device of each running backup's root
+        running = {}
+        failure = None
+        with ThreadPoolExecutor(max_workers=self.concurrent_backups, thread_name_prefix="backup") as executor:
+            while running or (pending and failure is None):
+                if failure is None:
+                    for cc in list(pending):
+                        device = self._device(cc)
+                        if len(running) < self.concurrent_backups and \
+                                list(running.values()).count(device) < self.backups_per_device:
+                            pending.remove(cc)
+                            running[executor.submit(self._backup_with_own_connection, cc)] = device
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+                    e = future.exception()
+                    if e is None:
+                        continue
+                    if failure is None:
+                        failure = e
+                    else:
+                        traceback.print_exception(type(e), e, e.__traceback__)
+        if failure is not None:
+            if pending:
+                print(f"Not backed up after the failure: {', '.join(cc.backup_root for cc in pending)}")
+            raise failure
+
+    def _backup_with_own_connection(self, cc):
+        db = Database(pragmas=self.pragmas)
+        try:
+            self.backup(db, cc, shared_catalog=True)
+        except BaseException:
+            print(f"Backup failed: {cc}")
+            raise
+        finally:
+            db.close()
+
+    @staticmethod
+    def _device(cc):
+        try:
+            return os.stat(cc.backup_root).st_dev
+        except OSError:
+            # The backup fails on its own
+            return cc.backup_root
+
+    def backup(self, db: Database, cc: ClientConfig, shared_catalog: bool = False):
+        print(f"Backing up: {cc}")
+        Backup(db, cc, shared_catalog=shared_catalog).run()
+        print(f"Purging obsolete archives: {cc}")
+        Purge(db, cc).run()
 
     def run_manual(self, cloud_provider, region, client_name, backup_root):
         ccf = ClientConfigFactory(self.db)
@@ -35,7 +110,4 @@ class Coordinator():
             if cc.backup_root != backup_root:
                 print(f"Skipping (root = {backup_root}): {cc}")
                 continue
-            print(f"Backing up: {cc}")
-            Backup(self.db, cc).run()
-            print(f"Purging obsolete archives: {cc}")
-            Purge(self.db, cc).run()
+            self.backup(self.db, cc)
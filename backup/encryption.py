@@ -0,0 +1,145 @@
+import os
+import struct
+
+from dataclasses import dataclass
+
+from db import ClientConfig
+
+# Container: header, then the archive in chunks of CHUNK_SIZE bytes (the last one shorter, possibly empty), each
+# encrypted with AES-256-GCM under a key derived from the key file with scrypt and the header's salt. A chunk's
+# nonce is the header's nonce prefix, the chunk's number and whether it is the last one, so that chunks cannot
+# be reordered, dropped or truncated undetected. The header is authenticated with every chunk.
+MAGIC = b"DFZA"
+VERSION = 1
+AES_256_GCM = 1
+CHUNK_SIZE = 1024 * 1024
+TAG_SIZE = 16
+SALT_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+# scrypt cost: 2^15 iterations of 8 blocks, about 32MB and 0.1s per archive
+SCRYPT_LOG2_N = 15
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+# Magic, version, algorithm, chunk size, scrypt log2(N), r and p, salt, nonce prefix
+_HEADER = struct.Struct(f">4sBBIBBB{SALT_SIZE}s{NONCE_PREFIX_SIZE}s")
+
+
+class DecryptionError(Exception):
+    pass
+
+
+def read_passphrase(key_file_path: str) -> bytes:
+    # As gpg --passphrase-file: the first line
+    with open(key_file_path, "rb") as f:
+        return f.readline().rstrip(b"\r\n")
+
+
+def _aead(passphrase: bytes, salt: bytes, log2_n: int, r: int, p: int):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+    return AESGCM(Scrypt(salt=salt, length=32, n=1 << log2_n, r=r, p=p).derive(passphrase))
+
+
+def _nonce(prefix: bytes, number: int, last: bool) -> bytes:
+    return prefix + struct.pack(">IB", number, 1 if last else 0)
+
+
+class Encryptor():
+    """
+    Encrypts what is written to it into an output file object, which it does not close.
+    """
+
+    def __init__(self, fileobj, passphrase: bytes, chunk_size: int = CHUNK_SIZE):
+        self.output = fileobj
+        self.chunk_size = chunk_size
+        salt = os.urandom(SALT_SIZE)
+        self.nonce_prefix = os.urandom(NONCE_PREFIX_SIZE)
+        self.header = _HEADER.pack(MAGIC, VERSION, AES_256_GCM, chunk_size, SCRYPT_LOG2_N, SCRYPT_R, SCRYPT_P,
+                                   salt, self.nonce_prefix)
+        self.aead = _aead(passphrase, salt, SCRYPT_LOG2_N, SCRYPT_R, SCRYPT_P)
+        self.buffer = bytearray()
+        self.chunk_number = 0
+        self.output.write(self.header)
+
+    def write(self, data) -> int:
+        self.buffer += data
+        # A full chunk is only known not to be the last once more data follows
+        while len(self.buffer) > self.chunk_size:
+            self._write_chunk(bytes(self.buffer[:self.chunk_size]), False)
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def close(self):
+        self._write_chunk(bytes(self.buffer), True)
+        self.buffer = bytearray()
+
+    def _write_chunk(self, chunk: bytes, last: bool):
+        if self.chunk_number >= 1 << 32:
+            raise ValueError("Archive too large to encrypt")
+        self.output.write(self.aead.encrypt(_nonce(self.nonce_prefix, self.chunk_number, last), chunk, self.header))
+        self.chunk_number += 1
+
+
+def decrypt(fileobj, output, passphrase: bytes):
+    """
+    Decrypts a container read from fileobj into output, raises DecryptionError if it is not a valid container,
+    was encrypted with another key, or was altered or truncated.
+    """
+    from cryptography.exceptions import InvalidTag
+
+    header = fileobj.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        raise DecryptionError("Truncated header")
+    magic, version, algorithm, chunk_size, log2_n, r, p, salt, nonce_prefix = _HEADER.unpack(header)
+    if magic != MAGIC:
+        raise DecryptionError("Not an encrypted archive")
+    if version != VERSION or algorithm != AES_256_GCM:
+        raise DecryptionError(f"Unsupported container version {version}, algorithm {algorithm}")
+    aead = _aead(passphrase, salt, log2_n, r, p)
+    number = 0
+    chunk = fileobj.read(chunk_size + TAG_SIZE)
+    while True:
+        # Read ahead to tell the last chunk
+        following = fileobj.read(chunk_size + TAG_SIZE) if len(chunk) == chunk_size + TAG_SIZE else b""
+        last = len(following) == 0
+        try:
+            output.write(aead.decrypt(_nonce(nonce_prefix, number, last), chunk, header))
+        except InvalidTag:
+            raise DecryptionError(f"Chunk {number} failed authentication: wrong key, altered or truncated archive")
+        if last:
+            return
+        chunk = following
+        number += 1
+
+
+@dataclass
+class ArchiveEncryption():
+    """
+    Encryption of archives, recorded per archive in the catalog so that restores know how to decrypt each one:
+    by a gpg process reading the built archive, or in process as it is written.
+    """
+
+    name: str
+    key_file_path: str
+
+    NAMES = (ClientConfig.GPG, ClientConfig.AEAD)
+
+    def __post_init__(self):
+        if self.name not in self.NAMES:
+            raise ValueError(f"Unknown archive encryption: {self.name}")
+        self.passphrase = None
+        if self.name == ClientConfig.AEAD:
+            try:
+                import cryptography  # noqa: F401
+            except ImportError:
+                raise RuntimeError("The aead archive encryption requires the cryptography package")
+            self.passphrase = read_passphrase(self.key_file_path)
+
+    @property
+    def in_process(self) -> bool:
+        return self.name == ClientConfig.AEAD
+
+    def encryptor(self, fileobj) -> Encryptor:
+        return Encryptor(fileobj, self.passphrase)
@@ -0,0 +1,126 @@
+import hashlib
+import os
+import stat
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator, List, NamedTuple, Optional
+
+from db import Database
+
+
+class ContentHash(NamedTuple):
+    digest: str
+    size: int
+    device: int
+    inode: int
+    modification_ns: int
+
+    def still_matches(self, path: str) -> bool:
+        """
+        Whether the file is unchanged since it was hashed, i.e. the hash describes what was then archived.
+        """
+        try:
+            metadata = os.lstat(path)
+        except OSError:
+            return False
+        return (metadata.st_dev, metadata.st_ino, metadata.st_size, metadata.st_mtime_ns) == \
+            (self.device, self.inode, self.size, self.modification_ns)
+
+
+@dataclass
+class ContentHasher():
+    """
+    SHA-256 of file contents, computed in parallel threads that each reuse one read buffer.
+
+    Hashes are cached in the catalog by device, inode, size and modification time in nanoseconds, so
+    unchanged files are never read twice. The cache is looked up by the threads too, on read-only connections.
+    """
+
+    db: Database
+    threads: int
+    buffer_size: int = 1024 * 1024
+    # Files looked up and hashed together, bounds how far hashing runs ahead of the caller
+    chunk_size: int = 64
+
+    def __post_init__(self):
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.hashed_count = 0
+        self.hashed_bytes = 0
+        self.cached_count = 0
+
+    def hash_files(self, paths: List[str]) -> Iterator[Optional[ContentHash]]:
+        """
+        Yields the hash of each file in order, or None if it could not be read.
+        """
+        for start in range(0, len(paths), self.chunk_size):
+            chunk = paths[start:start + self.chunk_size]
+            hashes = []
+            misses = []
+            for path, (metadata, digest) in zip(chunk, self.executor.map(self._lookup, chunk)):
+                if metadata is None:
+                    hashes.append(None)
+                    continue
+                content_hash = ContentHash(digest, metadata.st_size, metadata.st_dev, metadata.st_ino,
+                                           metadata.st_mtime_ns)
+                if digest is None:
+                    misses.append((len(hashes), path, content_hash))
+                else:
+                    self.cached_count += 1
+                hashes.append(content_hash)
+
+            computed = self.executor.map(self._hash, (path for _, path, _ in misses))
+            new_entries = []
+            for (i, path, content_hash), digest in zip(misses, computed):
+                if digest is None or not content_hash.still_matches(path):
+                    # Changed while being read
+                    hashes[i] = None
+                    continue
+                hashes[i] = content_hash._replace(digest=digest)
+                new_entries.append((content_hash.device, content_hash.inode, content_hash.size,
+                                    content_hash.modification_ns, digest))
+                self.hashed_count += 1
+                self.hashed_bytes += content_hash.size
+            self.db.cache_content_hashes(new_entries)
+
+            yield from hashes
+
+    def close(self):
+        self.executor.shutdown()
+
+    def stats(self) -> str:
+        return f"{self.hashed_count} files hashed ({self.hashed_bytes} bytes), {self.cached_count} cached"
+
+    def _lookup(self, path: str):
+        """
+        The file's metadata and cached hash, if any.
+        """
+        try:
+            metadata = os.lstat(path)
+        except OSError:
+            return None, None
+        # Symbolic links and special files are archived as such, their content isn't comparable
+        if not stat.S_ISREG(metadata.st_mode):
+            return None, None
+        return metadata, self.db.get_cached_content_hash(metadata.st_dev, metadata.st_ino, metadata.st_size,
+                                                         metadata.st_mtime_ns)
+
+    def _hash(self, path: str) -> Optional[str]:
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            buffer = self.local.buffer = memoryview(bytearray(self.buffer_size))
+        h = hashlib.sha256()
+        try:
+            with open(path, "rb", buffering=0) as f:
+                while True:
+                    n = f.readinto(buffer)
+                    if not n:
+                        break
+                    # hashlib releases the GIL for large updates, so threads hash in parallel
+                    h.update(buffer[:n])
+        except OSError as e:
+            print(f"Unable to hash {path}: {e}")
+            return None
+        return h.hexdigest()
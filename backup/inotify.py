@@ -0,0 +1,72 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+
+from typing import Iterator, NamedTuple
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyEvent(NamedTuple):
+    wd: int
+    mask: int
+    cookie: int
+    name: str
+
+
+class Inotify():
+    """
+    Minimal ctypes binding to the Linux inotify API.
+    """
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not supported on this platform")
+        self.fd = self._check(self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    def add_watch(self, path: str, mask: int) -> int:
+        return self._check(self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask)))
+
+    def read(self) -> Iterator[InotifyEvent]:
+        try:
+            buffer = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b"\0")
+            offset += length
+            yield InotifyEvent(wd, mask, cookie, os.fsdecode(name))
+
+    def close(self):
+        os.close(self.fd)
+
+    def _check(self, result: int) -> int:
+        if result < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return result
@@ -0,0 +1,192 @@
+import fcntl
+import hashlib
+import json
+import os
+
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Tuple
+
+from db import ClientConfig
+
+# Record kinds: a directory whose own entries changed, a directory whose whole subtree must be rescanned,
+# and events having been lost
+DIRTY = "D"
+DIRTY_RECURSIVE = "R"
+OVERFLOW = "O"
+
+WATCHER_STATE_FILE = "watcher.json"
+
+
+def journal_directory(db_path: str) -> str:
+    return os.path.join(os.path.dirname(db_path), "journal")
+
+
+@dataclass
+class ChangeJournal():
+    """
+    Directories changed under a backup root since the last successful backup, as recorded by deep-freeze-watch.py.
+
+    The watcher appends to <name>.journal. A backup renames it to <name>.journal.scanning before scanning,
+    so changes made during the scan land in a new journal, and deletes it once the backup has completed.
+    The journal can only be trusted if the same watcher session has been running since the previous
+    backup completed, and the configuration's exclusion settings haven't changed: this is tracked
+    in <name>.state.
+
+    Directory paths are relative to the backup root with a leading slash, "" being the root itself.
+    """
+
+    directory: str
+    client_config: ClientConfig
+
+    def __post_init__(self):
+        name = self.client_config.state_file_name()
+        self.journal_path = os.path.join(self.directory, name + ".journal")
+        self.claimed_path = self.journal_path + ".scanning"
+        self.state_path = os.path.join(self.directory, name + ".state")
+        self.recorded = set()
+        self.recorded_inode = None
+        self.session = None
+
+    # Watcher side
+
+    def record(self, kind: str, path: str = ""):
+        self.record_all([(kind, path)])
+
+    def record_all(self, records: Iterable[Tuple[str, str]]):
+        os.makedirs(self.directory, exist_ok=True)
+        with self._open_locked(self.journal_path) as f:
+            inode = os.fstat(f.fileno()).st_ino
+            if inode != self.recorded_inode:
+                # The backup has claimed the previous journal
+                self.recorded.clear()
+                self.recorded_inode = inode
+            for record in records:
+                if record in self.recorded:
+                    continue
+                self.recorded.add(record)
+                f.write(json.dumps(record) + "\n")
+
+    # Backup side
+
+    def claim(self) -> Optional[List[Tuple[str, bool]]]:
+        """
+        Returns the (directory, recursive) pairs to rescan, or None if the whole root must be walked.
+        """
+        self.session = self._current_watcher_session()
+        self._take_journal()
+
+        if self.session is None:
+            print("Change journal: watcher not running, full scan")
+            return None
+
+        state = self._read_json(self.state_path)
+        if state is None or state.get("session") != self.session:
+            print("Change journal: no continuous record since the last backup, full scan")
+            return None
+        if state.get("fingerprint") != self.fingerprint():
+            print("Change journal: exclusion settings changed, full scan")
+            return None
+
+        dirty = set()
+        dirty_recursive = set()
+        if os.path.exists(self.claimed_path):
+            with open(self.claimed_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        kind, path = json.loads(line)
+                    except ValueError:
+                        # Torn write if the watcher was killed: can't tell what was lost
+                        print("Change journal: corrupt record, full scan")
+                        return None
+                    if kind == OVERFLOW:
+                        print("Change journal: events were lost, full scan")
+                        return None
+                    (dirty_recursive if kind == DIRTY_RECURSIVE else dirty).add(path)
+
+        scope = []
+        for path in sorted(dirty_recursive):
+            if not self._has_ancestor_in(path, dirty_recursive):
+                scope.append((path, True))
+        for path in sorted(dirty):
+            if path not in dirty_recursive and not self._has_ancestor_in(path, dirty_recursive):
+                scope.append((path, False))
+        print(f"Change journal: rescanning {len(scope)} directories")
+        return scope
+
+    def complete(self):
+        if self.session is not None:
+            self._write_json(self.state_path, {"session": self.session, "fingerprint": self.fingerprint()})
+        elif os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        if os.path.exists(self.claimed_path):
+            os.remove(self.claimed_path)
+
+    def distrust(self):
+        """
+        Makes the next backup walk the whole root, e.g. because this one missed changes it was told about.
+        """
+        self.session = None
+
+    def fingerprint(self) -> str:
+        settings = [self.client_config.options.get(ClientConfig.BACKUPS_CROSS_DEVICES),
+                    self.client_config.options.get(ClientConfig.EXCLUSION_MARKERS)]
+        settings += sorted(p.pattern for p in self.client_config.exclusions or [])
+        return hashlib.sha256(json.dumps(settings).encode("utf-8")).hexdigest()
+
+    def _take_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+        with self._open_locked(self.journal_path) as f:
+            if os.path.exists(self.claimed_path):
+                # A previous backup did not complete: keep its records too
+                with open(self.journal_path, "r", encoding="utf-8") as pending, \
+                        open(self.claimed_path, "a", encoding="utf-8") as claimed:
+                    claimed.write(pending.read())
+                os.remove(self.journal_path)
+            else:
+                os.rename(self.journal_path, self.claimed_path)
+
+    def _open_locked(self, path: str):
+        # The file may be renamed by another process between open() and flock(), so check we locked the file
+        # that is still at path
+        while True:
+            f = open(path, "a", encoding="utf-8")
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                    return f
+            except FileNotFoundError:
+                pass
+            f.close()
+
+    def _current_watcher_session(self) -> Optional[str]:
+        watcher = self._read_json(os.path.join(self.directory, WATCHER_STATE_FILE))
+        if watcher is None:
+            return None
+        try:
+            os.kill(watcher["pid"], 0)
+        except ProcessLookupError:
+            return None
+        except PermissionError:
+            pass
+        return watcher["session"]
+
+    def _has_ancestor_in(self, path: str, directories: set) -> bool:
+        while path != "":
+            path = path[:path.rfind("/")]
+            if path in directories:
+                return True
+        return False
+
+    def _read_json(self, path: str):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_json(self, path: str, value):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
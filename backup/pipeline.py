@@ -0,0 +1,122 @@
+import time
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from .codec import ArchiveCodec
+from .planner import Entry
+
+_BUILD = "build"
+_UPLOAD = "upload"
+
+
+@dataclass
+class ArchiveJob():
+    archive_id: int
+    name: str
+    codec: ArchiveCodec
+    files: List[Entry] = field(default_factory=list)
+    size: int = 0
+    # Set while building: the archive's local path unless streamed, and the content hashes that match
+    # what was archived, by file ID
+    path: Optional[str] = None
+    digests: Dict[int, str] = field(default_factory=dict)
+    uncompressed_bytes: int = 0
+    compressed_bytes: int = 0
+    compress_seconds: float = 0.0
+    build_seconds: float = 0.0
+    upload_seconds: float = 0.0
+    attempts: int = 0
+
+
+class ArchivePipeline():
+    """
+    Builds archives on builder threads and uploads them on uploader threads, so that reading files, compressing,
+    encrypting and uploading overlap. At most builders + uploaders archives are in flight, submit() waits for
+    one to complete beyond that, which bounds temporary disk use. A failed stage is retried up to retries
+    times for that archive alone, e.g. for one part of a large file, before the failure is raised.
+
+    built() and uploaded() are called on the thread calling submit() and drain(), which should be the only one
+    using the database connection. Without an upload stage (upload is None), build() must also upload.
+    """
+
+    def __init__(self, build: Callable[[ArchiveJob], None], upload: Optional[Callable[[ArchiveJob], None]],
+                 built: Callable[[ArchiveJob], None], uploaded: Callable[[ArchiveJob], None],
+                 builders: int, uploaders: int, retries: int = 2):
+        self.build = build
+        self.upload = upload
+        self.built = built
+        self.uploaded = uploaded
+        self.retries = retries
+        self.builders = ThreadPoolExecutor(max_workers=builders, thread_name_prefix="archive-builder")
+        self.uploaders = None
+        self.max_in_flight = builders
+        if upload is not None:
+            self.uploaders = ThreadPoolExecutor(max_workers=uploaders, thread_name_prefix="archive-uploader")
+            self.max_in_flight += uploaders
+        self.in_flight = {}
+        self.start = time.monotonic()
+        self.archive_count = 0
+        self.build_seconds = 0.0
+        self.upload_seconds = 0.0
+        self.retry_count = 0
+
+    def submit(self, job: ArchiveJob):
+        while len(self.in_flight) >= self.max_in_flight:
+            self._complete()
+        job.attempts = 0
+        self.in_flight[self.builders.submit(self._build, job)] = (job, _BUILD)
+
+    def drain(self):
+        while len(self.in_flight) > 0:
+            self._complete()
+
+    def close(self):
+        # On failure, let archives being built or uploaded finish but don't start others
+        for future in self.in_flight:
+            future.cancel()
+        self.builders.shutdown()
+        if self.uploaders is not None:
+            self.uploaders.shutdown()
+
+    def stats(self) -> str:
+        elapsed = time.monotonic() - self.start
+        return (f"{self.archive_count} archives in {elapsed:.1f}s, "
+                f"{self.build_seconds:.1f}s building, {self.upload_seconds:.1f}s uploading, {self.retry_count} retries")
+
+    def _complete(self):
+        done, _ = wait(self.in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            job, stage = self.in_flight.pop(future)
+            e = future.exception()
+            if e is not None:
+                if job.attempts >= self.retries:
+                    raise e
+                job.attempts += 1
+                self.retry_count += 1
+                print(f"Retrying {stage} of {job.name} ({job.attempts}/{self.retries}): {e}")
+                executor, function = (self.builders, self._build) if stage == _BUILD else (self.uploaders, self._upload)
+                self.in_flight[executor.submit(function, job)] = (job, stage)
+                continue
+            if stage == _BUILD:
+                self.built(job)
+                self.build_seconds += job.build_seconds
+                if self.upload is not None:
+                    job.attempts = 0
+                    self.in_flight[self.uploaders.submit(self._upload, job)] = (job, _UPLOAD)
+                    continue
+            else:
+                self.upload_seconds += job.upload_seconds
+            self.uploaded(job)
+            self.archive_count += 1
+
+    def _build(self, job: ArchiveJob):
+        start = time.monotonic()
+        self.build(job)
+        job.build_seconds = time.monotonic() - start
+
+    def _upload(self, job: ArchiveJob):
+        start = time.monotonic()
+        self.upload(job)
+        job.upload_seconds = time.monotonic() - start
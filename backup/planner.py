@@ -0,0 +1,153 @@
+import bisect
+
+from dataclasses import dataclass
+from typing import Any, List, NamedTuple, Optional, Tuple
+
+from db.db import NANOSECONDS, FileToBackup
+
+
+class FilePart(NamedTuple):
+    # From 1
+    number: int
+    count: int
+    offset: int
+    size: int
+
+
+# A file to archive, its content hash if any, and the part of it to archive if it is split
+Entry = Tuple[FileToBackup, Any, Optional[FilePart]]
+
+
+@dataclass
+class ArchivePlanner():
+    """
+    Packs files to back up into archives of up to target_size bytes.
+
+    Files larger than target_size are split in parts of target_size bytes, each in an archive of its own but
+    for the last one, packed as any other file. Files of exactly target_size bytes get their own archive.
+
+    Files replacing a version younger than volatile_seconds are packed apart from the others: archives of such
+    churning files lose their relevance together and are purged whole, instead of keeping stable files'
+    archives alive. Within each group files are taken in directory order, keeping directories together, and
+    an archive is closed once a file doesn't fit if it is at least min_fill full. Files skipped to fill
+    archives further are then fitted in the remaining space.
+
+    Files may be planned in successive batches: archives less than min_fill full are then held back and their
+    files packed with the next batch, until the last one.
+    """
+
+    target_size: int
+    min_fill: float = 0.75
+    volatile_seconds: int = 30 * 24 * 3600
+
+    def __post_init__(self):
+        self.archive_count = 0
+        # Archives holding a single file or part of target_size bytes, and bytes in the others
+        self.full_count = 0
+        self.packed_bytes = 0
+        self.oversized_count = 0
+        self.split_count = 0
+        self.volatile_count = 0
+        # Files of archives held back, by group
+        self.held = {}
+
+    def plan(self, files: List[Tuple[FileToBackup, Any]], last: bool = True) -> List[List[Entry]]:
+        """
+        Takes files to archive with their content hash, if any, and whether no more files follow.
+        """
+        archives = []
+        stable = []
+        volatile = []
+        for file, content_hash in files:
+            size = file.new_size
+            group = volatile if self.is_volatile(file) else stable
+            if size < self.target_size:
+                group.append((file, content_hash, None))
+                continue
+            self.oversized_count += 1
+            if size == self.target_size:
+                archives.append([(file, content_hash, None)])
+                continue
+            self.split_count += 1
+            count = (size + self.target_size - 1) // self.target_size
+            for number in range(1, count + 1):
+                offset = (number - 1) * self.target_size
+                part = FilePart(number, count, offset, min(self.target_size, size - offset))
+                if part.size == self.target_size:
+                    archives.append([(file, content_hash, part)])
+                else:
+                    group.append((file, content_hash, part))
+        self.volatile_count += len(volatile)
+        packed = self._pack("stable", stable, last) + self._pack("volatile", volatile, last)
+
+        self.archive_count += len(archives) + len(packed)
+        self.full_count += len(archives)
+        self.packed_bytes += sum(entry_size(entry) for entries in packed for entry in entries)
+        return archives + packed
+
+    def is_volatile(self, file: FileToBackup) -> bool:
+        # New files have no history to go by
+        return file.last_archive_id is not None and \
+            file.new_modification - file.modification < self.volatile_seconds * NANOSECONDS
+
+    def stats(self) -> str:
+        packed_count = self.archive_count - self.full_count
+        mean_fill = self.packed_bytes * 100 / (packed_count * self.target_size) if packed_count else 0.0
+        return (f"{self.archive_count} archives of up to {self.target_size} bytes, {mean_fill:.1f}% full on average "
+                f"besides {self.full_count} full ones, {self.split_count} of {self.oversized_count} oversized files "
+                f"split in parts, {self.volatile_count} volatile files or parts")
+
+    def _pack(self, group: str, entries: List[Entry], last: bool) -> List[List[Entry]]:
+        entries = self.held.pop(group, []) + entries
+        entries.sort(key=lambda entry: _locality_key(entry[0].relative_path))
+        archives = []
+        sizes = []
+        skipped = []
+        for entry in entries:
+            size = entry_size(entry)
+            if len(archives) > 0 and sizes[-1] + size > self.target_size:
+                if sizes[-1] < self.min_fill * self.target_size:
+                    skipped.append(entry)
+                    continue
+                archives.append([])
+                sizes.append(0)
+            elif len(archives) == 0:
+                archives.append([])
+                sizes.append(0)
+            archives[-1].append(entry)
+            sizes[-1] += size
+
+        # Best fit, largest first, using the space left in each archive sorted in ascending order
+        skipped.sort(key=entry_size, reverse=True)
+        space = sorted((self.target_size - size, i) for i, size in enumerate(sizes))
+        for entry in skipped:
+            size = entry_size(entry)
+            position = bisect.bisect_left(space, (size, -1))
+            if position < len(space):
+                free, i = space.pop(position)
+            else:
+                free, i = self.target_size, len(archives)
+                archives.append([])
+            archives[i].append(entry)
+            bisect.insort(space, (free - size, i))
+
+        if last:
+            return archives
+        closed = []
+        for entries in archives:
+            if sum(entry_size(entry) for entry in entries) < self.min_fill * self.target_size:
+                self.held.setdefault(group, []).extend(entries)
+            else:
+                closed.append(entries)
+        return closed
+
+
+def entry_size(entry: Entry) -> int:
+    file, _, part = entry
+    return part.size if part is not None else file.new_size
+
+
+def _locality_key(relative_path: str):
+    # A directory's files, then its subdirectories
+    directory, _, name = relative_path.rpartition("/")
+    return directory.split("/"), name
@@ -6,7 +6,9 @@ import tempfile
 
 from dataclasses import dataclass
 
-from db import Database, ClientConfig, File
+from db import Database, ClientConfig
+
+from .storage import storage_for
 
 
 @dataclass
@@ -17,6 +19,10 @@ class Purge():
 
     db: Database
     client_config: ClientConfig
+    s3_storage_class: str = "DEEP_ARCHIVE"
+
+    def __post_init__(self):
+        self.storage = storage_for(self.client_config, self.s3_storage_class)
 
     def run(self):
         self.fix_stats()
@@ -28,20 +34,32 @@ class Purge():
             query = '''
                   update s3_archives as s3
                   set relevant_size = (select ifnull(sum(file_size), 0) from file_archive_records as far where far.archive_id = s3.archive_id and far.status = 'uploaded')
+                  -- Archives of other client configs may be being backed up concurrently
+                  where s3.archive_id in (select far.archive_id
+                                          from file_archive_records as far
+                                          inner join files as f using (file_id)
+                                          inner join directories as d using (directory_id)
+                                          where d.client_fqdn = ?
+                                          and d.backup_root = ?)
                   '''
-            cursor.execute(query)
+            cursor.execute(query, (self.client_config.client_fqdn, self.client_config.backup_root))
 
     def purge(self):
         self.db.flag_archives_to_delete(self.client_config.cloud, self.client_config.region,
                                         self.client_config.bucket, self.client_config.backup_root)
         archives = self.db.get_archives_pending_deletion(self.client_config.cloud, self.client_config.region,
                                                     self.client_config.bucket, self.client_config.backup_root)
-        for archive in archives:
-            cmd = f"aws --profile {self.client_config.credentials}"
-            cmd += f" s3 rm"
-            cmd += f" s3://{self.client_config.bucket}/{archive['archive_file_name']}.enc"
-            completed = subprocess.run(cmd.split())
-            
-            if completed.returncode == 0:
-                self.db.flag_archive_deleted(archive['archive_id'])
-        
\ No newline at end of file
+        if len(archives) == 0:
+            return
+        names = {f"{archive['archive_file_name']}.enc": archive["archive_id"] for archive in archives}
+        start = time.monotonic()
+        outcomes = self.storage.delete_objects(list(names))
+        deleted = []
+        for name, error in outcomes.items():
+            if error is None:
+                deleted.append(names[name])
+            else:
+                # Left pending deletion, retried by the next purge
+                print(f"Failed to delete {name}: {error}")
+        self.db.flag_archives_deleted(deleted)
+        print(f"Purge: {len(deleted)} of {len(names)} archives deleted in {time.monotonic() - start:.1f}s")
@@ -0,0 +1,137 @@
+import os
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from typing import FrozenSet, Iterator, List, NamedTuple, Optional, Tuple
+
+from db import ClientConfig
+
+# Directories containing one of these are not backed up, see https://bford.info/cachedir/
+CACHEDIR_TAG = "CACHEDIR.TAG"
+CACHEDIR_TAG_SIGNATURE = b"Signature: 8a477f597d28d172789f06886806bc55"
+NOBACKUP_MARKER = ".nobackup"
+
+
+class ScanEntry(NamedTuple):
+    rel_path: str
+    size: int
+    mtime_ns: int
+    device: int
+    inode: int
+
+
+class ScanDirectory(NamedTuple):
+    # Directory relative to the root, with a leading slash
+    rel_root: str
+    entries: List[ScanEntry]
+    # Already recorded by an interrupted scan that is being resumed: entries are listed but not stat'ed,
+    # so their metadata is None
+    resumed: bool
+
+
+@dataclass
+class Scanner():
+    """
+    Walks a backup root using os.scandir, one directory per task on a bounded pool of threads.
+
+    Directory paths are handled relative to the root, with a leading slash ("" is the root itself),
+    which is the form ClientConfig.is_excluded() expects. Excluded directories are never descended into,
+    nor are skip_directories (absolute paths), which hold deep-freeze's own derived state. skip_files (absolute
+    paths) are left out too.
+    """
+
+    client_config: ClientConfig
+    cross_devices: bool
+    threads: int
+    exclusion_markers: bool = True
+    skip_directories: FrozenSet[str] = frozenset()
+    skip_files: FrozenSet[str] = frozenset()
+
+    def __post_init__(self):
+        self.root = self.client_config.backup_root
+
+    def walk(self, scope: Optional[List[Tuple[str, bool]]] = None,
+             completed: FrozenSet[str] = frozenset()) -> Iterator[ScanDirectory]:
+        """
+        Walks the whole root, or only the given (directory, recursive) pairs. Directories in completed
+        are only listed, to find their subdirectories and which of their files still exist.
+        """
+        root_dev = os.lstat(self.root).st_dev
+        pending = deque([("", True)] if scope is None else scope)
+        in_flight = set()
+        # Cap the number of queued tasks so memory is held by the pending directory names rather than results
+        max_in_flight = self.threads * 2
+
+        with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="scan") as executor:
+            while pending or in_flight:
+                while pending and len(in_flight) < max_in_flight:
+                    # LIFO keeps the walk depth-first, which bounds the pending list on wide trees
+                    rel_root, recursive = pending.pop()
+                    in_flight.add(executor.submit(
+                        self._scan_directory, rel_root, recursive, rel_root in completed, root_dev))
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    directory, subdirs = future.result()
+                    pending.extend(subdirs)
+                    yield directory
+
+    def _scan_directory(self, rel_root: str, recursive: bool, resumed: bool,
+                        root_dev: int) -> Tuple[ScanDirectory, List[Tuple[str, bool]]]:
+        entries = []
+        subdirs = []
+        directory = ScanDirectory(rel_root, entries, resumed)
+        abs_root = self.root + rel_root
+
+        try:
+            with os.scandir(abs_root) as iterator:
+                dir_entries = list(iterator)
+        except OSError as e:
+            # Directory deleted in the interim or unreadable: behave as though its contents have been deleted
+            print(f"Unable to scan {abs_root}, pretend deleted: {e}")
+            return directory, subdirs
+
+        if self.exclusion_markers and self._has_exclusion_marker(dir_entries):
+            print(f"Skipping {abs_root}: contains an exclusion marker")
+            return directory, subdirs
+
+        for entry in dir_entries:
+            try:
+                # Same classification as os.walk(followlinks=False): symlinks to directories are neither
+                # descended into nor backed up
+                if entry.is_dir():
+                    if entry.is_symlink() or not recursive:
+                        continue
+                    if not self.cross_devices and entry.stat(follow_symlinks=False).st_dev != root_dev:
+                        continue
+                    if self.client_config.is_directory_excluded(rel_root, entry.name):
+                        continue
+                    if entry.path in self.skip_directories:
+                        continue
+                    subdirs.append((f"{rel_root}/{entry.name}", True))
+                elif entry.path not in self.skip_files and not self.client_config.is_excluded(rel_root, entry.name):
+                    rel_path = f"{rel_root[1:]}/{entry.name}" if rel_root else entry.name
+                    if resumed:
+                        entries.append(ScanEntry(rel_path, None, None, None, None))
+                    else:
+                        metadata = entry.stat(follow_symlinks=False)
+                        entries.append(ScanEntry(rel_path, metadata.st_size, metadata.st_mtime_ns,
+                                                 metadata.st_dev, metadata.st_ino))
+            except OSError as e:
+                # Behave as though the file has been deleted
+                print(f"Inaccessible, pretend deleted: {entry.path}: {e}")
+
+        return directory, subdirs
+
+    def _has_exclusion_marker(self, dir_entries: List[os.DirEntry]) -> bool:
+        for entry in dir_entries:
+            if entry.name == NOBACKUP_MARKER:
+                return True
+            if entry.name == CACHEDIR_TAG:
+                try:
+                    with open(entry.path, "rb") as f:
+                        if f.read(len(CACHEDIR_TAG_SIGNATURE)) == CACHEDIR_TAG_SIGNATURE:
+                            return True
+                except OSError as e:
+                    print(f"Unable to read {entry.path}: {e}")
+        return False
@@ -0,0 +1,345 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from db import ClientConfig
+
+from .codec import BUFFER_SIZE
+
+# Most keys S3 deletes per request
+DELETE_BATCH_SIZE = 1000
+DELETE_THREADS = 4
+
+
+class Storage(ABC):
+    """
+    Where archives are stored, as objects named after them in the client config's bucket.
+    """
+
+    # Whether upload_file() resumes what an interrupted upload of the object left, rather than leave it behind
+    resumes_uploads = False
+
+    @abstractmethod
+    def upload_file(self, path: str, name: str):
+        pass
+
+    @abstractmethod
+    def upload_stream(self, fileobj, name: str):
+        """
+        Uploads what is read from fileobj until end of file. If reading raises, nothing is stored.
+        """
+
+    @abstractmethod
+    def delete(self, name: str):
+        pass
+
+    @abstractmethod
+    def exists(self, name: str) -> bool:
+        pass
+
+    @abstractmethod
+    def abort_incomplete_uploads(self, name: str):
+        """
+        Discards what interrupted uploads of the object left behind.
+        """
+
+    def delete_objects(self, names: List[str]) -> Dict[str, Optional[str]]:
+        """
+        Deletes objects in batches of up to DELETE_BATCH_SIZE, DELETE_THREADS batches at a time. Returns the
+        outcome for each object: None if it was deleted, else why not.
+        """
+        batches = [names[start:start + DELETE_BATCH_SIZE] for start in range(0, len(names), DELETE_BATCH_SIZE)]
+        outcomes = {}
+        with ThreadPoolExecutor(max_workers=DELETE_THREADS) as executor:
+            for outcome in executor.map(self._delete_batch, batches):
+                outcomes.update(outcome)
+        return outcomes
+
+    def _delete_batch(self, names: List[str]) -> Dict[str, Optional[str]]:
+        try:
+            return self.delete_batch(names)
+        except Exception as e:
+            return {name: str(e) for name in names}
+
+    def delete_batch(self, names: List[str]) -> Dict[str, Optional[str]]:
+        # One object at a time unless the backend deletes several per request
+        outcome = {}
+        for name in names:
+            try:
+                self.delete(name)
+                outcome[name] = None
+            except Exception as e:
+                outcome[name] = str(e)
+        return outcome
+
+
+def _delete_objects_outcome(names: List[str], response: dict) -> Dict[str, Optional[str]]:
+    # Response of S3 DeleteObjects, which lists each key as deleted or failed
+    outcome = {name: "Not reported as deleted" for name in names}
+    for deleted in response.get("Deleted", []):
+        outcome[deleted["Key"]] = None
+    for error in response.get("Errors", []):
+        outcome[error["Key"]] = f"{error.get('Code')}: {error.get('Message')}"
+    return outcome
+
+
+def _delete_objects_request(names: List[str]) -> dict:
+    return {"Objects": [{"Key": name} for name in names], "Quiet": False}
+
+
+@dataclass
+class AwsCliStorage(Storage):
+    """
+    Runs the AWS CLI for each operation.
+    """
+
+    credentials: str
+    bucket: str
+    storage_class: str
+
+    def upload_file(self, path: str, name: str):
+        subprocess.run(["aws", "--profile", self.credentials, "s3", "cp", "--storage-class", self.storage_class,
+                        path, f"s3://{self.bucket}/{name}"]).check_returncode()
+
+    def upload_stream(self, fileobj, name: str):
+        aws = subprocess.Popen(["aws", "--profile", self.credentials, "s3", "cp",
+                                "--storage-class", self.storage_class, "-", f"s3://{self.bucket}/{name}"],
+                               stdin=subprocess.PIPE)
+        try:
+            while True:
+                data = fileobj.read(BUFFER_SIZE)
+                if not data:
+                    break
+                aws.stdin.write(data)
+            aws.stdin.close()
+        except BaseException:
+            aws.kill()
+            aws.wait()
+            raise
+        returncode = aws.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, aws.args)
+
+    def delete(self, name: str):
+        subprocess.run(["aws", "--profile", self.credentials, "s3", "rm",
+                        f"s3://{self.bucket}/{name}"]).check_returncode()
+
+    def delete_batch(self, names: List[str]) -> Dict[str, Optional[str]]:
+        # A thousand keys may not fit in a command line argument
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as request:
+            json.dump(_delete_objects_request(names), request)
+            request.flush()
+            completed = subprocess.run(["aws", "--profile", self.credentials, "--output", "json", "s3api",
+                                        "delete-objects", "--bucket", self.bucket,
+                                        "--delete", f"file://{request.name}"],
+                                       stdout=subprocess.PIPE)
+        completed.check_returncode()
+        return _delete_objects_outcome(names, json.loads(completed.stdout or "{}"))
+
+    def exists(self, name: str) -> bool:
+        return subprocess.run(["aws", "--profile", self.credentials, "s3api", "head-object", "--bucket", self.bucket,
+                               "--key", name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+    def abort_incomplete_uploads(self, name: str):
+        completed = subprocess.run(["aws", "--profile", self.credentials, "--output", "json", "s3api",
+                                    "list-multipart-uploads", "--bucket", self.bucket, "--prefix", name],
+                                   stdout=subprocess.PIPE)
+        completed.check_returncode()
+        for upload in json.loads(completed.stdout or "{}").get("Uploads") or []:
+            if upload["Key"] == name:
+                subprocess.run(["aws", "--profile", self.credentials, "s3api", "abort-multipart-upload",
+                                "--bucket", self.bucket, "--key", name,
+                                "--upload-id", upload["UploadId"]]).check_returncode()
+
+
+@dataclass
+class Boto3Storage(Storage):
+    """
+    S3 client in process, shared by all operations: connections are pooled, large objects are uploaded in parts
+    in parallel, and failed requests are retried. endpoint_url selects an S3-compatible service instead of AWS.
+
+    Uploads of files resume the multipart upload an interrupted attempt left, only uploading the parts it did
+    not complete.
+    """
+
+    resumes_uploads = True
+
+    credentials: str
+    region: str
+    bucket: str
+    storage_class: str
+    endpoint_url: Optional[str] = None
+    # Parts uploaded in parallel per object
+    concurrency: int = 8
+    part_size: int = 64 * 1024 * 1024
+    max_attempts: int = 5
+
+    def __post_init__(self):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config
+        except ImportError:
+            raise RuntimeError("The boto3 storage backend requires the boto3 package")
+        session = boto3.session.Session(profile_name=self.credentials, region_name=self.region)
+        # Enough connections for the parts of a few objects uploaded at once
+        self.client = session.client("s3", endpoint_url=self.endpoint_url,
+                                     config=Config(max_pool_connections=4 * self.concurrency,
+                                                   retries={"max_attempts": self.max_attempts,
+                                                            "mode": "adaptive"}))
+        self.transfer_config = TransferConfig(multipart_threshold=self.part_size,
+                                              multipart_chunksize=self.part_size,
+                                              max_concurrency=self.concurrency)
+        self.extra_args = {"StorageClass": self.storage_class}
+
+    def upload_file(self, path: str, name: str):
+        size = os.path.getsize(path)
+        if size <= self.part_size:
+            self.client.upload_file(path, self.bucket, name, ExtraArgs=self.extra_args, Config=self.transfer_config)
+            return
+        part_sizes = {number: min(self.part_size, size - (number - 1) * self.part_size)
+                      for number in range(1, (size + self.part_size - 1) // self.part_size + 1)}
+        upload_id = None
+        uploaded = {}
+        for candidate in self._incomplete_upload_ids(name):
+            parts = self._uploaded_parts(name, candidate) if upload_id is None else None
+            # Only parts cut the same way can be reused
+            if parts is not None and all(part_sizes.get(number) == part["Size"] for number, part in parts.items()):
+                upload_id = candidate
+                uploaded = parts
+            else:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=name, UploadId=candidate)
+        if upload_id is None:
+            upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=name,
+                                                            **self.extra_args)["UploadId"]
+        else:
+            print(f"Resuming upload of {name}: {len(uploaded)} of {len(part_sizes)} parts already uploaded")
+
+        def upload_part(number: int):
+            with open(path, "rb") as f:
+                f.seek((number - 1) * self.part_size)
+                data = f.read(part_sizes[number])
+            # An uploaded part's ETag is its MD5 (unless encrypted with KMS, then it is uploaded again)
+            if number in uploaded and uploaded[number]["ETag"].strip('"') == hashlib.md5(data).hexdigest():
+                return uploaded[number]["ETag"]
+            return self.client.upload_part(Bucket=self.bucket, Key=name, UploadId=upload_id, PartNumber=number,
+                                           Body=data)["ETag"]
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            etags = list(executor.map(upload_part, part_sizes))
+        # A failure leaves the multipart upload to be resumed by the next attempt
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=name, UploadId=upload_id, MultipartUpload={
+            "Parts": [{"PartNumber": number, "ETag": etag} for number, etag in zip(part_sizes, etags)]})
+
+    def upload_stream(self, fileobj, name: str):
+        # Read errors abort the multipart upload
+        self.client.upload_fileobj(fileobj, self.bucket, name, ExtraArgs=self.extra_args,
+                                   Config=self.transfer_config)
+
+    def delete(self, name: str):
+        self.client.delete_object(Bucket=self.bucket, Key=name)
+
+    def delete_batch(self, names: List[str]) -> Dict[str, Optional[str]]:
+        return _delete_objects_outcome(names, self.client.delete_objects(Bucket=self.bucket,
+                                                                         Delete=_delete_objects_request(names)))
+
+    def exists(self, name: str) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=name)
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def abort_incomplete_uploads(self, name: str):
+        for upload_id in self._incomplete_upload_ids(name):
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=name, UploadId=upload_id)
+
+    def _incomplete_upload_ids(self, name: str) -> List[str]:
+        upload_ids = []
+        for page in self.client.get_paginator("list_multipart_uploads").paginate(Bucket=self.bucket, Prefix=name):
+            upload_ids.extend(upload["UploadId"] for upload in page.get("Uploads", []) if upload["Key"] == name)
+        return upload_ids
+
+    def _uploaded_parts(self, name: str, upload_id: str) -> Dict[int, dict]:
+        parts = {}
+        for page in self.client.get_paginator("list_parts").paginate(Bucket=self.bucket, Key=name,
+                                                                     UploadId=upload_id):
+            parts.update((part["PartNumber"], part) for part in page.get("Parts", []))
+        return parts
+
+
+@dataclass
+class LocalStorage(Storage):
+    """
+    Stores objects as files under directory/bucket, e.g. to back up offline or for tests. Objects are written
+    to a temporary name first, so that they only appear once complete.
+    """
+
+    directory: str
+    bucket: str
+
+    def upload_file(self, path: str, name: str):
+        with open(path, "rb") as f:
+            self.upload_stream(f, name)
+
+    def upload_stream(self, fileobj, name: str):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = path + ".partial"
+        try:
+            with open(partial, "wb") as f:
+                shutil.copyfileobj(fileobj, f, BUFFER_SIZE)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        os.replace(partial, path)
+
+    def delete(self, name: str):
+        # As S3, deleting a missing object succeeds
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self._path(name))
+
+    def abort_incomplete_uploads(self, name: str):
+        try:
+            os.remove(self._path(name) + ".partial")
+        except FileNotFoundError:
+            pass
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, self.bucket, name)
+
+
+def storage_for(client_config: ClientConfig, storage_class: str) -> Storage:
+    """
+    The storage backend chosen by the client config.
+    """
+    backend = client_config.options[ClientConfig.STORAGE_BACKEND]
+    location = client_config.options.get(ClientConfig.STORAGE_LOCATION) or None
+    if backend == ClientConfig.BOTO3:
+        return Boto3Storage(client_config.credentials, client_config.region, client_config.bucket, storage_class,
+                            location)
+    if backend == ClientConfig.LOCAL:
+        if location is None:
+            raise ValueError("The local storage backend requires a storage location")
+        return LocalStorage(location, client_config.bucket)
+    if backend == ClientConfig.AWS_CLI:
+        return AwsCliStorage(client_config.credentials, client_config.bucket, storage_class)
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,97 @@
+import os
+import subprocess
+import threading
+
+from dataclasses import dataclass
+
+from .storage import Storage
+
+
+class UploadAborted(Exception):
+    pass
+
+
+class _UploadReader():
+    """
+    Reads the data to upload, fails rather than ends if the upload was aborted so that nothing is stored.
+    """
+
+    def __init__(self, fileobj, upload):
+        self.fileobj = fileobj
+        self.upload = upload
+
+    def read(self, n: int = -1) -> bytes:
+        data = self.fileobj.read(n)
+        if self.upload.aborted:
+            raise UploadAborted()
+        return data
+
+
+@dataclass
+class StreamingUpload():
+    """
+    Encrypts an archive with gpg and uploads it while it is being written, without temporary files: data
+    written to stdin only goes through pipes to the upload, which runs on a thread of its own. Without gpg,
+    what is written must already be encrypted.
+    """
+
+    key_file_path: str
+    storage: Storage
+    object_name: str
+    gpg: bool = True
+
+    def __post_init__(self):
+        self.aborted = False
+        self.error = None
+        self.process = None
+        if self.gpg:
+            self.process = subprocess.Popen(["gpg", "-c", "--batch", "--pinentry-mode=loopback",
+                                             "--passphrase-file", self.key_file_path, "-o", "-"],
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            source = self.process.stdout
+            self.stdin = self.process.stdin
+        else:
+            read_fd, write_fd = os.pipe()
+            source = os.fdopen(read_fd, "rb")
+            self.stdin = os.fdopen(write_fd, "wb")
+        self.thread = threading.Thread(target=self._upload, args=(source,), name="streaming-upload", daemon=True)
+        self.thread.start()
+
+    def _upload(self, source):
+        try:
+            self.storage.upload_stream(_UploadReader(source, self), self.object_name)
+        except BaseException as e:
+            self.error = e
+        finally:
+            # Writers fail rather than block if the upload failed
+            source.close()
+
+    def finish(self):
+        """
+        Waits for the upload to complete, raises if it failed.
+        """
+        try:
+            self.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = self.process.wait() if self.process is not None else 0
+        self.thread.join()
+        # The upload failing makes gpg fail too, report the upload first
+        if self.error is not None:
+            raise self.error
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.process.args)
+
+    def abort(self):
+        """
+        Stops the upload, e.g. when reading files to archive failed.
+        """
+        self.aborted = True
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+        try:
+            self.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.thread.join()
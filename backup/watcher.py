@@ -0,0 +1,159 @@
+import errno
+import json
+import os
+import select
+import time
+import uuid
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from db import Database, ClientConfig, ClientConfigFactory
+
+from . import inotify
+from .journal import ChangeJournal, journal_directory, DIRTY, DIRTY_RECURSIVE, OVERFLOW, WATCHER_STATE_FILE
+from .scanner import CACHEDIR_TAG, NOBACKUP_MARKER
+
+WATCH_MASK = (inotify.IN_MODIFY | inotify.IN_ATTRIB | inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_FROM |
+              inotify.IN_MOVED_TO | inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_DELETE_SELF |
+              inotify.IN_MOVE_SELF | inotify.IN_ONLYDIR | inotify.IN_DONT_FOLLOW | inotify.IN_EXCL_UNLINK)
+
+
+@dataclass
+class WatchedRoot():
+    client_config: ClientConfig
+    journal: ChangeJournal
+    root_dev: int
+    pending: List[Tuple[str, str]] = field(default_factory=list)
+
+
+@dataclass
+class Watcher():
+    """
+    Records directories changed under backup roots configured with a change journal, so that backups
+    can rescan only those directories. Linux only.
+    """
+
+    db: Database
+    flush_interval_seconds: float = 1.0
+
+    def __post_init__(self):
+        self.directory = journal_directory(self.db.db_path)
+        self.inotify = inotify.Inotify()
+        # Several roots may contain the same directory, inotify returns the same watch descriptor for each
+        self.watches: Dict[int, List[Tuple[WatchedRoot, str]]] = {}
+        self.roots: List[WatchedRoot] = []
+
+    def run(self):
+        for cc in ClientConfigFactory(self.db).get_active_client_configs():
+            if cc.options[ClientConfig.CHANGE_JOURNAL] != ClientConfig.YES:
+                continue
+            root = WatchedRoot(cc, ChangeJournal(self.directory, cc), os.lstat(cc.backup_root).st_dev)
+            self.roots.append(root)
+            print(f"Watching: {cc.backup_root}")
+            self.watch_tree(root, "")
+
+        if len(self.roots) == 0:
+            print("No configurations with a change journal, exiting")
+            return
+
+        # Backups only trust journals written by the session that was running when they last completed
+        os.makedirs(self.directory, exist_ok=True)
+        state_path = os.path.join(self.directory, WATCHER_STATE_FILE)
+        with open(state_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"pid": os.getpid(), "session": uuid.uuid4().hex}, f)
+        os.replace(state_path + ".tmp", state_path)
+
+        next_flush = time.monotonic() + self.flush_interval_seconds
+        while True:
+            timeout = max(0.0, next_flush - time.monotonic())
+            readable, _, _ = select.select([self.inotify.fd], [], [], timeout)
+            if readable:
+                for event in self.inotify.read():
+                    self.handle(event)
+            if time.monotonic() >= next_flush:
+                self.flush()
+                next_flush = time.monotonic() + self.flush_interval_seconds
+
+    def watch_tree(self, root: WatchedRoot, rel_root: str):
+        abs_root = root.client_config.backup_root + rel_root
+        if os.path.realpath(abs_root) == os.path.realpath(self.directory):
+            # Our own writes would mark the journal directory dirty on every flush
+            return
+        try:
+            wd = self.inotify.add_watch(abs_root, WATCH_MASK)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                print(f"Out of inotify watches (see fs.inotify.max_user_watches), journal incomplete: {abs_root}")
+                root.pending.append((OVERFLOW, ""))
+                return
+            raise
+        self.watches.setdefault(wd, [])
+        self.watches[wd] = [(r, p) for r, p in self.watches[wd] if r is not root] + [(root, rel_root)]
+
+        try:
+            with os.scandir(abs_root) as iterator:
+                dir_entries = list(iterator)
+        except OSError:
+            return
+        cc = root.client_config
+        names = set(entry.name for entry in dir_entries)
+        if cc.options[ClientConfig.EXCLUSION_MARKERS] == ClientConfig.YES and \
+                (NOBACKUP_MARKER in names or CACHEDIR_TAG in names):
+            # Watching the directory itself is enough to notice the marker being removed
+            return
+        for entry in dir_entries:
+            try:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                if cc.options[ClientConfig.BACKUPS_CROSS_DEVICES] != ClientConfig.YES and \
+                        entry.stat(follow_symlinks=False).st_dev != root.root_dev:
+                    continue
+            except OSError:
+                continue
+            if not cc.is_directory_excluded(rel_root, entry.name):
+                self.watch_tree(root, f"{rel_root}/{entry.name}")
+
+    def handle(self, event: inotify.InotifyEvent):
+        if event.mask & inotify.IN_Q_OVERFLOW:
+            print("inotify queue overflow, journals incomplete")
+            for root in self.roots:
+                root.pending.append((OVERFLOW, ""))
+            return
+
+        if event.mask & inotify.IN_IGNORED:
+            self.watches.pop(event.wd, None)
+            return
+
+        for root, rel_root in self.watches.get(event.wd, []):
+            if event.mask & (inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF):
+                if rel_root == "":
+                    # The backup root itself is gone
+                    root.pending.append((OVERFLOW, ""))
+                continue
+
+            if event.name == "":
+                # The watched directory's own attributes changed, e.g. by chmod or touch: its entries did not
+                root.pending.append((DIRTY, rel_root))
+                continue
+
+            path = f"{rel_root}/{event.name}"
+            if event.mask & inotify.IN_ISDIR:
+                if root.client_config.is_directory_excluded(rel_root, event.name):
+                    continue
+                # Rows below a directory that was created, deleted or moved all need revisiting
+                root.pending.append((DIRTY_RECURSIVE, path))
+                if event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                    self.watch_tree(root, path)
+            elif event.name in (NOBACKUP_MARKER, CACHEDIR_TAG):
+                root.pending.append((DIRTY_RECURSIVE, rel_root))
+            else:
+                root.pending.append((DIRTY, rel_root))
+
+    def flush(self):
+        for root in self.roots:
+            if len(root.pending) > 0:
+                root.journal.record_all(root.pending)
+                root.pending.clear()
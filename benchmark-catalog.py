@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from db import ClientConfig, Database, FileWriter
+
+# SQLite's own defaults, which the catalog used before its pragmas were tuned
+SQLITE_DEFAULTS = {
+    "journal_mode": "delete",
+    "synchronous": "full",
+    "cache_size": "-2000",
+    "mmap_size": "0",
+    "temp_store": "default",
+}
+
+CLIENT = "benchmark"
+ROOT = "/benchmark"
+
+
+def open_catalog(pragmas, db_path: str) -> Database:
+    # Without the schema upgrades' output
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Database(pragmas=pragmas, db_path=db_path)
+
+
+def configurations(custom):
+    """
+    SQLite's defaults, the tuned pragmas, and for each pragma the tuned ones but that one, to tell its effect.
+    """
+    configs = {"sqlite defaults": SQLITE_DEFAULTS, "tuned": {}}
+    for name in Database.DEFAULT_PRAGMAS:
+        configs[f"tuned but {name}={SQLITE_DEFAULTS[name]}"] = {name: SQLITE_DEFAULTS[name]}
+    if custom:
+        configs["tuned with " + ", ".join(f"{name}={value}" for name, value in custom.items())] = custom
+    return configs
+
+
+def relative_path(i: int) -> str:
+    # 10 files per directory, under 3 levels of directories
+    return f"d{i // 10000 % 100}/e{i // 1000 % 10}/f{i // 10 % 100}/file{i}.dat"
+
+
+def scan(db: Database, cc: ClientConfig, files: int, modification: int):
+    """
+    The catalog work of a scan finding the given files, committed every 50000 as by checkpoints.
+    """
+    generation = db.start_scan(CLIENT, ROOT)
+    writer = FileWriter(db, cc, generation)
+    db.connection.execute("BEGIN IMMEDIATE")
+    for i in range(files):
+        writer.upsert(relative_path(i), 1000 + i % 1000, modification + i, 1, i + 1)
+        if (i + 1) % 50000 == 0:
+            writer.flush()
+            db.connection.commit()
+            db.connection.execute("BEGIN IMMEDIATE")
+    writer.flush()
+    db.connection.commit()
+    db.mark_vanished_files(CLIENT, ROOT, generation)
+    db.link_renamed_files(CLIENT, ROOT, generation)
+    db.update_deleted_files_new_status(CLIENT, ROOT, generation)
+    db.mark_files_for_backup(CLIENT, ROOT, generation)
+    db.end_scan(CLIENT, ROOT)
+
+
+def archive(db: Database, files_per_archive: int = 1000):
+    """
+    The catalog work of archiving the files to back up, one transaction per archive built and per upload.
+    """
+    archives = 0
+    for page in db.get_files_to_backup(CLIENT, ROOT):
+        for start in range(0, len(page), files_per_archive):
+            files = page[start:start + files_per_archive]
+            archive_id = db.new_archive("aws", "region", "bucket", f"archive_{time.time_ns()}_{archives}", "gzip",
+                                        "gpg", CLIENT, ROOT)
+            db.add_files_to_archive(archive_id, [(file.file_id, file.new_size, file.new_modification, None, None,
+                                                  None) for file in files])
+            db.archive_uploaded(archive_id, sum(file.new_size for file in files))
+            archives += 1
+    return archives
+
+
+def lookups_while_writing(db_path: str, pragmas, db: Database, files: int, modification: int, seconds: float):
+    """
+    Restore lookups (a file and its archives) while another connection rescans changed files: returns the
+    number of lookups and their mean and maximum latency in milliseconds.
+    """
+    writing = threading.Event()
+    done = threading.Event()
+
+    def write():
+        writer_db = open_catalog(pragmas, db_path)
+        writing.set()
+        scans = 0
+        while not done.is_set():
+            scans += 1
+            scan(writer_db, client_config(writer_db), files, modification + scans)
+        writer_db.close()
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    writing.wait()
+    latencies = []
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        file_id = random.randint(1, files)
+        start = time.perf_counter()
+        db.get_file(file_id)
+        db.find_file_archives(file_id)
+        latencies.append(time.perf_counter() - start)
+    done.set()
+    thread.join()
+    return len(latencies), sum(latencies) * 1000 / len(latencies), max(latencies) * 1000
+
+
+def client_config(db: Database) -> ClientConfig:
+    return ClientConfig("aws", "region", "profile", "bucket", CLIENT, ROOT, "/dev/null",
+                        dict(ClientConfig.DEFAULT_OPTIONS), [], db)
+
+
+def run(name: str, pragmas, directory: str, files: int, seconds: float):
+    work_directory = tempfile.mkdtemp(prefix="deep-freeze-benchmark-", dir=directory)
+    db_path = os.path.join(work_directory, "catalog.db")
+    try:
+        db = open_catalog(pragmas, db_path)
+        cc = client_config(db)
+        cc.add_to_database()
+        timings = []
+        modification = 1700000000 * 1000000000
+        for phase in (lambda: scan(db, cc, files, modification),
+                      lambda: archive(db),
+                      lambda: scan(db, cc, files, modification),
+                      lambda: scan(db, cc, files, modification + 1),
+                      lambda: archive(db)):
+            start = time.perf_counter()
+            phase()
+            timings.append(time.perf_counter() - start)
+        lookups, mean_ms, max_ms = lookups_while_writing(db_path, pragmas, db, files, modification + 2, seconds)
+        db.close()
+        size = sum(os.path.getsize(os.path.join(work_directory, f)) for f in os.listdir(work_directory))
+        print(f"{name:<40} " + " ".join(f"{t:>8.2f}" for t in timings) +
+              f" {lookups:>8} {mean_ms:>8.2f} {max_ms:>8.1f} {size / 1024 / 1024:>8.1f}")
+    finally:
+        shutil.rmtree(work_directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measures the catalog's SQLite pragmas on a synthetic catalog")
+
+    parser.add_argument("--files",
+                        help="Number of files in the synthetic backup root",
+                        type=int,
+                        default=100000)
+    parser.add_argument("--lookup-seconds",
+                        help="Duration of restore lookups while a scan writes",
+                        type=float,
+                        default=5.0)
+    parser.add_argument("--directory",
+                        help="Directory for the benchmark's catalogs, on the catalog's disk for realistic syncs",
+                        type=str,
+                        default=None)
+    parser.add_argument("--catalog-pragma",
+                        help="Pragma to benchmark in addition, as name=value (can be repeated)",
+                        action="append",
+                        default=[])
+    args = parser.parse_args()
+
+    custom = {}
+    for pragma in args.catalog_pragma:
+        name, _, value = pragma.partition("=")
+        if not value:
+            parser.error(f"Invalid catalog pragma, expected name=value: {pragma}")
+        custom[name] = value
+
+    print(f"{args.files} files; seconds to scan, archive, rescan unchanged, rescan changed and archive again; "
+          f"restore lookups while scanning, their mean and max milliseconds; catalog MB")
+    print(f"{'':<40} {'scan':>8} {'archive':>8} {'rescan':>8} {'changed':>8} {'archive':>8} "
+          f"{'lookups':>8} {'mean ms':>8} {'max ms':>8} {'MB':>8}")
+    for name, pragmas in configurations(custom).items():
+        run(name, pragmas, args.directory, args.files, args.lookup_seconds)
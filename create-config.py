@@ -40,6 +40,62 @@ if __name__ == '__main__':
                         help="Whether backups of this directory will cross mount points",
                         action=argparse.BooleanOptionalAction,
                         default=True)
+    parser.add_argument("--exclusion-markers",
+                        help="Whether directories containing a CACHEDIR.TAG or .nobackup file are skipped",
+                        action=argparse.BooleanOptionalAction,
+                        default=True)
+    parser.add_argument("--change-journal",
+                        help="Whether backups only rescan directories reported changed by deep-freeze-watch.py",
+                        action=argparse.BooleanOptionalAction,
+                        default=False)
+    parser.add_argument("--scan-diff",
+                        help="Compare scans with the previous state in the catalog, or in memory (about 33MB per million files)",
+                        choices=[ClientConfig.CATALOG, ClientConfig.MEMORY],
+                        default=ClientConfig.CATALOG)
+    parser.add_argument("--snapshot-max-files",
+                        help="Largest backup root compared in memory, bigger ones are compared in the catalog (default: 20000000)",
+                        type=int,
+                        default=None)
+    parser.add_argument("--scan-checkpoint-seconds",
+                        help="Interval at which scans commit their progress, so an interrupted scan can be resumed (default: 60)",
+                        type=int,
+                        default=None)
+    parser.add_argument("--content-dedup",
+                        help="Whether files whose content is already in an archive of the bucket are recorded instead of archived again",
+                        action=argparse.BooleanOptionalAction,
+                        default=False)
+    parser.add_argument("--streaming-upload",
+                        help="Whether archives are compressed, encrypted and uploaded as they are built, without temporary files",
+                        action=argparse.BooleanOptionalAction,
+                        default=False)
+    parser.add_argument("--archive-codec",
+                        help="Compression of archives: gzip, zstd on all cores (requires the zstd command on backup and restore), or none",
+                        choices=[ClientConfig.GZIP, ClientConfig.ZSTD, ClientConfig.UNCOMPRESSED],
+                        default=ClientConfig.GZIP)
+    parser.add_argument("--compression-level",
+                        help="Compression level of archives (default: 9 for gzip, 3 for zstd)",
+                        type=int,
+                        default=None)
+    parser.add_argument("--adaptive-compression",
+                        help="Whether already compressed or encrypted files are archived without compression, in separate archives",
+                        action=argparse.BooleanOptionalAction,
+                        default=False)
+    parser.add_argument("--archive-target-size",
+                        help="Size in bytes archives are filled up to, larger files get their own archive (default: 500000000)",
+                        type=int,
+                        default=None)
+    parser.add_argument("--encryption",
+                        help="Encryption of archives: gpg, or aead for AES-256-GCM in process as archives are built (requires the cryptography package on backup and restore)",
+                        choices=[ClientConfig.GPG, ClientConfig.AEAD],
+                        default=ClientConfig.GPG)
+    parser.add_argument("--storage-backend",
+                        help="How archives are stored: aws-cli (runs the AWS CLI for each upload and deletion), boto3 (in process, requires the boto3 package) or local (files under --storage-location)",
+                        choices=[ClientConfig.AWS_CLI, ClientConfig.BOTO3, ClientConfig.LOCAL],
+                        default=ClientConfig.AWS_CLI)
+    parser.add_argument("--storage-location",
+                        help="Directory of the local storage backend, or endpoint URL of an S3-compatible service for the boto3 storage backend",
+                        type=str,
+                        default=None)
     parser.add_argument("--manual-only",
                         help="Whether backups of this directory should only be done manually",
                         action=argparse.BooleanOptionalAction,
@@ -48,13 +104,47 @@ if __name__ == '__main__':
                         help="Directory to use for building archives",
                         type=str,
                         default=None)
+    parser.add_argument("--scan-threads",
+                        help="Number of threads scanning directories in parallel (default: CPU count + 4, at most 32)",
+                        type=int,
+                        default=None)
+    parser.add_argument("--catalog-batch-size",
+                        help="Number of scanned files written to the catalog per statement batch (default: 1000)",
+                        type=int,
+                        default=None)
+    parser.add_argument("--archive-builders",
+                        help="Number of archives built (read, compressed and encrypted) in parallel (default: 1)",
+                        type=int,
+                        default=None)
+    parser.add_argument("--archive-uploaders",
+                        help="Number of archives uploaded in parallel while others are being built (default: 1)",
+                        type=int,
+                        default=None)
 
     args = parser.parse_args()
 
     options = {}
     options[ClientConfig.BACKUPS_CROSS_DEVICES] = ClientConfig.YES if args.cross_devices else ClientConfig.NO
     options[ClientConfig.MANUAL_ONLY] = ClientConfig.YES if args.manual_only else ClientConfig.NO
+    options[ClientConfig.EXCLUSION_MARKERS] = ClientConfig.YES if args.exclusion_markers else ClientConfig.NO
+    options[ClientConfig.CHANGE_JOURNAL] = ClientConfig.YES if args.change_journal else ClientConfig.NO
+    options[ClientConfig.SCAN_DIFF] = args.scan_diff
+    options[ClientConfig.CONTENT_DEDUP] = ClientConfig.YES if args.content_dedup else ClientConfig.NO
+    options[ClientConfig.STREAMING_UPLOAD] = ClientConfig.YES if args.streaming_upload else ClientConfig.NO
+    options[ClientConfig.ARCHIVE_CODEC] = args.archive_codec
+    options[ClientConfig.ENCRYPTION] = args.encryption
+    options[ClientConfig.STORAGE_BACKEND] = args.storage_backend
+    if args.storage_location: options[ClientConfig.STORAGE_LOCATION] = args.storage_location
+    options[ClientConfig.ADAPTIVE_COMPRESSION] = ClientConfig.YES if args.adaptive_compression else ClientConfig.NO
     if args.temp_directory: options[ClientConfig.TMP_DIR] = args.temp_directory 
+    if args.scan_threads: options[ClientConfig.SCAN_THREADS] = str(args.scan_threads)
+    if args.catalog_batch_size: options[ClientConfig.CATALOG_BATCH_SIZE] = str(args.catalog_batch_size)
+    if args.snapshot_max_files: options[ClientConfig.SNAPSHOT_MAX_FILES] = str(args.snapshot_max_files)
+    if args.archive_builders: options[ClientConfig.ARCHIVE_BUILDERS] = str(args.archive_builders)
+    if args.archive_uploaders: options[ClientConfig.ARCHIVE_UPLOADERS] = str(args.archive_uploaders)
+    if args.scan_checkpoint_seconds: options[ClientConfig.SCAN_CHECKPOINT_SECONDS] = str(args.scan_checkpoint_seconds)
+    if args.archive_target_size: options[ClientConfig.ARCHIVE_TARGET_SIZE] = str(args.archive_target_size)
+    if args.compression_level is not None: options[ClientConfig.COMPRESSION_LEVEL] = str(args.compression_level)
 
     db = Database()
     config = ClientConfig(args.cloud_provider, args.region, args.aws_profile, args.bucket, args.client_name,
@@ -1,3 +1,4 @@
 from .db import Database
 from .client_config import ClientConfig, ClientConfigFactory
-from .file import File
+from .file import FileWriter
+from .snapshot import Snapshot, SnapshotStore
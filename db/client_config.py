@@ -1,3 +1,4 @@
+import hashlib
 import os
 import re
 
@@ -6,6 +7,7 @@ from typing import Dict
 from typing import List
 
 from .db import Database
+from .exclusions import ExclusionMatcher
 
 
 @dataclass
@@ -24,9 +26,61 @@ class ClientConfig():
     BACKUPS_CROSS_DEVICES = "backups_cross_devices"
     MANUAL_ONLY = "manual_only"
     TMP_DIR = "temporary_directory"
+    SCAN_THREADS = "scan_threads"
+    CATALOG_BATCH_SIZE = "catalog_batch_size"
+    EXCLUSION_MARKERS = "exclusion_markers"
+    CHANGE_JOURNAL = "change_journal"
+    SCAN_DIFF = "scan_diff"
+    SNAPSHOT_MAX_FILES = "snapshot_max_files"
+    SCAN_CHECKPOINT_SECONDS = "scan_checkpoint_seconds"
+    CONTENT_DEDUP = "content_dedup"
+    STREAMING_UPLOAD = "streaming_upload"
+    ARCHIVE_BUILDERS = "archive_builders"
+    ARCHIVE_UPLOADERS = "archive_uploaders"
+    ARCHIVE_CODEC = "archive_codec"
+    COMPRESSION_LEVEL = "compression_level"
+    ADAPTIVE_COMPRESSION = "adaptive_compression"
+    ARCHIVE_TARGET_SIZE = "archive_target_size"
+    ENCRYPTION = "encryption"
+    STORAGE_BACKEND = "storage_backend"
+    STORAGE_LOCATION = "storage_location"
+    CATALOG = "catalog"
+    MEMORY = "memory"
+    GZIP = "gzip"
+    ZSTD = "zstd"
+    UNCOMPRESSED = "none"
+    GPG = "gpg"
+    AEAD = "aead"
+    AWS_CLI = "aws-cli"
+    BOTO3 = "boto3"
+    LOCAL = "local"
     YES = "Y"
     NO = "N"
 
+    # Applied to options missing from the database, e.g. for configurations created by older versions
+    DEFAULT_OPTIONS = {
+        MANUAL_ONLY: NO,
+        SCAN_THREADS: str(min(32, (os.cpu_count() or 1) + 4)),
+        CATALOG_BATCH_SIZE: "1000",
+        EXCLUSION_MARKERS: YES,
+        CHANGE_JOURNAL: NO,
+        SCAN_DIFF: CATALOG,
+        SNAPSHOT_MAX_FILES: "20000000",
+        SCAN_CHECKPOINT_SECONDS: "60",
+        CONTENT_DEDUP: NO,
+        STREAMING_UPLOAD: NO,
+        ARCHIVE_BUILDERS: "1",
+        ARCHIVE_UPLOADERS: "1",
+        ARCHIVE_CODEC: GZIP,
+        ADAPTIVE_COMPRESSION: NO,
+        ARCHIVE_TARGET_SIZE: "500000000",
+        ENCRYPTION: GPG,
+        STORAGE_BACKEND: AWS_CLI,
+    }
+
+    def __post_init__(self):
+        self.exclusion_matcher = ExclusionMatcher(self.exclusions or [])
+
     def add_to_database(self):
         self.add_backup_client_config()
 
@@ -49,19 +103,25 @@ class ClientConfig():
                 cursor.execute(
                     query, (self.client_fqdn, self.backup_root, key, value))
 
+    def state_file_name(self) -> str:
+        """
+        Name identifying this configuration in the per-root state files kept next to the catalog.
+        """
+        root_hash = hashlib.sha1(f"{self.client_fqdn}\0{self.backup_root}".encode(
+            "utf-8", "surrogateescape")).hexdigest()[:12]
+        safe_root = self.backup_root.strip("/").replace("/", "-")
+        return f"{self.client_fqdn}_{safe_root}_{root_hash}"
+
     def is_excluded(self, root: str, path: str) -> bool:
-        if self.exclusions is None or len(self.exclusions) == 0:
-            return False
+        return self.exclusion_matcher.matches(self._exclusion_path(root, path))
+
+    def is_directory_excluded(self, root: str, path: str) -> bool:
+        return self.exclusion_matcher.matches_subtree(self._exclusion_path(root, path))
 
+    def _exclusion_path(self, root: str, path: str) -> str:
         if root == "":
             root = "/"
-        fullpath = os.path.join(root, path)
-
-        for exclusion in self.exclusions:
-            if exclusion.fullmatch(fullpath):
-                return True
-
-        return False
+        return os.path.join(root, path)
 
 
 @dataclass
@@ -109,8 +169,8 @@ class ClientConfigFactory():
                 for row3 in cursor3:
                     exclusions.append(re.compile(row3["pattern"]))
 
-                if ClientConfig.MANUAL_ONLY not in options:
-                    options[ClientConfig.MANUAL_ONLY] = ClientConfig.NO
+                for key, value in ClientConfig.DEFAULT_OPTIONS.items():
+                    options.setdefault(key, value)
 
                 cc = ClientConfig(row["cloud"], row["region"], row["credentials"], row["bucket"],
                                   row["client_fqdn"], row["backup_root"], row["key_file_path"],
@@ -1,90 +1,402 @@
+import queue
+import re
 import sqlite3
 import os
+import threading
 import time
+import urllib.parse
+from contextlib import contextmanager
 from datetime import datetime, timezone
 
 from dataclasses import dataclass
+from typing import Dict, Iterator, List, NamedTuple, Optional
 
 from .ddl import MaintainSchema
 
+NANOSECONDS = 1000000000
+
+
+def modification_changed(old: str, new: str) -> str:
+    """
+    SQL condition comparing two modification times in integer nanoseconds. Times converted from text by
+    the v8 schema upgrade only have whole second precision: they match any time within the same second.
+    """
+    return f"({old} != {new} and ({old} % {NANOSECONDS} != 0 or {old} != {new} - {new} % {NANOSECONDS}))"
+
+
+class FileToBackup(NamedTuple):
+    file_id: int
+    relative_path: str
+    new_size: int
+    new_modification: int
+    # Of the version last archived, None for new files
+    modification: Optional[int]
+    last_archive_id: Optional[int]
+
 
 @dataclass
 class Database():
+    # Seconds to wait for another connection's write transaction, e.g. of a backup running concurrently
+    timeout: float = 300.0
+    # Overrides of DEFAULT_PRAGMAS
+    pragmas: Optional[Dict[str, str]] = None
+    # Read-only connections lent by reader(), which waits for one to be returned when all are in use
+    max_readers: int = 4
+    # The catalog in the user's home directory unless set, e.g. by benchmarks
+    db_path: Optional[str] = None
+
+    # With write-ahead logging, reading never waits for a write transaction nor holds one up, and commits
+    # are only synced to disk at checkpoints: a power loss may lose the last ones, but not corrupt the catalog.
+    # The page cache (negative: in KiB) and memory-mapped I/O are per connection. Temporary tables, such as
+    # those of the paths seen by scans of millions of files, are kept in files rather than memory.
+    DEFAULT_PRAGMAS = {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": "-65536",
+        "mmap_size": str(256 * 1024 * 1024),
+        "temp_store": "file",
+    }
 
     def __post_init__(self):
-        # TODO check sanity
-        home = os.getenv('HOME')
-        rcdir = '.deep-freeze-backups'
-        # TODO create directory if it does not exist
-        self.db_path = os.path.join(home, rcdir, "deep-freeze-backups.db")
-        # self.db_path = "deep-freeze-dev.db"
+        if self.db_path is None:
+            # TODO check sanity
+            home = os.getenv('HOME')
+            rcdir = '.deep-freeze-backups'
+            # TODO create directory if it does not exist
+            self.db_path = os.path.join(home, rcdir, "deep-freeze-backups.db")
+            # self.db_path = "deep-freeze-dev.db"
+        self.pragmas = {**self.DEFAULT_PRAGMAS, **(self.pragmas or {})}
+        for name, value in self.pragmas.items():
+            if name not in self.DEFAULT_PRAGMAS:
+                raise ValueError(f"Unsupported catalog pragma: {name}")
+            if not re.fullmatch(r"[\w-]+", value):
+                raise ValueError(f"Invalid value for catalog pragma {name}: {value}")
 
-        self.connection = sqlite3.connect(self.db_path)
-        self.connection.row_factory = sqlite3.Row
+        # Transactions take the write lock when they start: one that first reads then writes could otherwise
+        # fail at once with "database is locked", rather than wait, when another connection is committing
+        self.connection = self._connect(isolation_level="IMMEDIATE")
+        journal_mode = self.connection.execute(f"pragma journal_mode = {self.pragmas['journal_mode']}").fetchone()[0]
+        if journal_mode != self.pragmas["journal_mode"].lower():
+            print(f"Catalog journal mode {self.pragmas['journal_mode']} unavailable, using {journal_mode}")
+        self.readers = queue.LifoQueue()
+        self.reader_slots = threading.BoundedSemaphore(max(1, self.max_readers))
 
         MaintainSchema(self.connection)
 
-    def set_sweep_mark(self, client_fqdn, backup_root):
+    def _connect(self, read_only: bool = False, **kwargs) -> sqlite3.Connection:
+        if read_only:
+            connection = sqlite3.connect(f"file:{urllib.parse.quote(self.db_path)}?mode=ro", uri=True,
+                                         timeout=self.timeout, check_same_thread=False, **kwargs)
+        else:
+            connection = sqlite3.connect(self.db_path, timeout=self.timeout, **kwargs)
+        connection.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            # The journal mode is a property of the catalog file, set by the writer
+            if name != "journal_mode":
+                connection.execute(f"pragma {name} = {value}")
+        return connection
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """
+        Lends a read-only connection, on any thread, for queries that need not see the uncommitted changes of
+        this one's transaction: reports, restore lookups and lookups by concurrent threads.
+        """
+        with self.reader_slots:
+            try:
+                connection = self.readers.get_nowait()
+            except queue.Empty:
+                connection = self._connect(read_only=True)
+            try:
+                yield connection
+            finally:
+                self.readers.put(connection)
+
+    @contextmanager
+    def frozen(self):
+        """
+        Keeps the catalog file unchanged, e.g. while it is being backed up: changes committed in the meantime are
+        kept in the write-ahead log, and only written to the file afterwards. Other writers must be closed.
+        """
+        self.checkpoint()
+        self.connection.execute("pragma wal_autocheckpoint = 0")
+        try:
+            yield
+        finally:
+            self.connection.execute("pragma wal_autocheckpoint = 1000")
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Writes the whole write-ahead log to the catalog file and empties it, retrying while readers still use
+        parts of it, for up to timeout seconds.
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            # busy is 1 if the checkpoint could not complete; without write-ahead logging, log and checkpointed are -1
+            busy, log, checkpointed = self.connection.execute("pragma wal_checkpoint(truncate)").fetchone()
+            if busy == 0 and log == checkpointed:
+                return
+            if time.monotonic() >= deadline:
+                raise RuntimeError(f"Could not checkpoint the catalog: {checkpointed} of {log} log pages written")
+            time.sleep(0.1)
+
+    def close(self):
+        while not self.readers.empty():
+            self.readers.get_nowait().close()
+        self.connection.close()
+
+    def get_scan_generation(self, client_fqdn, backup_root) -> int:
         with self.connection:
             cursor = self.connection.cursor()
             query = '''
-                  update files
-                  set sweep_mark = 'absent'
+                  select scan_generation
+                  from backup_client_configs
                   where client_fqdn = ?
                   and backup_root = ?
                   '''
             cursor.execute(query, (client_fqdn, backup_root))
+            return int(cursor.fetchone()["scan_generation"])
 
-    def update_deleted_files_new_status(self, client_fqdn, backup_root):
+    def start_scan(self, client_fqdn, backup_root, resume: bool = False) -> int:
+        """
+        Returns the generation number of a new scan of the backup root, or of the interrupted scan being
+        resumed, and prepares the (temporary) table in which the scan records the files it finds.
+        """
+        if not resume:
+            with self.connection:
+                cursor = self.connection.cursor()
+                query = '''
+                      update backup_client_configs
+                      set scan_generation = scan_generation + 1
+                      where client_fqdn = ?
+                      and backup_root = ?
+                      '''
+                cursor.execute(query, (client_fqdn, backup_root))
+        generation = self.get_scan_generation(client_fqdn, backup_root)
+
+        self.connection.execute('''create temp table if not exists scan_seen (
+                                 directory_id integer not null,
+                                 name text not null,
+                                 primary key (directory_id, name)
+                                 )
+                              ''')
+        with self.connection:
+            self.connection.execute("delete from temp.scan_seen")
+
+        return generation
+
+    def get_scan_checkpoint(self, client_fqdn, backup_root):
+        """
+        Returns the directories already recorded by an interrupted scan of the current generation, or None
+        if there is no scan to resume.
+        """
+        generation = self.get_scan_generation(client_fqdn, backup_root)
         with self.connection:
             cursor = self.connection.cursor()
             query = '''
-                  update files
-                  set new_status = 'absent'
+                  select scan_generation, relative_directory
+                  from scan_checkpoints
                   where client_fqdn = ?
                   and backup_root = ?
-                  and sweep_mark = 'absent'
                   '''
             cursor.execute(query, (client_fqdn, backup_root))
+            directories = set()
+            stale = False
+            for row in cursor:
+                if row["scan_generation"] == generation:
+                    directories.add(row["relative_directory"])
+                else:
+                    stale = True
+
+        if stale or len(directories) == 0:
+            self.end_scan(client_fqdn, backup_root)
+            return None
+        return directories
+
+    def add_scan_checkpoints(self, client_fqdn, backup_root, scan_generation: int, directories):
+        """
+        Records directories whose files have all been written. Part of the caller's transaction, so
+        directories are only checkpointed along with their files.
+        """
+        cursor = self.connection.cursor()
+        query = '''
+              insert or ignore into scan_checkpoints(client_fqdn, backup_root, scan_generation,
+                                                     relative_directory)
+              values(?, ?, ?, ?)
+              '''
+        cursor.executemany(query, ((client_fqdn, backup_root, scan_generation, directory)
+                                   for directory in directories))
+
+    def get_directory_ids(self, client_fqdn, backup_root, directories) -> Dict[str, int]:
+        """
+        Returns the IDs of the given directories of the backup root, relative to it ("" being the root), and
+        records those new to the catalog. Part of the caller's transaction.
+        """
+        cursor = self.connection.cursor()
+        directory_ids = {}
+        for directory in directories:
+            query = '''
+                  select directory_id
+                  from directories
+                  where client_fqdn = ?
+                  and backup_root = ?
+                  and relative_path = ?
+                  '''
+            cursor.execute(query, (client_fqdn, backup_root, directory))
+            row = cursor.fetchone()
+            if row is not None:
+                directory_ids[directory] = row["directory_id"]
+                continue
+            query = '''
+                  insert into directories(client_fqdn, backup_root, relative_path)
+                  values(?, ?, ?)
+                  '''
+            cursor.execute(query, (client_fqdn, backup_root, directory))
+            directory_ids[directory] = cursor.lastrowid
+        return directory_ids
 
-        # Get the ids of archives that contained the previous "last backup" of files
-        # that have been deleted, and the space occupied by those files
-        entries = []
+    def end_scan(self, client_fqdn, backup_root):
         with self.connection:
             cursor = self.connection.cursor()
             query = '''
-                  select sum(f.size) size, f.last_archive_id archive_id
-                  from files f
-                  where new_status = 'absent'
-                  group by f.last_archive_id
+                  delete from scan_checkpoints
+                  where client_fqdn = ?
+                  and backup_root = ?
                   '''
-            cursor.execute(query)
+            cursor.execute(query, (client_fqdn, backup_root))
 
-            for row in cursor:
-                entry = {}
-                for col in row.keys():
-                    entry[col] = row[col]
-                entries.append(entry)
+    def mark_vanished_files(self, client_fqdn, backup_root, scan_generation: int, scope=None):
+        """
+        Flags present files the scan did not find as absent. scope restricts this to the files in the given
+        (directory, recursive) pairs, with directories relative to the backup root ("" being the root).
+        """
+        if scope is None:
+            scope = [("", True)]
+
+        with self.connection:
+            cursor = self.connection.cursor()
+            for directory, recursive in scope:
+                condition, params = self._directory_condition(directory, recursive)
+                query = f'''
+                      update files
+                      set new_status = 'absent',
+                          scan_generation = ?
+                      where directory_id in (select directory_id
+                                             from directories
+                                             where client_fqdn = ?
+                                             and backup_root = ?
+                                             and {condition})
+                      and status = 'present'
+                      and not exists (select 1
+                                      from temp.scan_seen as s
+                                      where s.directory_id = files.directory_id
+                                      and s.name = files.name)
+                      '''
+                cursor.execute(query, (scan_generation, client_fqdn, backup_root) + params)
 
-        self.update_superseded_archives(entries, None)
+        with self.connection:
+            self.connection.execute("delete from temp.scan_seen")
 
-        # Flag previous file backup records as deleted
+    def mark_files_vanished(self, scan_generation: int, file_ids):
+        """
+        Flags the given files as absent, for scans that compared the tree against a Snapshot.
+        """
         with self.connection:
             cursor = self.connection.cursor()
             query = '''
-                  update file_archive_records
-                  set status = 'deleted'
-                  where file_id in (select file_id
-                                    from files
-                                    where new_status = 'absent'
-                                    and client_fqdn = ?
-                                    and backup_root = ?)
+                  update files
+                  set new_status = 'absent',
+                      scan_generation = ?
+                  where file_id = ?
+                  and status = 'present'
                   '''
-            cursor.execute(query, (client_fqdn, backup_root))
+            cursor.executemany(query, ((scan_generation, file_id) for file_id in file_ids))
+
+    def _directory_condition(self, directory: str, recursive: bool):
+        # On the relative path of directories
+        if not recursive:
+            return "relative_path = ?", (directory,)
+        if directory == "":
+            return "1 = 1", ()
+        # Range on the directories_1 index: '0' is the character after '/'
+        return "(relative_path = ? or (relative_path >= ? and relative_path < ?))", (directory, directory + "/",
+                                                                                     directory + "0")
 
-        # Update file sizes etc with the latest values
+    def link_renamed_files(self, client_fqdn, backup_root, scan_generation: int) -> int:
+        """
+        Files new to the catalog that have the device, inode, size and modification time of a file that vanished
+        in the same scan have been renamed or moved: they are recorded as backed up by the vanished file's
+        last archive rather than archived again. Must run before update_deleted_files_new_status().
+        """
+        renamed = []
         with self.connection:
             cursor = self.connection.cursor()
+            query = f'''
+                  select n.file_id, n.new_size, n.new_modification, far.archive_id,
+                         ifnull(far.source_file_id, o.file_id) source_file_id, far.content_hash
+                  from files as n
+                  inner join files as o on (o.device = n.device and o.inode = n.inode)
+                  inner join file_archive_records as far on (far.file_id = o.file_id
+                                                             and far.archive_id = o.last_archive_id)
+                  inner join s3_archives as s3 on (s3.archive_id = far.archive_id)
+                  where n.scan_generation = ?3
+                  and n.directory_id in (select directory_id
+                                         from directories
+                                         where client_fqdn = ?1
+                                         and backup_root = ?2)
+                  and n.new_status = 'present'
+                  and n.last_archive_id is null
+                  and o.scan_generation = n.scan_generation
+                  and o.directory_id in (select directory_id
+                                         from directories
+                                         where client_fqdn = ?1
+                                         and backup_root = ?2)
+                  and o.new_status = 'absent'
+                  and o.size = n.new_size
+                  and not {modification_changed("o.modification", "n.new_modification")}
+                  and far.status = 'uploaded'
+                  and far.part is null
+                  and s3.status = 'uploaded'
+                  group by n.file_id
+                  '''
+            cursor.execute(query, (client_fqdn, backup_root, scan_generation))
+            for row in cursor:
+                renamed.append(row)
+
+        with self.connection:
+            cursor = self.connection.cursor()
+            for row in renamed:
+                self._add_file_reference(cursor, row["archive_id"], row["source_file_id"], row["file_id"],
+                                         row["new_size"], row["new_modification"], row["content_hash"])
+        return len(renamed)
+
+    def update_deleted_files_new_status(self, client_fqdn, backup_root, scan_generation: int):
+        # Files flagged absent by mark_vanished_files() no longer count towards the relevant size of
+        # the archives holding their last backup
+        with self.connection:
+            cursor = self.connection.cursor()
+            absent_files = '''
+                  select file_id
+                  from files
+                  where scan_generation = ?3
+                  and directory_id in (select directory_id
+                                       from directories
+                                       where client_fqdn = ?1
+                                       and backup_root = ?2)
+                  and new_status = 'absent'
+                  '''
+            self._subtract_relevance(cursor, absent_files, (client_fqdn, backup_root, scan_generation))
+
+            # Flag previous file backup records as deleted
+            query = f'''
+                  update file_archive_records
+                  set status = 'deleted'
+                  where file_id in ({absent_files})
+                  '''
+            cursor.execute(query, (client_fqdn, backup_root, scan_generation))
+
+            # Update file sizes etc with the latest values
             query = '''
                   update files
                   set status = new_status,
@@ -92,78 +404,93 @@ class Database():
                      new_modification = null,
                      new_status = null,
                      force_backup = 'N'
-                  where new_status = 'absent'
+                  where scan_generation = ?3
+                  and directory_id in (select directory_id
+                                       from directories
+                                       where client_fqdn = ?1
+                                       and backup_root = ?2)
+                  and new_status = 'absent'
                   '''
-            cursor.execute(query)
+            cursor.execute(query, (client_fqdn, backup_root, scan_generation))
 
-    def update_superseded_archives(self, entries, new_archive_id: int):
-        for entry in entries:
-            # Remove superseded file size amounts from relevant size of previous archives
-            with self.connection:
-                cursor = self.connection.cursor()
-                query = '''
-                     update s3_archives
-                     set relevant_size = relevant_size - ?
-                     where archive_id = ?
-                     '''
-                cursor.execute(query, (entry["size"], entry["archive_id"]))
-
-            # Flag previous file backup records as superseded
-            if new_archive_id is not None:
-                with self.connection:
-                    cursor = self.connection.cursor()
-                    query = '''
-                        update file_archive_records
-                        set status = 'superseded'
-                        where status != 'superseded'
-                        and file_id in (select file_id from file_archive_records where archive_id = ?)
-                        and archive_id != ?
-                        '''
-                    cursor.execute(query, (new_archive_id, new_archive_id))
-
-    def mark_files_for_backup(self, client_fqdn, backup_root):
+    def mark_files_for_backup(self, client_fqdn, backup_root, scan_generation: int):
+        # Only files written by this scan can have changed
         with self.connection:
             cursor = self.connection.cursor()
-            query = '''
+            query = f'''
                   update files
                   set force_backup = 'Y'
-                  where client_fqdn = ?
-                  and backup_root = ?
-                  and sweep_mark = 'present'
-                  and (new_size != size or new_modification != modification)
+                  where scan_generation = ?3
+                  and directory_id in (select directory_id
+                                       from directories
+                                       where client_fqdn = ?1
+                                       and backup_root = ?2)
+                  and new_status = 'present'
+                  and (new_size != size
+                       or {modification_changed("modification", "new_modification")}
+                       or status != 'present')
                   '''
-            cursor.execute(query, (client_fqdn, backup_root))
+            cursor.execute(query, (client_fqdn, backup_root, scan_generation))
 
-    def get_files_to_backup(self, client_fqdn, backup_root) -> []:
-        entries = []
+    def get_files_to_backup(self, client_fqdn, backup_root, page_size: int = 10000) -> Iterator[List[FileToBackup]]:
+        """
+        Yields the files to back up in pages of up to page_size, directory by directory in path order. Each
+        page is read by a query of its own resuming after the last file of the previous one, so that no statement
+        stays open on files while the caller archives the page and updates them.
+        """
+        after_directory, after_name = "", ""
+        while True:
+            with self.connection:
+                cursor = self.connection.cursor()
+                query = '''
+                      select f.file_id,
+                             case when d.relative_path = '' then f.name
+                                  else d.relative_path || '/' || f.name end relative_path,
+                             f.new_size, f.new_modification, f.modification, f.last_archive_id
+                      from directories as d
+                      inner join files as f using (directory_id)
+                      where d.client_fqdn = ?1
+                      and d.backup_root = ?2
+                      and d.relative_path >= ?3
+                      and (d.relative_path > ?3 or f.name > ?4)
+                      and f.force_backup = 'Y'
+                      order by d.relative_path, f.name
+                      limit ?5
+                      '''
+                cursor.execute(query, (client_fqdn, backup_root, after_directory, after_name, page_size))
+                page = [FileToBackup(*row) for row in cursor]
+            if len(page) == 0:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+            after_directory, _, after_name = page[-1].relative_path.rpartition("/")
+
+    def archive_exists(self, cloud: str, region: str, bucket: str, name: str) -> bool:
         with self.connection:
             cursor = self.connection.cursor()
             query = '''
-                  select relative_path, new_size, new_modification, file_id
-                  from files
-                  where client_fqdn = ?
-                  and backup_root = ?
-                  and force_backup = 'Y'
+                  select 1
+                  from s3_archives
+                  where cloud = ?
+                  and region = ?
+                  and bucket = ?
+                  and archive_file_name = ?
                   '''
-            cursor.execute(query, (client_fqdn, backup_root))
-
-            for row in cursor:
-                entry = {}
-                for col in row.keys():
-                    entry[col] = row[col]
-                entries.append(entry)
-
-        return entries
+            cursor.execute(query, (cloud, region, bucket, name))
+            return cursor.fetchone() is not None
 
-    def new_archive(self, cloud: str, region: str, bucket: str, name: str) -> int:
+    def new_archive(self, cloud: str, region: str, bucket: str, name: str, codec: str, encryption: str,
+                    client_fqdn: str, backup_root: str) -> int:
         with self.connection:
             cursor = self.connection.cursor()
             query = '''
-                  insert into s3_archives(cloud, region, bucket, archive_file_name, total_size, relevant_size, status)
-                  values(?,?,?,?,?,?,?)
+                  insert into s3_archives(cloud, region, bucket, archive_file_name, total_size, relevant_size, status,
+                                          codec, encryption, client_fqdn, backup_root)
+                  values(?,?,?,?,?,?,?,?,?,?,?)
                   '''
             cursor.execute(query, (cloud, region, bucket,
-                           name, 0, 0, "pending_upload"))
+                           name, 0, 0, "pending_upload", codec, encryption, client_fqdn, backup_root))
 
         with self.connection:
             cursor = self.connection.cursor()
@@ -181,6 +508,14 @@ class Database():
                 return int(row["archive_id"])
 
     def archive_uploaded(self, archive_id: int, total_size: int):
+        """
+        Records an archive as uploaded and its files as backed up, superseding their previous records. Runs a
+        fixed number of statements that only visit the archive's files and their records.
+        """
+        self.connection.execute('''create temp table if not exists uploaded_files (
+                                 file_id integer not null primary key
+                                 )
+                              ''')
         with self.connection:
             cursor = self.connection.cursor()
             query = '''
@@ -192,39 +527,39 @@ class Database():
                   '''
             cursor.execute(query, (total_size, total_size, archive_id))
 
-        with self.connection:
-            cursor = self.connection.cursor()
+            # A file split in parts is only backed up once all its parts are uploaded, until then its uploaded
+            # parts are kept apart from its previous backups
             query = '''
                   update file_archive_records
-                  set status = 'uploaded'
+                  set status = 'part_uploaded'
                   where archive_id = ?
                   '''
             cursor.execute(query, (archive_id,))
 
-        # Get the ids of archives that contained the previous "last backup" of files
-        # backed up in this archive, and the space occupied by those files
-        entries = []
-        with self.connection:
-            cursor = self.connection.cursor()
+            cursor.execute("delete from temp.uploaded_files")
             query = '''
-                  select sum(f.size) size, f.last_archive_id archive_id
-                  from files f inner join file_archive_records far on (f.file_id = far.file_id)
+                  insert into temp.uploaded_files(file_id)
+                  select far.file_id
+                  from file_archive_records as far
                   where far.archive_id = ?
-                  group by f.last_archive_id
+                  and (far.part is null
+                       or far.part_count = (select count(*)
+                                            from file_archive_records as p
+                                            where p.file_id = far.file_id
+                                            and p.status = 'part_uploaded'))
                   '''
             cursor.execute(query, (archive_id,))
 
-            for row in cursor:
-                entry = {}
-                for col in row.keys():
-                    entry[col] = row[col]
-                entries.append(entry)
-
-        self.update_superseded_archives(entries, archive_id)
+            self._supersede_records(cursor, "select file_id from temp.uploaded_files")
+            query = '''
+                  update file_archive_records
+                  set status = 'uploaded'
+                  where file_id in (select file_id from temp.uploaded_files)
+                  and status = 'part_uploaded'
+                  '''
+            cursor.execute(query)
 
-        # Update file sizes etc with the latest values
-        with self.connection:
-            cursor = self.connection.cursor()
+            # Update file sizes etc with the latest values
             query = '''
                   update files
                   set last_archive_id = ?,
@@ -235,19 +570,236 @@ class Database():
                      new_modification = null,
                      new_status = null,
                      force_backup = 'N'
-                  where file_id in (select file_id from file_archive_records where archive_id = ?)
+                  where file_id in (select file_id from temp.uploaded_files)
+                  '''
+            cursor.execute(query, (archive_id,))
+            cursor.execute("delete from temp.uploaded_files")
+
+    def _supersede_file_records(self, cursor, file_id: int):
+        self._supersede_records(cursor, "select ?1", (file_id,))
+
+    def _supersede_records(self, cursor, file_ids: str, params=()):
+        # The archives holding the previous backup of the files lose its relevance
+        self._subtract_relevance(cursor, file_ids, params)
+        query = f'''
+              update file_archive_records
+              set status = 'superseded'
+              where file_id in ({file_ids})
+              and status in ('uploaded', 'deleted')
+              '''
+        cursor.execute(query, params)
+
+    def _subtract_relevance(self, cursor, file_ids: str, params=()):
+        """
+        Subtracts the size of the uploaded records of the files selected by the file_ids query from the relevant
+        size of their archives. The sizes are summed per archive first, so that each archive is updated once.
+        """
+        self.connection.execute('''create temp table if not exists relevance_changes (
+                                 archive_id integer not null primary key,
+                                 size integer not null
+                                 )
+                              ''')
+        cursor.execute("delete from temp.relevance_changes")
+        query = f'''
+              insert into temp.relevance_changes(archive_id, size)
+              select far.archive_id, sum(far.file_size)
+              from file_archive_records as far
+              where far.file_id in ({file_ids})
+              and far.status = 'uploaded'
+              group by far.archive_id
+              '''
+        cursor.execute(query, params)
+        query = '''
+              update s3_archives
+              set relevant_size = relevant_size - (select t.size
+                                                   from temp.relevance_changes as t
+                                                   where t.archive_id = s3_archives.archive_id)
+              where archive_id in (select archive_id from temp.relevance_changes)
+              '''
+        cursor.execute(query)
+        cursor.execute("delete from temp.relevance_changes")
+
+    def add_files_to_archive(self, archive_id: int, records: List[tuple]):
+        """
+        Records the files of a built archive in one transaction, along with its being built. Records are file
+        ID, size, modification, content hash (or None) and for a part of a file, its number and the file's part
+        count (or None): the size of a part is that of the part.
+        """
+        with self.connection:
+            cursor = self.connection.cursor()
+            query = '''
+                  update s3_archives
+                  set status = 'built'
+                  where archive_id = ?
+                  '''
+            cursor.execute(query, (archive_id,))
+            query = '''
+                  insert into file_archive_records(file_id, archive_id, file_size, file_modification, status,
+                                                   content_hash, part, part_count)
+                  values(?,?,?,?,'pending_upload',?,?,?)
+                  '''
+            cursor.executemany(query, ((file_id, archive_id, size, modification, content_hash, part, part_count)
+                                       for file_id, size, modification, content_hash, part, part_count in records))
+
+    def get_interrupted_archives(self, client_fqdn: str, backup_root: str):
+        """
+        Archives an interrupted backup of the client config left unfinished: built but not known to be
+        uploaded, or not even built. Includes those left by versions that did not record the client config.
+        incomplete_files counts the files split in parts of which the archive holds one, but whose other parts
+        were neither built nor uploaded.
+        """
+        with self.connection:
+            cursor = self.connection.cursor()
+            query = '''
+                  select s3.archive_id, s3.archive_file_name, s3.status,
+                         (select ifnull(sum(far.file_size), 0)
+                          from file_archive_records as far
+                          where far.archive_id = s3.archive_id) size,
+                         (select count(*)
+                          from file_archive_records as far
+                          where far.archive_id = s3.archive_id
+                          and far.part is not null
+                          and far.part_count > (select count(*)
+                                                from file_archive_records as p
+                                                inner join s3_archives as a using (archive_id)
+                                                where p.file_id = far.file_id
+                                                and (p.status = 'part_uploaded'
+                                                     or (p.status = 'pending_upload' and a.status = 'built')))
+                         ) incomplete_files
+                  from s3_archives as s3
+                  where s3.status in ('pending_upload', 'built')
+                  and ((s3.client_fqdn = ? and s3.backup_root = ?) or s3.client_fqdn is null)
                   '''
-            cursor.execute(query, (archive_id, archive_id))
+            cursor.execute(query, (client_fqdn, backup_root))
+
+            entries = []
+            for row in cursor:
+                entry = {}
+                for col in row.keys():
+                    entry[col] = row[col]
+                entries.append(entry)
+
+            return entries
 
-    def add_file_to_archive(self, archive_id: int, file_id: int, size: int, modification: str):
+    def discard_archives(self, archive_ids: List[int]):
+        """
+        Forgets archives that will not be uploaded, and the records of their files.
+        """
         with self.connection:
             cursor = self.connection.cursor()
             query = '''
-                  insert into file_archive_records(file_id, archive_id, file_size, file_modification, status)
+                  delete from file_archive_records
+                  where archive_id = ?
+                  and status = 'pending_upload'
+                  '''
+            cursor.executemany(query, ((archive_id,) for archive_id in archive_ids))
+            query = '''
+                  delete from s3_archives
+                  where archive_id = ?
+                  and status in ('pending_upload', 'built')
+                  '''
+            cursor.executemany(query, ((archive_id,) for archive_id in archive_ids))
+
+    def find_archived_content(self, cloud: str, region: str, bucket: str, content_hash: str, size: int):
+        """
+        Returns the archive ID and source file ID of an uploaded archive holding the given content, or None.
+        """
+        with self.connection:
+            cursor = self.connection.cursor()
+            query = '''
+                  select far.archive_id, ifnull(far.source_file_id, far.file_id) source_file_id
+                  from file_archive_records as far
+                  inner join s3_archives as s3 using (archive_id)
+                  where far.content_hash = ?
+                  and far.file_size = ?
+                  and s3.status = 'uploaded'
+                  and s3.cloud = ?
+                  and s3.region = ?
+                  and s3.bucket = ?
+                  limit 1
+                  '''
+            cursor.execute(query, (content_hash, size, cloud, region, bucket))
+            for row in cursor:
+                return row["archive_id"], row["source_file_id"]
+        return None
+
+    def add_file_reference(self, archive_id: int, source_file_id: int, file_id: int, size: int, modification: int,
+                           content_hash: str):
+        """
+        Records a file as backed up by content already stored in an uploaded archive, as archive_uploaded()
+        does for the files of a new archive.
+        """
+        with self.connection:
+            self._add_file_reference(self.connection.cursor(), archive_id, source_file_id, file_id, size,
+                                     modification, content_hash)
+
+    def _add_file_reference(self, cursor, archive_id: int, source_file_id: int, file_id: int, size: int,
+                            modification: int, content_hash: str):
+        self._supersede_file_records(cursor, file_id)
+
+        # The file may already have a record in the archive, e.g. if its content was reverted
+        query = '''
+              insert into file_archive_records(file_id, archive_id, file_size, file_modification, status,
+                                               content_hash, source_file_id)
+              values(?,?,?,?,'uploaded',?,?)
+              on conflict(file_id, archive_id) do
+              update set
+                  file_size = excluded.file_size,
+                  file_modification = excluded.file_modification,
+                  status = 'uploaded',
+                  content_hash = excluded.content_hash
+              '''
+        cursor.execute(query, (file_id, archive_id, size, modification, content_hash,
+                               None if source_file_id == file_id else source_file_id))
+        query = '''
+              update s3_archives
+              set relevant_size = relevant_size + ?
+              where archive_id = ?
+              '''
+        cursor.execute(query, (size, archive_id))
+
+        query = '''
+              update files
+              set last_archive_id = ?,
+                 size = new_size,
+                 modification = new_modification,
+                 status = new_status,
+                 new_size = null,
+                 new_modification = null,
+                 new_status = null,
+                 force_backup = 'N'
+              where file_id = ?
+              '''
+        cursor.execute(query, (archive_id, file_id))
+
+    def get_cached_content_hash(self, device: int, inode: int, size: int, modification_ns: int):
+        with self.reader() as connection:
+            cursor = connection.cursor()
+            query = '''
+                  select content_hash
+                  from content_hash_cache
+                  where device = ?
+                  and inode = ?
+                  and size = ?
+                  and modification_ns = ?
+                  '''
+            cursor.execute(query, (device, inode, size, modification_ns))
+            # Read to the end, so that the connection is returned to the pool without a statement in progress
+            for row in cursor.fetchall():
+                return row["content_hash"]
+        return None
+
+    def cache_content_hashes(self, entries):
+        """
+        Stores (device, inode, size, modification_ns, content_hash) tuples.
+        """
+        with self.connection:
+            cursor = self.connection.cursor()
+            query = '''
+                  insert or replace into content_hash_cache(device, inode, size, modification_ns, content_hash)
                   values(?,?,?,?,?)
                   '''
-            cursor.execute(query, (file_id, archive_id, size,
-                           modification, "pending_upload"))
+            cursor.executemany(query, entries)
 
     def get_archives_to_delete(self, cloud: str, region: str, bucket: str, backup_root: str):
         with self.connection:
@@ -271,9 +823,10 @@ class Database():
                   and s3.archive_id in (select distinct far.archive_id
                               from file_archive_records as far
                               inner join files as f using (file_id)
+                              inner join directories as d using (directory_id)
                               where far.archive_id = s3.archive_id
-                              and f.client_fqdn = cc.client_fqdn
-                              and f.backup_root = cc.backup_root)
+                              and d.client_fqdn = cc.client_fqdn
+                              and d.backup_root = cc.backup_root)
                   '''
             cursor.execute(query, (cloud, region, bucket, backup_root))
 
@@ -287,10 +840,17 @@ class Database():
             return entries
 
     def get_archive_stats(self, cloud: str, region: str, bucket: str, backup_root: str):
-        with self.connection:
-            cursor = self.connection.cursor()
+        """
+        Read-only, relevant sizes are computed rather than taken from s3_archives, which Purge keeps up to date.
+        """
+        with self.reader() as connection:
+            cursor = connection.cursor()
             query = '''
-                  select s3.archive_file_name, s3.total_size, s3.relevant_size, s3.status, s3.archive_id, s3.created
+                  select s3.archive_file_name, s3.total_size, s3.status, s3.archive_id, s3.created,
+                         (select ifnull(sum(far.file_size), 0)
+                          from file_archive_records as far
+                          where far.archive_id = s3.archive_id
+                          and far.status = 'uploaded') relevant_size
                   from s3_archives as s3
                   inner join backup_client_configs as cc using (cloud, region, bucket)
                   where cc.cloud = ?
@@ -303,9 +863,10 @@ class Database():
                   and s3.archive_id in (select distinct far.archive_id
                               from file_archive_records as far
                               inner join files as f using (file_id)
+                              inner join directories as d using (directory_id)
                               where far.archive_id = s3.archive_id
-                              and f.client_fqdn = cc.client_fqdn
-                              and f.backup_root = cc.backup_root)
+                              and d.client_fqdn = cc.client_fqdn
+                              and d.backup_root = cc.backup_root)
                   '''
             cursor.execute(query, (cloud, region, bucket, backup_root))
 
@@ -372,9 +933,10 @@ class Database():
                   and s3.archive_id in (select distinct far.archive_id
                               from file_archive_records as far
                               inner join files as f using (file_id)
+                              inner join directories as d using (directory_id)
                               where far.archive_id = s3.archive_id
-                              and f.client_fqdn = cc.client_fqdn
-                              and f.backup_root = cc.backup_root)
+                              and d.client_fqdn = cc.client_fqdn
+                              and d.backup_root = cc.backup_root)
                   '''
             cursor.execute(query, (cloud, region, bucket, backup_root))
 
@@ -387,15 +949,22 @@ class Database():
 
             return entries
 
-    def flag_archive_deleted(self, archive_id: int):
-        self._set_archive_status(archive_id, 'deleted')
-
-    def find_file(self, backup_root: str, file: str):
+    def flag_archives_deleted(self, archive_ids: List[int]):
         with self.connection:
             cursor = self.connection.cursor()
+            query = '''
+                  update s3_archives
+                  set status = 'deleted'
+                  where archive_id = ?
+                  '''
+            cursor.executemany(query, ((archive_id,) for archive_id in archive_ids))
+
+    def find_file(self, backup_root: str, file: str):
+        with self.reader() as connection:
+            cursor = connection.cursor()
             query = '''
                         select file_id
-                        from files
+                        from file_paths
                         where backup_root = ?
                         and relative_path like ?
                     '''
@@ -410,11 +979,29 @@ class Database():
 
             return entries
 
+    def get_file(self, file_id: int):
+        with self.reader() as connection:
+            cursor = connection.cursor()
+            query = '''
+                        select file_id, client_fqdn, backup_root, relative_path
+                        from file_paths
+                        where file_id = ?
+                    '''
+            cursor.execute(query, (file_id,))
+
+            for row in cursor.fetchall():
+                entry = {}
+                for col in row.keys():
+                    entry[col] = row[col]
+                return entry
+        return None
+
     def find_file_archives(self, file_id: str):
-        with self.connection:
-            cursor = self.connection.cursor()
+        with self.reader() as connection:
+            cursor = connection.cursor()
             query = '''
-                        select file_id, archive_id, file_size, file_modification, status
+                        select file_id, archive_id, file_size, file_modification, status, source_file_id,
+                               part, part_count
                         from file_archive_records
                         where file_id = ?
                         and status in ('uploaded', 'superseded')
@@ -431,10 +1018,10 @@ class Database():
             return entries
 
     def get_archive_details(self, archive_id: str):
-        with self.connection:
-            cursor = self.connection.cursor()
+        with self.reader() as connection:
+            cursor = connection.cursor()
             query = '''
-                        select archive_id, bucket, archive_file_name
+                        select archive_id, bucket, archive_file_name, codec, encryption
                         from s3_archives
                         where archive_id = ?
                     '''
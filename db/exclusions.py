@@ -0,0 +1,174 @@
+import re
+
+from typing import List, Optional, Tuple
+
+_METACHARACTERS = set(".^$*+?{}[]|()")
+_QUANTIFIERS = set("*+?{")
+# Flags that can be scoped to each pattern of a merged alternation
+_INLINE_FLAGS = ((re.IGNORECASE, "i"), (re.MULTILINE, "m"), (re.DOTALL, "s"), (re.VERBOSE, "x"))
+_MERGEABLE_FLAGS = re.UNICODE | re.IGNORECASE | re.MULTILINE | re.DOTALL | re.VERBOSE
+
+
+def _split_literal_prefix(pattern: str) -> Tuple[str, str]:
+    """
+    Splits a regexp into the literal text it starts with and the remaining pattern source.
+    """
+    literal = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            if i + 1 >= len(pattern) or pattern[i + 1].isalnum():
+                # Character class (\d, \w...), anchor or backreference
+                break
+            c = pattern[i + 1]
+            width = 2
+        elif c in _METACHARACTERS:
+            break
+        else:
+            width = 1
+        if i + width < len(pattern) and pattern[i + width] in _QUANTIFIERS:
+            # The character is quantified, so is not part of the literal prefix
+            break
+        literal.append(c)
+        i += width
+    return "".join(literal), pattern[i:]
+
+
+def _has_top_level_alternation(pattern: str) -> bool:
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            i += 2
+            continue
+        if in_class:
+            if c == "]":
+                in_class = False
+        elif c == "[":
+            in_class = True
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            return True
+        i += 1
+    return False
+
+
+def _ends_with_subtree_wildcard(pattern: str) -> bool:
+    """
+    True if the pattern ends with an unescaped "/.*", i.e. it matches everything below some directory.
+    """
+    if not pattern.endswith("/.*"):
+        return False
+    backslashes = len(pattern[:-2]) - len(pattern[:-2].rstrip("\\"))
+    return backslashes % 2 == 0
+
+
+def _references_groups(pattern: str) -> bool:
+    """
+    True if the pattern refers to groups, by a backreference or a conditional: merged with others before it,
+    its groups would be renumbered.
+    """
+    i = 0
+    while i < len(pattern):
+        if pattern[i] == "\\":
+            if i + 1 < len(pattern) and pattern[i + 1] in "123456789":
+                return True
+            i += 2
+            continue
+        if pattern.startswith("(?P=", i) or pattern.startswith("(?(", i):
+            return True
+        i += 1
+    return False
+
+
+def _scoped(pattern: re.Pattern) -> str:
+    flags = "".join(letter for flag, letter in _INLINE_FLAGS if pattern.flags & flag)
+    return f"(?{flags}:{pattern.pattern})"
+
+
+def _merge(patterns: List[re.Pattern]) -> Optional[re.Pattern]:
+    if len(patterns) == 0:
+        return None
+    if any(p.flags & ~_MERGEABLE_FLAGS or _references_groups(p.pattern) for p in patterns):
+        return _PatternList(patterns)
+    try:
+        return re.compile("|".join(_scoped(p) for p in patterns))
+    except re.error:
+        # Patterns can't always be combined (e.g. duplicate group names), fall back to testing them in turn
+        return _PatternList(patterns)
+
+
+class _PatternList():
+    def __init__(self, patterns: List[re.Pattern]):
+        self.patterns = patterns
+
+    def fullmatch(self, path: str) -> bool:
+        return any(p.fullmatch(path) for p in self.patterns)
+
+
+class ExclusionMatcher():
+    """
+    Tests paths against a client configuration's exclusion patterns.
+
+    Patterns that are plain text (e.g. "/excluded_file1\\.dat") or plain text followed by ".*"
+    (e.g. "/excluded_directory1/.*") are answered from a set and a prefix tuple without running
+    any regexp. All other patterns are merged into a single alternation.
+
+    Paths are relative to the backup root and start with a slash.
+    """
+
+    def __init__(self, patterns: List[re.Pattern]):
+        self.exact = set()
+        prefixes = []
+        generic = []
+        subtree = []
+        for pattern in patterns:
+            if pattern.flags & ~re.UNICODE or _has_top_level_alternation(pattern.pattern):
+                generic.append(pattern)
+                continue
+            literal, rest = _split_literal_prefix(pattern.pattern)
+            if rest == "":
+                self.exact.add(literal)
+            elif rest == ".*":
+                prefixes.append(literal)
+            else:
+                generic.append(pattern)
+                if _ends_with_subtree_wildcard(pattern.pattern):
+                    subtree.append(pattern)
+
+        self.prefixes = tuple(prefixes)
+        self.regex = _merge(generic)
+        self.subtree_regex = _merge(subtree)
+        # "." does not match newlines, so the literal fast paths don't apply to such names
+        self.all_regex = _merge(patterns)
+        self.empty = len(patterns) == 0
+
+    def matches(self, path: str) -> bool:
+        if self.empty:
+            return False
+        if "\n" in path:
+            return bool(self.all_regex.fullmatch(path))
+        if path in self.exact or path.startswith(self.prefixes):
+            return True
+        return self.regex is not None and bool(self.regex.fullmatch(path))
+
+    def matches_subtree(self, path: str) -> bool:
+        """
+        True if the directory at path, or everything below it, is excluded: the directory need not be walked.
+        """
+        if self.empty:
+            return False
+        if self.matches(path):
+            return True
+        subtree_path = path + "/"
+        if "\n" in path:
+            return False
+        if subtree_path.startswith(self.prefixes):
+            return True
+        return self.subtree_regex is not None and bool(self.subtree_regex.fullmatch(subtree_path))
@@ -1,60 +1,107 @@
-import os
 import time
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import List, Tuple
 
-from .db import Database
+from .db import Database, modification_changed
 from .client_config import ClientConfig
 
 
 @dataclass
-class File():
-    db: Database
-    client_config: ClientConfig
-    root: str
-    file: str
-    is_accessible: bool = True
+class FileWriter():
+    """
+    Records files found by a scan in the catalog.
 
-    def __post_init__(self):
-        abs_path = os.path.join(self.root, self.file)
-        try:
-            self.metadata = os.lstat(abs_path)
-        except FileNotFoundError:
-            self.is_accessible = False
+    Rows are buffered and written with executemany() every batch_size files. The caller owns the
+    transaction and must call flush() before committing it.
 
-        # Trim root and trailing slash
-        self.rel_path = abs_path[len(self.client_config.backup_root) + 1:]
+    Catalog rows are only written for files that are new, changed, reappeared, still pending backup or whose
+    device and inode changed, and are then tagged with the scan's generation. Unless record_seen is False
+    (the scan is compared against a Snapshot instead), every file found is recorded in temp.scan_seen so that
+    Database.mark_vanished_files() can tell which files have been deleted. Files are identified by their
+    directory's ID and their name, the IDs of the directories of each batch being looked up when it is written.
+    """
 
-    def upsert(self):
-        if not self.is_accessible:
-            # Behave as though the file has been deleted
-            print(f"Inaccessible, pretend deleted: {self.rel_path}")
-            return
+    db: Database
+    client_config: ClientConfig
+    scan_generation: int
+    batch_size: int = 1000
+    record_seen: bool = True
+    pending: List[Tuple] = field(default_factory=list)
+    pending_seen: List[Tuple[str, str]] = field(default_factory=list)
+    flush_count: int = 0
+    flush_seconds: float = 0.0
+    flush_max_seconds: float = 0.0
+    row_count: int = 0
 
-        e = self._check_utf8(self.rel_path)
+    def upsert(self, rel_path: str, size: int, mtime_ns: int, device: int, inode: int):
+        e = self._check_utf8(rel_path)
         if e is not None:
             print(f"Pretending deleted, unable to encode file name: {e}")
             return
 
-        datetime_str = self._epoch2fmt(self.metadata.st_mtime)
+        directory, _, name = rel_path.rpartition("/")
+        self.pending.append((directory, name, size, mtime_ns, self.scan_generation, device, inode))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
 
+    def mark_seen(self, rel_path: str):
+        """
+        Records that a file exists without checking it for changes, e.g. when resuming a scan.
+        """
+        if self.record_seen:
+            directory, _, name = rel_path.rpartition("/")
+            self.pending_seen.append((directory, name))
+            if len(self.pending_seen) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0 and len(self.pending_seen) == 0:
+            return
+
+        start = time.monotonic()
+        directory_ids = self.db.get_directory_ids(self.client_config.client_fqdn, self.client_config.backup_root,
+                                                  {row[0] for row in self.pending} |
+                                                  {row[0] for row in self.pending_seen})
         cursor = self.db.connection.cursor()
-        query = '''
-                insert into files(client_fqdn, backup_root, relative_path, size, modification, status, sweep_mark,
-                                force_backup, new_size, new_modification, new_status)
-                values(?,?,?,?,?,'present','present','Y',?,?,'present')
-                on conflict(client_fqdn, backup_root, relative_path) do
+        query = f'''
+                insert into files(directory_id, name, size, modification, status, force_backup, new_size,
+                                  new_modification, new_status, scan_generation, device, inode)
+                values(?1,?2,?3,?4,'present','Y',?3,?4,'present',?5,?6,?7)
+                on conflict(directory_id, name) do
                 update set
-                    new_size = ?,
-                    new_modification = ?,
+                    new_size = excluded.new_size,
+                    new_modification = excluded.new_modification,
                     new_status = 'present',
-                    sweep_mark = 'present'
+                    scan_generation = excluded.scan_generation,
+                    device = excluded.device,
+                    inode = excluded.inode
+                where files.size != excluded.size
+                or {modification_changed("files.modification", "excluded.modification")}
+                or files.status != 'present'
+                or files.force_backup = 'Y'
+                or files.inode is null
+                or files.inode != excluded.inode
+                or files.device != excluded.device
                 '''
-        cursor.execute(query, (self.client_config.client_fqdn, self.client_config.backup_root,
-                                self.rel_path, self.metadata.st_size,
-                                datetime_str,
-                                self.metadata.st_size, datetime_str,
-                                self.metadata.st_size, datetime_str))
+        cursor.executemany(query, ((directory_ids[row[0]],) + row[1:] for row in self.pending))
+        if self.record_seen:
+            query = "insert or ignore into temp.scan_seen(directory_id, name) values(?, ?)"
+            cursor.executemany(query, ((directory_ids[row[0]], row[1]) for row in self.pending))
+            cursor.executemany(query, ((directory_ids[directory], name) for directory, name in self.pending_seen))
+            self.pending_seen.clear()
+        elapsed = time.monotonic() - start
+
+        self.row_count += len(self.pending)
+        self.pending.clear()
+        self.flush_count += 1
+        self.flush_seconds += elapsed
+        self.flush_max_seconds = max(self.flush_max_seconds, elapsed)
+
+    def stats(self) -> str:
+        mean_ms = self.flush_seconds * 1000 / self.flush_count if self.flush_count else 0.0
+        return (f"{self.row_count} files in {self.flush_count} flushes of up to {self.batch_size}, "
+                f"{self.flush_seconds:.2f}s total, {mean_ms:.1f}ms mean, {self.flush_max_seconds * 1000:.1f}ms max")
 
     def _check_utf8(self, s):
         try:
@@ -62,6 +109,3 @@ class File():
         except Exception as e:
             return e
         return None
-
-    def _epoch2fmt(self, epoch) -> str:
-        return time.strftime('%Y-%m-%d %H:%M:%S %Z', time.gmtime(epoch))
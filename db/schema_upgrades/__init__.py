@@ -2,3 +2,13 @@ from .v0 import SchemaUpgradeV0
 from .v1 import SchemaUpgradeV1
 from .v2 import SchemaUpgradeV2
 from .v3 import SchemaUpgradeV3
+from .v4 import SchemaUpgradeV4
+from .v5 import SchemaUpgradeV5
+from .v6 import SchemaUpgradeV6
+from .v7 import SchemaUpgradeV7
+from .v8 import SchemaUpgradeV8
+from .v9 import SchemaUpgradeV9
+from .v10 import SchemaUpgradeV10
+from .v11 import SchemaUpgradeV11
+from .v12 import SchemaUpgradeV12
+from .v13 import SchemaUpgradeV13
@@ -0,0 +1,28 @@
+import sqlite3
+
+from dataclasses import dataclass
+
+from .schema_upgrade import SchemaUpgrade
+
+
+@dataclass()
+class SchemaUpgradeV10(SchemaUpgrade):
+    connection: sqlite3.Connection
+    schema_version: int = 10
+
+    def __post_init__(self):
+        self.upgrade()
+        self.set_version()
+
+    def upgrade(self):
+        self.ddl_add_file_parts()
+
+    def ddl_add_file_parts(self):
+        # Files larger than an archive are split in parts stored in separate archives, numbered from 1.
+        # Null for files archived whole
+        self.connection.execute('''alter table file_archive_records
+                                   add column part integer
+                              ''')
+        self.connection.execute('''alter table file_archive_records
+                                   add column part_count integer
+                              ''')
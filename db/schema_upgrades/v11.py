@@ -0,0 +1,24 @@
+import sqlite3
+
+from dataclasses import dataclass
+
+from .schema_upgrade import SchemaUpgrade
+
+
+@dataclass()
+class SchemaUpgradeV11(SchemaUpgrade):
+    connection: sqlite3.Connection
+    schema_version: int = 11
+
+    def __post_init__(self):
+        self.upgrade()
+        self.set_version()
+
+    def upgrade(self):
+        self.ddl_add_archive_encryption()
+
+    def ddl_add_archive_encryption(self):
+        # Archives created before encryption could be chosen are encrypted with gpg
+        self.connection.execute('''alter table s3_archives
+                                   add column encryption text not null default 'gpg'
+                              ''')
@@ -0,0 +1,28 @@
+import sqlite3
+
+from dataclasses import dataclass
+
+from .schema_upgrade import SchemaUpgrade
+
+
+@dataclass()
+class SchemaUpgradeV12(SchemaUpgrade):
+    connection: sqlite3.Connection
+    schema_version: int = 12
+
+    def __post_init__(self):
+        self.upgrade()
+        self.set_version()
+
+    def upgrade(self):
+        self.ddl_add_archive_client_config()
+
+    def ddl_add_archive_client_config(self):
+        # The client config that created the archive, so that the archives a backup left pending can be found
+        # before any of their files are recorded. Null for archives created by older versions
+        self.connection.execute('''alter table s3_archives
+                                   add column client_fqdn text
+                              ''')
+        self.connection.execute('''alter table s3_archives
+                                   add column backup_root text
+                              ''')
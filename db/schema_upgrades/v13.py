@@ -0,0 +1,121 @@
+import sqlite3
+
+from dataclasses import dataclass
+
+from .schema_upgrade import SchemaUpgrade
+
+# The directory part of a relative path, with its trailing slash: rtrim() strips every character of the path but '/'
+_DIRECTORY_PREFIX = "rtrim({0}, replace({0}, '/', ''))"
+
+
+@dataclass()
+class SchemaUpgradeV13(SchemaUpgrade):
+    connection: sqlite3.Connection
+    schema_version: int = 13
+
+    def __post_init__(self):
+        self.upgrade()
+        self.set_version()
+        # Reclaim the space of the paths: the catalog is backed up every run
+        self.connection.execute("vacuum")
+
+    def upgrade(self):
+        # In one transaction: the files table is rebuilt
+        with self.connection:
+            self.connection.execute("begin immediate")
+            self.ddl_create_table_directories()
+            self.ddl_rebuild_table_files()
+            self.ddl_create_view_file_paths()
+
+    def ddl_create_table_directories(self):
+        # Directories of the files, relative to their backup root ("" being the root). Their paths are only
+        # stored once, rather than in every files row and index entry
+        self.connection.execute('''create table if not exists directories (
+                                 directory_id integer primary key,
+                                 client_fqdn text not null,
+                                 backup_root text not null,
+                                 relative_path text not null
+                                 )
+                              ''')
+        self.connection.execute('''create unique index if not exists directories_1 on directories (
+                                 client_fqdn,
+                                 backup_root,
+                                 relative_path
+                                 )
+                              ''')
+        prefix = _DIRECTORY_PREFIX.format("relative_path")
+        self.connection.execute(f'''insert into directories(client_fqdn, backup_root, relative_path)
+                                   select distinct client_fqdn, backup_root, substr({prefix}, 1, length({prefix}) - 1)
+                                   from files
+                                   order by 1, 2, 3
+                              ''')
+
+    def ddl_rebuild_table_files(self):
+        # Files are identified by their directory and name, and keep their IDs. sweep_mark was replaced by
+        # scan_generation in v4
+        self.connection.execute('''create table files_v13 (
+                                 file_id integer primary key,
+                                 directory_id integer not null,
+                                 name text not null,
+                                 size integer not null,
+                                 modification integer not null,
+                                 status text not null,
+                                 new_size integer,
+                                 new_modification integer,
+                                 new_status text,
+                                 last_archive_id integer,
+                                 force_backup char(1),
+                                 scan_generation integer,
+                                 device integer,
+                                 inode integer,
+                                 foreign key (directory_id) references directories (directory_id),
+                                 foreign key (last_archive_id) references s3_archives (archive_id)
+                                 )
+                              ''')
+        prefix = _DIRECTORY_PREFIX.format("f.relative_path")
+        self.connection.execute(f'''insert into files_v13(file_id, directory_id, name, size, modification, status,
+                                                         new_size, new_modification, new_status, last_archive_id,
+                                                         force_backup, scan_generation, device, inode)
+                                   select f.file_id, d.directory_id, substr(f.relative_path, length({prefix}) + 1),
+                                          f.size, f.modification, f.status, f.new_size, f.new_modification,
+                                          f.new_status, f.last_archive_id, f.force_backup, f.scan_generation,
+                                          f.device, f.inode
+                                   from files as f
+                                   inner join directories as d on (d.client_fqdn = f.client_fqdn
+                                                                   and d.backup_root = f.backup_root
+                                                                   and d.relative_path = substr({prefix}, 1,
+                                                                                                length({prefix}) - 1))
+                                   order by f.file_id
+                              ''')
+        self.connection.execute("drop table files")
+        self.connection.execute("alter table files_v13 rename to files")
+        self.connection.execute('''create unique index if not exists files_1 on files (
+                                 directory_id,
+                                 name
+                                 )
+                              ''')
+        # Scan generations are numbered per backup root: files written by the scans of other roots with the same
+        # generation number are told apart by their directory
+        self.connection.execute('''create index if not exists files_2 on files (
+                                 scan_generation,
+                                 directory_id
+                                 )
+                              ''')
+        self.connection.execute('''create index if not exists files_3 on files (
+                                 device,
+                                 inode
+                                 )
+                              ''')
+
+    def ddl_create_view_file_paths(self):
+        # Files with their backup root and path, as they were stored before v13: for restores and queries by path
+        self.connection.execute('''create view if not exists file_paths as
+                                 select f.file_id, d.client_fqdn, d.backup_root,
+                                        case when d.relative_path = '' then f.name
+                                             else d.relative_path || '/' || f.name end relative_path,
+                                        f.directory_id, f.name, f.size, f.modification, f.status, f.new_size,
+                                        f.new_modification, f.new_status, f.last_archive_id, f.force_backup,
+                                        f.scan_generation, f.device, f.inode
+                                 from files as f
+                                 inner join directories as d using (directory_id)
+                              ''')
@@ -0,0 +1,34 @@
+import sqlite3
+
+from dataclasses import dataclass
+
+from .schema_upgrade import SchemaUpgrade
+
+
+@dataclass()
+class SchemaUpgradeV4(SchemaUpgrade):
+    connection: sqlite3.Connection
+    schema_version: int = 4
+
+    def __post_init__(self):
+        self.upgrade()
+        self.set_version()
+
+    def upgrade(self):
+        self.ddl_add_scan_generations()
+
+    def ddl_add_scan_generations(self):
+        # Replaces files.sweep_mark: rows are only written by a scan when new, changed or vanished,
+        # and carry the generation of the scan that wrote them
+        self.connection.execute('''alter table backup_client_configs
+                                   add column scan_generation integer not null default 0
+                              ''')
+        self.connection.execute('''alter table files
+                                   add column scan_generation integer
+                              ''')
+        self.connection.execute('''create index if not exists files_2 on files (
+                                 client_fqdn,
+                                 backup_root,
+                                 scan_generation
+                                 )
+                              ''')
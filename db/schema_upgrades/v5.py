@@ -0,0 +1,29 @@
+import sqlite3
+
+from dataclasses import dataclass
+
+from .schema_upgrade import SchemaUpgrade
+
+
+@dataclass()
+class SchemaUpgradeV5(SchemaUpgrade):
+    connection: sqlite3.Connection
+    schema_version: int = 5
+
+    def __post_init__(self):
+        self.upgrade()
+        self.set_version()
+
+    def upgrade(self):
+        self.ddl_create_table_scan_checkpoints()
+
+    def ddl_create_table_scan_checkpoints(self):
+        # Directories fully recorded by a scan that has not completed yet, so that it can be resumed
+        self.connection.execute('''create table if not exists scan_checkpoints (
+                                 client_fqdn text not null,
+                                 backup_root text not null,
+                                 scan_generation integer not null,
+                                 relative_directory text not null,
+                                 primary key (client_fqdn, backup_root, relative_directory)
+                                 )
+                              ''')
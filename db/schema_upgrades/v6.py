@@ -0,0 +1,44 @@
+import sqlite3
+
+from dataclasses import dataclass
+
+from .schema_upgrade import SchemaUpgrade
+
+
+@dataclass()
+class SchemaUpgradeV6(SchemaUpgrade):
+    connection: sqlite3.Connection
+    schema_version: int = 6
+
+    def __post_init__(self):
+        self.upgrade()
+        self.set_version()
+
+    def upgrade(self):
+        self.ddl_add_content_hashes()
+        self.ddl_create_table_content_hash_cache()
+
+    def ddl_add_content_hashes(self):
+        # source_file_id is set on records that reference content archived for another file (or an older
+        # version of the same file), the archive holding it under that file's path
+        self.connection.execute('''alter table file_archive_records
+                                   add column content_hash text
+                              ''')
+        self.connection.execute('''alter table file_archive_records
+                                   add column source_file_id integer references files (file_id)
+                              ''')
+        self.connection.execute('''create index if not exists file_archive_records_2 on file_archive_records (
+                                 content_hash
+                                 )
+                              ''')
+
+    def ddl_create_table_content_hash_cache(self):
+        self.connection.execute('''create table if not exists content_hash_cache (
+                                 device integer not null,
+                                 inode integer not null,
+                                 size integer not null,
+                                 modification_ns integer not null,
+                                 content_hash text not null,
+                                 primary key (device, inode)
+                                 )
+                              ''')
@@ -0,0 +1,32 @@
+import sqlite3
+
+from dataclasses import dataclass
+
+from .schema_upgrade import SchemaUpgrade
+
+
+@dataclass()
+class SchemaUpgradeV7(SchemaUpgrade):
+    connection: sqlite3.Connection
+    schema_version: int = 7
+
+    def __post_init__(self):
+        self.upgrade()
+        self.set_version()
+
+    def upgrade(self):
+        self.ddl_add_file_identities()
+
+    def ddl_add_file_identities(self):
+        # Filled in by the next scan of each file, see FileWriter
+        self.connection.execute('''alter table files
+                                   add column device integer
+                              ''')
+        self.connection.execute('''alter table files
+                                   add column inode integer
+                              ''')
+        self.connection.execute('''create index if not exists files_3 on files (
+                                 device,
+                                 inode
+                                 )
+                              ''')
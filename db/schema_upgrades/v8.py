@@ -0,0 +1,35 @@
+import sqlite3
+
+from dataclasses import dataclass
+
+from .schema_upgrade import SchemaUpgrade
+
+# Text times were written as '%Y-%m-%d %H:%M:%S %Z' in UTC
+_TO_NANOSECONDS = "cast(strftime('%s', substr({0}, 1, 19)) as integer) * 1000000000"
+
+
+@dataclass()
+class SchemaUpgradeV8(SchemaUpgrade):
+    connection: sqlite3.Connection
+    schema_version: int = 8
+
+    def __post_init__(self):
+        self.upgrade()
+        self.set_version()
+        # Reclaim the space freed by the conversion: the catalog is backed up every run
+        self.connection.execute("vacuum")
+
+    def upgrade(self):
+        self.dml_convert_modification_times()
+
+    def dml_convert_modification_times(self):
+        # Modification times become integer nanoseconds since the epoch. Converted times keep their whole
+        # second precision, see modification_changed() in db/db.py
+        with self.connection:
+            for table, column in (("files", "modification"),
+                                  ("files", "new_modification"),
+                                  ("file_archive_records", "file_modification")):
+                self.connection.execute(f'''update {table}
+                                           set {column} = {_TO_NANOSECONDS.format(column)}
+                                           where typeof({column}) = 'text'
+                                      ''')
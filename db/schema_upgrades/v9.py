@@ -0,0 +1,24 @@
+import sqlite3
+
+from dataclasses import dataclass
+
+from .schema_upgrade import SchemaUpgrade
+
+
+@dataclass()
+class SchemaUpgradeV9(SchemaUpgrade):
+    connection: sqlite3.Connection
+    schema_version: int = 9
+
+    def __post_init__(self):
+        self.upgrade()
+        self.set_version()
+
+    def upgrade(self):
+        self.ddl_add_archive_codec()
+
+    def ddl_add_archive_codec(self):
+        # Archives created before codecs could be chosen are gzip compressed
+        self.connection.execute('''alter table s3_archives
+                                   add column codec text not null default 'gzip'
+                              ''')
@@ -0,0 +1,200 @@
+import hashlib
+import mmap
+import os
+import struct
+
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import List, Optional
+
+from .db import Database, NANOSECONDS
+from .client_config import ClientConfig
+
+_HEADER = struct.Struct("<8sQQ")
+_MAGIC = b"DFSNAP03"
+
+# Outcomes of Snapshot.compare()
+UNCHANGED = 0
+CHANGED = 1
+NEW = 2
+
+# Size of the files scans must always rewrite: no file has it, so they never compare unchanged
+REWRITE_SIZE = -1
+
+
+def snapshot_directory(db_path: str) -> str:
+    return os.path.join(os.path.dirname(db_path), "snapshots")
+
+
+def path_hash(rel_path: str) -> int:
+    # Signed, as SQLite integers are
+    return int.from_bytes(hashlib.blake2b(rel_path.encode("utf-8", "surrogateescape"),
+                                          digest_size=8).digest(), "little", signed=True)
+
+
+def same_modification(cataloged_ns: int, mtime_ns: int) -> bool:
+    # As modification_changed() in db/db.py: times converted from text only have whole second precision
+    if cataloged_ns == mtime_ns:
+        return True
+    return cataloged_ns % NANOSECONDS == 0 and cataloged_ns == mtime_ns - mtime_ns % NANOSECONDS
+
+
+class Snapshot():
+    """
+    Compact state of the present files of a backup root: four parallel arrays sorted by path hash.
+
+    Each file costs 32 bytes (64-bit path hash, file ID, size and modification time), plus one byte
+    while a scan is compared against it: about 33MB per million files. Paths themselves are not kept,
+    so two paths with the same 64-bit hash would be confused; the odds of that in a root of a
+    million files are around 3 in 100 million.
+    """
+
+    def __init__(self, hashes, file_ids, sizes, mtimes, mapping: Optional[mmap.mmap] = None):
+        self.hashes = hashes
+        self.file_ids = file_ids
+        self.sizes = sizes
+        self.mtimes = mtimes
+        self.mapping = mapping
+        self.seen = bytearray(len(hashes))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def compare(self, rel_path: str, size: int, mtime_ns: int) -> int:
+        h = path_hash(rel_path)
+        i = bisect_left(self.hashes, h)
+        if i == len(self.hashes) or self.hashes[i] != h:
+            return NEW
+        self.seen[i] = 1
+        if self.sizes[i] == size and same_modification(self.mtimes[i], mtime_ns):
+            return UNCHANGED
+        return CHANGED
+
+    def mark_seen(self, rel_path: str):
+        h = path_hash(rel_path)
+        i = bisect_left(self.hashes, h)
+        if i < len(self.hashes) and self.hashes[i] == h:
+            self.seen[i] = 1
+
+    def unseen_file_ids(self) -> List[int]:
+        return [self.file_ids[i] for i in range(len(self.seen)) if not self.seen[i]]
+
+    def close(self):
+        if self.mapping is not None:
+            for values in (self.hashes, self.file_ids, self.sizes, self.mtimes):
+                values.release()
+            self.mapping.close()
+            self.mapping = None
+
+
+@dataclass
+class SnapshotStore():
+    """
+    Loads snapshots of a backup root from the catalog, or memory-maps them from the file saved
+    at the end of the previous successful backup if it is still current.
+    """
+
+    db: Database
+    client_config: ClientConfig
+    max_files: int
+
+    def __post_init__(self):
+        self.directory = snapshot_directory(self.db.db_path)
+        self.path = os.path.join(self.directory, self.client_config.state_file_name() + ".snapshot")
+
+    def load(self, generation: int) -> Optional[Snapshot]:
+        """
+        Returns the snapshot as of the scan of the given generation, or None if it can't be used.
+        """
+        snapshot = self._map(generation)
+        if snapshot is not None:
+            print(f"Snapshot: mapped {len(snapshot)} files from {self.path}")
+            return snapshot
+
+        arrays = self._query()
+        if arrays is None:
+            return None
+        print(f"Snapshot: loaded {len(arrays[0])} files from the catalog")
+        return Snapshot(*arrays)
+
+    def save(self, generation: int):
+        arrays = self._query()
+        if arrays is None:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, generation, len(arrays[0])))
+            for values in arrays:
+                values.tofile(f)
+        os.replace(tmp_path, self.path)
+
+    def _map(self, generation: int) -> Optional[Snapshot]:
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return None
+        with f:
+            header = f.read(_HEADER.size)
+            if len(header) != _HEADER.size:
+                return None
+            magic, snapshot_generation, count = _HEADER.unpack(header)
+            if magic != _MAGIC or snapshot_generation != generation or count > self.max_files:
+                return None
+            if os.fstat(f.fileno()).st_size != _HEADER.size + count * 32:
+                return None
+            if count == 0:
+                return Snapshot(array("q"), array("q"), array("q"), array("q"))
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(mapping)
+        arrays = []
+        for i, typecode in enumerate("qqqq"):
+            start = _HEADER.size + i * count * 8
+            arrays.append(view[start:start + count * 8].cast(typecode))
+        view.release()
+        return Snapshot(*arrays, mapping=mapping)
+
+    def _query(self):
+        cursor = self.db.connection.cursor()
+        query = '''
+              select count(*) count
+              from file_paths
+              where client_fqdn = ?
+              and backup_root = ?
+              and status = 'present'
+              '''
+        cursor.execute(query, (self.client_config.client_fqdn, self.client_config.backup_root))
+        count = cursor.fetchone()["count"]
+        if count > self.max_files:
+            print(f"Snapshot: {count} files exceed the limit of {self.max_files}")
+            return None
+
+        # Files pending backup, or whose identity isn't known yet, are kept so that scans notice them vanish, but
+        # never compare unchanged so that scans always rewrite them
+        self.db.connection.create_function("path_hash", 1, path_hash, deterministic=True)
+        query = f'''
+              select path_hash(relative_path) hash, file_id,
+                     case when force_backup = 'N' and inode is not null then size else {REWRITE_SIZE} end size,
+                     modification
+              from file_paths
+              where client_fqdn = ?
+              and backup_root = ?
+              and status = 'present'
+              order by 1
+              '''
+        cursor.execute(query, (self.client_config.client_fqdn, self.client_config.backup_root))
+        hashes, file_ids, sizes, mtimes = array("q"), array("q"), array("q"), array("q")
+        for row in cursor:
+            if len(hashes) > 0 and hashes[-1] == row[0]:
+                print("Snapshot: path hash collision, falling back to comparing in the catalog")
+                return None
+            hashes.append(row[0])
+            file_ids.append(row[1])
+            sizes.append(row[2])
+            mtimes.append(row[3])
+        return hashes, file_ids, sizes, mtimes
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+
+from backup.encryption import DecryptionError, decrypt, read_passphrase
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decrypts archives encrypted in process (aead encryption)')
+
+    parser.add_argument("--key-file",
+                        help="Key file of the backup",
+                        type=str,
+                        required=True)
+    parser.add_argument("input",
+                        help="Encrypted archive, standard input if omitted",
+                        nargs="?",
+                        type=str,
+                        default=None)
+    args = parser.parse_args()
+
+    passphrase = read_passphrase(args.key_file)
+    try:
+        if args.input is None:
+            decrypt(sys.stdin.buffer, sys.stdout.buffer, passphrase)
+        else:
+            with open(args.input, "rb") as f:
+                decrypt(f, sys.stdout.buffer, passphrase)
+    except DecryptionError as e:
+        print(f"Failed to decrypt: {e}", file=sys.stderr)
+        sys.exit(1)
@@ -23,8 +23,20 @@ if __name__ == '__main__':
                         help="Root directory of the manual backup to trigger",
                         type=str,
                         required=True)
+    parser.add_argument("--catalog-pragma",
+                        help="SQLite pragma set on the catalog's connections, as name=value, e.g. synchronous=full "
+                             "(can be repeated)",
+                        action="append",
+                        default=[])
     args = parser.parse_args()
 
+    pragmas = {}
+    for pragma in args.catalog_pragma:
+        name, _, value = pragma.partition("=")
+        if not value:
+            parser.error(f"Invalid catalog pragma, expected name=value: {pragma}")
+        pragmas[name] = value
+
     print(f"{args}")
-    c = Coordinator()
+    c = Coordinator(pragmas=pragmas)
     c.run_manual(args.cloud_provider, args.region, args.client_name, args.backup_root)
@@ -8,7 +8,7 @@ from datetime import datetime, timezone
 
 from dataclasses import dataclass
 
-from db import Database
+from db import ClientConfig, Database
 
 @dataclass
 class Restore:
@@ -28,8 +28,9 @@ class Restore:
         self.generate_restore_commands(archives)
         self.generate_restore_status_commands(archives)
         self.generate_s3_copy_commands(archives)
-        self.generate_gpg_commands(archives)
+        self.generate_decryption_commands(archives)
         self.generate_untar_commands(archives)
+        self.generate_reassembly_commands(archives)
 
     def stat_file(self):
         full_path = os.path.join(self.backup_root, self.target)
@@ -89,6 +90,18 @@ class Restore:
             archive["archive_file_name"] = archive_file_name
             archive["bucket"] = archive_details["bucket"]
             archive["archive_dest_file_name"] = re.sub('/', '_', archive_file_name)
+            archive["dest_directory"] = re.sub("\.tar(\.gz|\.zst)?$", "", archive["archive_dest_file_name"])
+            archive["codec"] = archive_details["codec"]
+            archive["encryption"] = archive_details["encryption"]
+            # Deduplicated content is stored under the path of the file it was first archived for
+            archive["member"] = self.target
+            if archive["source_file_id"] is not None:
+                source = self.db.get_file(archive["source_file_id"])
+                archive["member"] = source["relative_path"]
+                print(f"Archive {archive_id} holds the content as {source['backup_root']}/{source['relative_path']}")
+            # Files larger than an archive are split in parts, each stored in a separate archive
+            if archive["part"] is not None:
+                archive["member"] += f".part{archive['part']:05d}"
         return archives
 
     def generate_restore_commands(self, archives):
@@ -114,21 +127,45 @@ class Restore:
             print(f"aws-vault exec <someone> -- aws s3 cp s3://{bucket}/{archive_file_name}.enc ./{archive_dest_file_name}")
         return archives
 
-    def generate_gpg_commands(self, archives):
-        print("\n-- GPG commands")
+    def generate_decryption_commands(self, archives):
+        print("\n-- Decryption commands")
+        decrypt = os.path.join(os.path.dirname(os.path.abspath(__file__)), "deep-freeze-decrypt.py")
         for archive in archives:
             archive_dest_file_name = archive["archive_dest_file_name"]
-            print(f"gpg -d {archive_dest_file_name}.enc > {archive_dest_file_name}")
+            if archive["encryption"] == ClientConfig.AEAD:
+                print(f"{decrypt} --key-file <key file> {archive_dest_file_name}.enc > {archive_dest_file_name}")
+            else:
+                print(f"gpg -d {archive_dest_file_name}.enc > {archive_dest_file_name}")
 
     def generate_untar_commands(self, archives):
         print("\n-- Untar commands")
-        target_components = self.target.split("/")
-        target_file_name = target_components[-1]
-        strip_count = len(target_components) - 1
         for archive in archives:
+            strip_count = len(archive["member"].split("/")) - 1
             archive_dest_file_name = archive["archive_dest_file_name"]
-            dest_directory = re.sub("\.tar\.gz$", "", archive_dest_file_name)
-            print(f"mkdir {dest_directory} && tar xzf -C {dest_directory} --strip-components={strip_count} {archive_dest_file_name} \"{self.target}\"")
+            dest_directory = archive["dest_directory"]
+            if archive["codec"] == ClientConfig.ZSTD:
+                print(f"mkdir {dest_directory} && zstd -dc {archive_dest_file_name} | tar xf - -C {dest_directory} --strip-components={strip_count} \"{archive['member']}\"")
+            elif archive["codec"] == ClientConfig.UNCOMPRESSED:
+                print(f"mkdir {dest_directory} && tar xf {archive_dest_file_name} -C {dest_directory} --strip-components={strip_count} \"{archive['member']}\"")
+            else:
+                print(f"mkdir {dest_directory} && tar xzf -C {dest_directory} --strip-components={strip_count} {archive_dest_file_name} \"{archive['member']}\"")
+
+    def generate_reassembly_commands(self, archives):
+        versions = {}
+        for archive in archives:
+            if archive["part"] is not None:
+                versions.setdefault((archive["file_modification"], archive["part_count"]), []).append(archive)
+        if len(versions) == 0:
+            return
+        print("\n-- Reassembly commands")
+        for (modification, part_count), parts in versions.items():
+            parts.sort(key=lambda archive: archive["part"])
+            if len(parts) != part_count:
+                print(f"# Version modified at {modification} is missing parts: {len(parts)} of {part_count} found")
+                continue
+            name = os.path.basename(self.target)
+            paths = " ".join(f"{part['dest_directory']}/{name}.part{part['part']:05d}" for part in parts)
+            print(f"cat {paths} > \"{name}\"")
 
 def human_readable_epoch(t: float):
     return datetime.fromtimestamp(t, tz=timezone.utc)
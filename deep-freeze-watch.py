@@ -0,0 +1,7 @@
+#!/usr/bin/env python3
+
+from backup.watcher import Watcher
+from db import Database
+
+if __name__ == '__main__':
+    Watcher(Database()).run()
@@ -1,6 +1,35 @@
 #!/usr/bin/env python3
 
+import argparse
+
 from backup import Coordinator
 
-c = Coordinator()
-c.run()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs backups')
+
+    parser.add_argument("--concurrent-backups",
+                        help="Number of configurations backed up at the same time (the catalog is backed up last, "
+                             "on its own)",
+                        type=int,
+                        default=1)
+    parser.add_argument("--backups-per-device",
+                        help="Number of configurations whose backup roots are on the same device backed up at "
+                             "the same time",
+                        type=int,
+                        default=1)
+    parser.add_argument("--catalog-pragma",
+                        help="SQLite pragma set on the catalog's connections, as name=value, e.g. synchronous=full "
+                             "(can be repeated)",
+                        action="append",
+                        default=[])
+    args = parser.parse_args()
+
+    pragmas = {}
+    for pragma in args.catalog_pragma:
+        name, _, value = pragma.partition("=")
+        if not value:
+            parser.error(f"Invalid catalog pragma, expected name=value: {pragma}")
+        pragmas[name] = value
+
+    c = Coordinator(args.concurrent_backups, args.backups_per_device, pragmas)
+    c.run()
@@ -88,3 +88,13 @@ dd if=/dev/urandom of="${test_root}/excluded_file1.dat" bs=1k count=2
 dd if=/dev/urandom of="${test_root}/a1/b1/c1/excluded_file2.dat" bs=1k count=2
 dd if=/dev/urandom of="${test_root}/d1/e2/f2/excluded_file2.dat" bs=1k count=2
 dd if=/dev/urandom of="${test_root}/d1/e2/f2/not_initially_excluded_file3.dat" bs=1k count=2
+
+# Create directories skipped because they contain exclusion markers
+
+mkdir -p "${test_root}/d1/cache_directory/e1"
+printf 'Signature: 8a477f597d28d172789f06886806bc55\n# This file is a cache directory tag.\n' >"${test_root}/d1/cache_directory/CACHEDIR.TAG"
+dd if=/dev/urandom of="${test_root}/d1/cache_directory/e1/e1_1.dat" bs=1k count=2
+
+mkdir -p "${test_root}/a1/nobackup_directory"
+touch "${test_root}/a1/nobackup_directory/.nobackup"
+dd if=/dev/urandom of="${test_root}/a1/nobackup_directory/nobackup_1.dat" bs=1k count=2
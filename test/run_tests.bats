@@ -4,6 +4,7 @@
 setup_file() {
   export test_root2=$(mktemp -d)
   export temp_work_dir=$(mktemp -d)
+  export MOCK_AWS_MULTIPART_UPLOADS=$(mktemp)
 }
 
 setup() {
@@ -24,31 +25,31 @@ setup() {
 
 @test "Check test_root files have been loaded" {
   run sqlite3 -echo -readonly ~/.deep-freeze-backups/deep-freeze-backups.db \
-    "select count(*) from files where backup_root = '${test_root}'"
+    "select count(*) from file_paths where backup_root = '${test_root}'"
   assert_output "5"
 }
 
 @test "Check deep-freeze files have been loaded too" {
   run sqlite3 -echo -readonly ~/.deep-freeze-backups/deep-freeze-backups.db \
-    "select count(*) from files where backup_root = '${HOME}/.deep-freeze-backups'"
+    "select count(*) from file_paths where backup_root = '${HOME}/.deep-freeze-backups'"
   assert_output "1"
 }
 
 @test "Check test_root has been backed up" {
   run sqlite3 -echo -readonly ~/.deep-freeze-backups/deep-freeze-backups.db \
-    "select count(*) from files f inner join file_archive_records far using (file_id) where f.backup_root = '${test_root}' and far.status='uploaded'"
+    "select count(*) from file_paths f inner join file_archive_records far using (file_id) where f.backup_root = '${test_root}' and far.status='uploaded'"
   assert_output "5"
 }
 
 @test "Check deep-freeze DB has been backed up" {
   run sqlite3 -echo -readonly ~/.deep-freeze-backups/deep-freeze-backups.db \
-    "select count(*) from files f inner join file_archive_records far using (file_id) where f.backup_root = '${HOME}/.deep-freeze-backups' and far.status='uploaded'"
+    "select count(*) from file_paths f inner join file_archive_records far using (file_id) where f.backup_root = '${HOME}/.deep-freeze-backups' and far.status='uploaded'"
   assert_output "1"
 }
 
 @test "Check test_root2 has not been loaded as it is manually backed up" {
   run sqlite3 -echo -readonly ~/.deep-freeze-backups/deep-freeze-backups.db \
-    "select count(*) from files where backup_root = '${test_root2}'"
+    "select count(*) from file_paths where backup_root = '${test_root2}'"
   assert_output "0"
 }
 
@@ -86,7 +87,7 @@ setup() {
 
 @test "Check newly excluded file is considered deleted" {
   run sqlite3 -echo -readonly ~/.deep-freeze-backups/deep-freeze-backups.db \
-    "select count(*) from files where relative_path = 'd1/e2/f2/not_initially_excluded_file3.dat' and status = 'absent'"
+    "select count(*) from file_paths where relative_path = 'd1/e2/f2/not_initially_excluded_file3.dat' and status = 'absent'"
   assert_output "1"
 
   run sqlite3 -echo -readonly ~/.deep-freeze-backups/deep-freeze-backups.db \
@@ -106,7 +107,7 @@ setup() {
 
 @test "Check deleted file detected" {
   run sqlite3 -echo -readonly ~/.deep-freeze-backups/deep-freeze-backups.db \
-    "select count(*) from files where relative_path = 'a1/b1/c1/c1_1.dat' and status = 'absent'"
+    "select count(*) from file_paths where relative_path = 'a1/b1/c1/c1_1.dat' and status = 'absent'"
   assert_output "1"
 
   # File excluded above is deleted too
@@ -129,19 +130,19 @@ setup() {
 
 @test "Check test_root2 has been loaded" {
   run sqlite3 -echo -readonly ~/.deep-freeze-backups/deep-freeze-backups.db \
-    "select count(*) from files where backup_root = '${test_root2}'"
+    "select count(*) from file_paths where backup_root = '${test_root2}'"
   assert_output "1"
 }
 
 @test "Check test_root2 has been backed up" {
   run sqlite3 -echo -readonly ~/.deep-freeze-backups/deep-freeze-backups.db \
-    "select count(*) from files f inner join file_archive_records far using (file_id) where far.status='uploaded' and f.backup_root = '${HOME}/.deep-freeze-backups'"
+    "select count(*) from file_paths f inner join file_archive_records far using (file_id) where far.status='uploaded' and f.backup_root = '${HOME}/.deep-freeze-backups'"
   assert_output "1"
 }
 
 @test "Check the change in test_root was not backed up" {
   run sqlite3 -echo -readonly ~/.deep-freeze-backups/deep-freeze-backups.db \
-    "select count(*) from files where relative_path = 'd1/e2/f2/f2_1.dat' and size = 3072"
+    "select count(*) from file_paths where relative_path = 'd1/e2/f2/f2_1.dat' and size = 3072"
   assert_output "1"
 }
 
@@ -182,7 +183,21 @@ setup() {
   assert_success
 }
 
-@test "Run backup 5" {
+@test "Run backup 5 with failing deletions" {
+  MOCK_AWS_FAIL_DELETE=1 run ../deep-freeze.py
+  assert_success
+}
+
+@test "Check archives that failed to be deleted are not flagged deleted" {
+  run sqlite3 -echo -readonly ~/.deep-freeze-backups/deep-freeze-backups.db \
+    "select count(*) from s3_archives where status='deleted'"
+  assert_output "0"
+  run sqlite3 -echo -readonly ~/.deep-freeze-backups/deep-freeze-backups.db \
+    "select count(*) from s3_archives where status='pending_deletion'"
+  assert_output "2"
+}
+
+@test "Run backup 6" {
   run ../deep-freeze.py
   assert_success
 }
@@ -193,6 +208,51 @@ setup() {
   assert_output "2"
 }
 
+# Test resumed uploads of archives built by a failed backup
+
+@test "Make a change in test_root for a failing upload" {
+  dd if=/dev/urandom of="${test_root}/d1/e1/f1/f1_1.dat" bs=1k count=5
+}
+
+@test "Ensure archive name will change for next backup (3)" {
+  run sleep 1
+  assert_success
+}
+
+@test "Run backup 7 with failing uploads" {
+  MOCK_AWS_FAIL_UPLOAD=1 run ../deep-freeze.py
+  assert_failure
+}
+
+@test "Check the failed upload left its archive built and a multipart upload" {
+  run sqlite3 -echo -readonly ~/.deep-freeze-backups/deep-freeze-backups.db \
+    "select count(*) from s3_archives where status='built'"
+  assert_output "1"
+  run bash -c "sort -u ${MOCK_AWS_MULTIPART_UPLOADS} | wc -l"
+  assert_output "1"
+}
+
+@test "Run backup 8" {
+  run ../deep-freeze.py
+  assert_success
+  assert_output --partial "Resuming upload of"
+}
+
+@test "Check the archive was uploaded and the multipart upload aborted" {
+  run sqlite3 -echo -readonly ~/.deep-freeze-backups/deep-freeze-backups.db \
+    "select count(*) from s3_archives where status='built'"
+  assert_output "0"
+  run bash -c "wc -l < ${MOCK_AWS_MULTIPART_UPLOADS}"
+  assert_output "0"
+}
+
+# Unit tests, each with catalogs of its own
+
+@test "Run unit tests" {
+  run python3 -m unittest discover -s unit
+  assert_success
+}
+
 # Debugging
 
 # @test "Force error to get DB contents" {
@@ -0,0 +1,106 @@
+import io
+import os
+import unittest
+
+from backup import encryption
+from backup.encryption import DecryptionError, Encryptor, TAG_SIZE, decrypt
+
+try:
+    import cryptography  # noqa: F401
+except ImportError:
+    cryptography = None
+
+PASSPHRASE = b"correct horse battery staple"
+# Small chunks so that a few hundred bytes span several
+CHUNK_SIZE = 64
+
+
+def encrypt(data: bytes, passphrase: bytes = PASSPHRASE, write_size: int = 10) -> bytes:
+    output = io.BytesIO()
+    encryptor = Encryptor(output, passphrase, CHUNK_SIZE)
+    for start in range(0, len(data), write_size):
+        encryptor.write(data[start:start + write_size])
+    encryptor.close()
+    return output.getvalue()
+
+
+def decrypted(container: bytes, passphrase: bytes = PASSPHRASE) -> bytes:
+    output = io.BytesIO()
+    decrypt(io.BytesIO(container), output, passphrase)
+    return output.getvalue()
+
+
+def split(container: bytes):
+    header_size = encryption._HEADER.size
+    body = container[header_size:]
+    size = CHUNK_SIZE + TAG_SIZE
+    return container[:header_size], [body[start:start + size] for start in range(0, len(body), size)]
+
+
+@unittest.skipIf(cryptography is None, "requires the cryptography package")
+class EncryptionTest(unittest.TestCase):
+    def test_round_trip_across_chunk_boundaries(self):
+        for size in (0, 1, CHUNK_SIZE - 1, CHUNK_SIZE, CHUNK_SIZE + 1, 3 * CHUNK_SIZE, 3 * CHUNK_SIZE + 5):
+            data = os.urandom(size)
+            for write_size in (1, CHUNK_SIZE, 1000):
+                with self.subTest(size=size, write_size=write_size):
+                    self.assertEqual(decrypted(encrypt(data, write_size=write_size)), data)
+
+    def test_chunks(self):
+        # A last chunk is always written, empty if the data fills the previous ones
+        _, chunks = split(encrypt(os.urandom(2 * CHUNK_SIZE)))
+        self.assertEqual([len(chunk) for chunk in chunks], [CHUNK_SIZE + TAG_SIZE, CHUNK_SIZE + TAG_SIZE])
+        _, chunks = split(encrypt(os.urandom(2 * CHUNK_SIZE + 1)))
+        self.assertEqual([len(chunk) for chunk in chunks], [CHUNK_SIZE + TAG_SIZE] * 2 + [1 + TAG_SIZE])
+
+    def test_wrong_passphrase(self):
+        with self.assertRaises(DecryptionError):
+            decrypted(encrypt(os.urandom(100)), b"wrong passphrase")
+
+    def test_truncated_final_chunk(self):
+        container = encrypt(os.urandom(2 * CHUNK_SIZE + 10))
+        for size in (len(container) - 1, len(container) - 10 - TAG_SIZE):
+            with self.subTest(size=size):
+                with self.assertRaises(DecryptionError):
+                    decrypted(container[:size])
+
+    def test_dropped_final_chunk(self):
+        # Without its last chunk, a container of full chunks ends with one encrypted as not the last
+        for size in (2 * CHUNK_SIZE, 2 * CHUNK_SIZE + 10):
+            with self.subTest(size=size):
+                header, chunks = split(encrypt(os.urandom(size)))
+                with self.assertRaises(DecryptionError):
+                    decrypted(header + b"".join(chunks[:-1]))
+
+    def test_truncated_header(self):
+        with self.assertRaises(DecryptionError):
+            decrypted(encrypt(b"data")[:encryption._HEADER.size - 1])
+
+    def test_tampered_chunk(self):
+        container = bytearray(encrypt(os.urandom(3 * CHUNK_SIZE)))
+        container[encryption._HEADER.size + CHUNK_SIZE + TAG_SIZE + 5] ^= 1
+        with self.assertRaises(DecryptionError):
+            decrypted(bytes(container))
+
+    def test_tampered_header(self):
+        container = bytearray(encrypt(os.urandom(100)))
+        # The last byte of the nonce prefix
+        container[encryption._HEADER.size - 1] ^= 1
+        with self.assertRaises(DecryptionError):
+            decrypted(bytes(container))
+
+    def test_reordered_chunks(self):
+        header, chunks = split(encrypt(os.urandom(3 * CHUNK_SIZE + 10)))
+        with self.assertRaises(DecryptionError):
+            decrypted(header + chunks[1] + chunks[0] + b"".join(chunks[2:]))
+
+    def test_chunks_of_another_container(self):
+        data = os.urandom(2 * CHUNK_SIZE + 10)
+        header, chunks = split(encrypt(data))
+        _, other_chunks = split(encrypt(data))
+        with self.assertRaises(DecryptionError):
+            decrypted(header + chunks[0] + other_chunks[1] + chunks[2])
+
+
+if __name__ == "__main__":
+    unittest.main()
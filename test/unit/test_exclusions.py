@@ -0,0 +1,108 @@
+import re
+import unittest
+
+from db.exclusions import ExclusionMatcher, _PatternList
+
+# Groups of patterns, each answered by a different part of the matcher
+PATTERNS = {
+    "exact": [r"/excluded_file1\.dat", r"/a\+b", r"/with space"],
+    "prefix": [r"/excluded_directory1/.*", r"/a/excluded_directory2/.*", r"/p.*"],
+    "generic": [r".*/excluded_file2\..*", r".*\.tmp", r"/[ab]/.*", r"/ab*c", r"/a\.?b", r"/x\d+"],
+    "anchors": [r"^/anchored$", r"/start.*$", r"\A/whole\Z", r"^/logs/.*"],
+    "alternations": [r"/foo|/bar/.*", r"/(cache|tmp)/.*", r"/x(a|b)y", r"/[|]|/pipe"],
+    "unmergeable": [r"/(?P<name>one)/.*", r"/(?P<name>two)\.dat", r"/(\w)\1/.*"],
+    # Merged, the backreferences would refer to the groups of the patterns before them
+    "backreferences": [r"/(g)roup/.*", r"/(\w)\1/.*", r"/(?P<c>\w)(?P=c)\.dat", r"/(x)?(?(1)y|z)"],
+    "flags": [re.compile(r"/case/.*", re.IGNORECASE), re.compile(r"/multi.*", re.DOTALL), r"(?i)/inline/.*"],
+    "subtrees": [r"/logs/.*\.log", r"/src/.*/build/.*", r"/deep/.*/.*"],
+}
+
+PATHS = [
+    "/excluded_file1.dat", "/excluded_file1xdat", "/excluded_file1.dat/x", "/a+b", "/aab", "/with space",
+    "/excluded_directory1", "/excluded_directory1/", "/excluded_directory1/x", "/excluded_directory1x/y",
+    "/a/excluded_directory2/c1/c1_1.dat", "/p", "/pq/r", "/q/p",
+    "/d/excluded_file2.txt", "/excluded_file2.txt", "/x.tmp", "/d/x.tmp", "/a/x", "/b/x", "/c/x",
+    "/ac", "/abbbc", "/ab", "/a.b", "/x12", "/x", "/x1a",
+    "/anchored", "/anchored/x", "/start", "/start/x", "/whole", "/wholex",
+    "/foo", "/foo/x", "/bar", "/bar/x", "/cache/x", "/tmp/x", "/tmpx/y", "/xay", "/xby", "/xcy", "/|", "/pipe",
+    "/one/x", "/one", "/two.dat", "/three.dat", "/aa/x", "/ab/x", "/gg/x", "/group/x", "/cc.dat", "/gg.dat",
+    "/xy", "/z", "/y",
+    "/case/x", "/CASE/x", "/Case", "/multi/x", "/INLINE/x", "/inline",
+    "/logs/x.log", "/logs/x.txt", "/logs/d/x.log", "/src/a/build/x", "/src/build/x", "/deep/x", "/deep/x/y",
+    # "." matches no newline, but for DOTALL patterns
+    "/excluded_directory1/x\n", "/d/excluded_file2.\n", "/multi\n", "/excluded_file1.dat\n", "/p\n",
+]
+
+# Directories, and names below them: pruning a directory must only skip files that would be excluded
+DIRECTORIES = [
+    "/excluded_directory1", "/excluded_directory1x", "/a", "/a/excluded_directory2", "/b", "/p", "/pq",
+    "/start", "/foo", "/bar", "/cache", "/tmp", "/one", "/two", "/aa", "/ab", "/gg", "/group", "/case", "/CASE",
+    "/logs", "/logs/d", "/src", "/src/a", "/src/a/build", "/deep", "/deep/x", "/x",
+]
+DESCENDANTS = ["x", "x.log", "x.tmp", "excluded_file2.txt", "y/z", "build/x", ".hidden", "with space"]
+
+
+def reference(patterns, path: str) -> bool:
+    # As ClientConfig.is_excluded() tested paths before ExclusionMatcher
+    return any(pattern.fullmatch(path) for pattern in patterns)
+
+
+def compiled(patterns):
+    return [pattern if isinstance(pattern, re.Pattern) else re.compile(pattern) for pattern in patterns]
+
+
+class ExclusionMatcherTest(unittest.TestCase):
+    def pattern_sets(self):
+        for name, patterns in PATTERNS.items():
+            yield name, compiled(patterns)
+        yield "all", compiled([pattern for patterns in PATTERNS.values() for pattern in patterns])
+        yield "none", []
+
+    def test_matches_as_fullmatch(self):
+        for name, patterns in self.pattern_sets():
+            matcher = ExclusionMatcher(patterns)
+            for path in PATHS:
+                with self.subTest(patterns=name, path=path):
+                    self.assertEqual(matcher.matches(path), reference(patterns, path))
+
+    def test_pruned_directories_only_hold_excluded_files(self):
+        # Names holding newlines, which "." does not match, are assumed not to occur below pruned directories
+        for name, patterns in self.pattern_sets():
+            matcher = ExclusionMatcher(patterns)
+            for directory in DIRECTORIES:
+                if not matcher.matches_subtree(directory):
+                    continue
+                if reference(patterns, directory):
+                    # Directories were never descended into when excluded themselves
+                    continue
+                for descendant in DESCENDANTS:
+                    path = f"{directory}/{descendant}"
+                    with self.subTest(patterns=name, path=path):
+                        self.assertTrue(reference(patterns, path))
+
+    def test_subtrees(self):
+        matcher = ExclusionMatcher(compiled([pattern for patterns in PATTERNS.values() for pattern in patterns]))
+        for directory in ("/excluded_directory1", "/a/excluded_directory2", "/pq", "/cache", "/one", "/aa", "/a",
+                          "/deep/x", "/logs", "/logs/d"):
+            with self.subTest(directory=directory):
+                self.assertTrue(matcher.matches_subtree(directory))
+        # Some descendants of these are not excluded
+        for directory in ("/excluded_directory1x", "/src", "/src/a", "/deep", "/x", "/two"):
+            with self.subTest(directory=directory):
+                self.assertFalse(matcher.matches_subtree(directory))
+
+    def test_descendants_that_could_still_match(self):
+        # Only some files below /logs are excluded: it must be walked, whatever else is excluded
+        matcher = ExclusionMatcher(compiled([r"/logs/.*\.log", r"/excluded_directory1/.*"]))
+        self.assertFalse(matcher.matches_subtree("/logs"))
+        self.assertTrue(matcher.matches("/logs/d/x.log"))
+        self.assertFalse(matcher.matches("/logs/d/x.txt"))
+        self.assertTrue(matcher.matches_subtree("/excluded_directory1"))
+
+    def test_unmergeable_patterns_are_tested_in_turn(self):
+        matcher = ExclusionMatcher(compiled(PATTERNS["unmergeable"]))
+        self.assertIsInstance(matcher.regex, _PatternList)
+
+
+if __name__ == "__main__":
+    unittest.main()
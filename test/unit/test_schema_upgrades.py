@@ -0,0 +1,193 @@
+import calendar
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from db import ClientConfig, Database, FileWriter
+from db.ddl import MaintainSchema
+
+
+def create_catalog(path: str, schema_version: int) -> sqlite3.Connection:
+    connection = sqlite3.connect(path)
+    connection.row_factory = sqlite3.Row
+    MaintainSchema(connection, schema_version)
+    return connection
+
+
+class SchemaUpgradeV13Test(unittest.TestCase):
+    # Paths as scans recorded them: at the root, nested, with dots anywhere, and with the double slash
+    # of a directory recorded with a trailing slash
+    PATHS = [
+        "root.txt",
+        ".hidden",
+        "a/b/c.tar.gz",
+        "a/b/.profile",
+        "a/b.d/e",
+        "a/b.d/e.",
+        "a/..x/y",
+        "dir.with.dots/x",
+        "sub//name",
+    ]
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "catalog.db")
+        connection = create_catalog(self.path, 12)
+        with connection:
+            connection.execute('''insert into s3_archives(archive_id, cloud, region, bucket, archive_file_name,
+                                                         total_size, relevant_size, status, client_fqdn,
+                                                         backup_root)
+                                  values(7, 'aws', 'eu-north-1', 'bucket', 'archive', 1000, 1000, 'uploaded',
+                                         'host', '/root1')
+                               ''')
+            self.rows = {}
+            file_id = 100
+            # The same paths under another root and another client, whose directories must be kept apart
+            for client_fqdn, backup_root in (("host", "/root1"), ("host", "/root2"), ("other", "/root1")):
+                for relative_path in self.PATHS:
+                    file_id += 1
+                    row = (file_id, client_fqdn, backup_root, relative_path, len(relative_path),
+                           1600000000000000000 + file_id, "present", None, None, None, 7, "N", 3, 1, file_id)
+                    connection.execute('''insert into files(file_id, client_fqdn, backup_root, relative_path, size,
+                                                           modification, status, new_size, new_modification,
+                                                           new_status, last_archive_id, force_backup,
+                                                           scan_generation, device, inode)
+                                          values(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+                                       ''', row)
+                    connection.execute('''insert into file_archive_records(file_id, archive_id, file_size,
+                                                                          file_modification, status)
+                                          values(?, 7, ?, ?, 'uploaded')
+                                       ''', (file_id, row[4], row[5]))
+                    self.rows[file_id] = row
+        connection.close()
+        self.db = Database(db_path=self.path)
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_schema_version(self):
+        row = self.db.connection.execute("select value from deep_freeze_metadata where key = 'schema_version'")
+        self.assertEqual(row.fetchone()["value"], "13")
+
+    def test_directories(self):
+        rows = self.db.connection.execute("select client_fqdn, backup_root, relative_path from directories").fetchall()
+        expected = {"", "a/b", "a/b.d", "a/..x", "dir.with.dots", "sub/"}
+        for client_fqdn, backup_root in (("host", "/root1"), ("host", "/root2"), ("other", "/root1")):
+            self.assertEqual({row["relative_path"] for row in rows if (row["client_fqdn"], row["backup_root"]) ==
+                              (client_fqdn, backup_root)}, expected, (client_fqdn, backup_root))
+
+    def test_names(self):
+        rows = self.db.connection.execute('''select f.file_id, d.relative_path, f.name
+                                              from files as f
+                                              inner join directories as d using (directory_id)
+                                           ''')
+        split = {row["file_id"]: (row["relative_path"], row["name"]) for row in rows}
+        self.assertEqual(split[101], ("", "root.txt"))
+        self.assertEqual(split[102], ("", ".hidden"))
+        self.assertEqual(split[103], ("a/b", "c.tar.gz"))
+        self.assertEqual(split[104], ("a/b", ".profile"))
+        self.assertEqual(split[105], ("a/b.d", "e"))
+        self.assertEqual(split[106], ("a/b.d", "e."))
+        self.assertEqual(split[107], ("a/..x", "y"))
+        self.assertEqual(split[108], ("dir.with.dots", "x"))
+        self.assertEqual(split[109], ("sub/", "name"))
+
+    def test_file_paths_keep_files_and_their_ids(self):
+        rows = self.db.connection.execute('''select file_id, client_fqdn, backup_root, relative_path, size,
+                                                    modification, status, new_size, new_modification, new_status,
+                                                    last_archive_id, force_backup, scan_generation, device, inode
+                                             from file_paths
+                                          ''')
+        self.assertEqual({row["file_id"]: tuple(row) for row in rows}, self.rows)
+
+    def test_archive_links(self):
+        rows = self.db.connection.execute('''select far.file_id, far.file_size, far.file_modification, far.status
+                                             from file_archive_records as far
+                                             inner join files as f using (file_id)
+                                             inner join s3_archives as s3 on (s3.archive_id = f.last_archive_id)
+                                             where far.archive_id = s3.archive_id
+                                          ''')
+        self.assertEqual({tuple(row) for row in rows},
+                         {(file_id, row[4], row[5], "uploaded") for file_id, row in self.rows.items()})
+
+    def test_files_are_unique_per_directory(self):
+        directory_id = self.db.connection.execute("select directory_id from files where file_id = 101").fetchone()[0]
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.db.connection.execute('''insert into files(directory_id, name, size, modification, status)
+                                          values(?, 'root.txt', 0, 0, 'present')
+                                       ''', (directory_id,))
+
+
+class SchemaUpgradeV8Test(unittest.TestCase):
+    SECOND_NS = calendar.timegm((2023, 5, 6, 7, 8, 9)) * 1000000000
+    NEXT_DAY_NS = calendar.timegm((2023, 5, 7, 0, 0, 0)) * 1000000000
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "catalog.db")
+        connection = create_catalog(self.path, 7)
+        with connection:
+            connection.execute('''insert into backup_client_configs(cloud, region, bucket, credentials, client_fqdn,
+                                                                  backup_root, status, key_file_path)
+                                  values('aws', 'eu-north-1', 'bucket', 'profile', 'host', '/root', 'active', '/key')
+                               ''')
+            connection.execute('''insert into s3_archives(archive_id, cloud, region, bucket, archive_file_name,
+                                                         total_size, relevant_size, status)
+                                  values(1, 'aws', 'eu-north-1', 'bucket', 'archive', 1000, 1000, 'uploaded')
+                               ''')
+            # Times as written before v8, with whole or fractional seconds; rows from before v7 have no inode
+            for row in ((1, "whole.dat", "2023-05-06 07:08:09 UTC", None, None, None, "N"),
+                        (2, "fraction.dat", "2023-05-06 07:08:09.750000 UTC", None, None, None, "N"),
+                        (3, "changed.dat", "2023-05-06 07:08:09 UTC", None, None, None, "N"),
+                        (4, "pending.dat", "2023-05-06 07:08:09 UTC", 100, "2023-05-07 00:00:00 UTC", "present",
+                         "Y")):
+                connection.execute('''insert into files(file_id, client_fqdn, backup_root, relative_path, size,
+                                                       modification, status, new_size, new_modification,
+                                                       new_status, last_archive_id, force_backup)
+                                      values(?, 'host', '/root', ?, 100, ?, 'present', ?, ?, ?, 1, ?)
+                                   ''', row)
+                connection.execute('''insert into file_archive_records(file_id, archive_id, file_size,
+                                                                      file_modification, status)
+                                      values(?, 1, 100, ?, 'uploaded')
+                                   ''', (row[0], row[2]))
+        connection.close()
+        self.db = Database(db_path=self.path)
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_modifications_become_nanoseconds(self):
+        rows = self.db.connection.execute("select file_id, modification, new_modification from file_paths")
+        self.assertEqual({tuple(row) for row in rows}, {(1, self.SECOND_NS, None),
+                                                        (2, self.SECOND_NS, None),
+                                                        (3, self.SECOND_NS, None),
+                                                        (4, self.SECOND_NS, self.NEXT_DAY_NS)})
+        rows = self.db.connection.execute("select distinct file_modification from file_archive_records")
+        self.assertEqual([tuple(row) for row in rows], [(self.SECOND_NS,)])
+
+    def test_unchanged_files_are_not_archived_again(self):
+        cc = ClientConfig("aws", "eu-north-1", "profile", "bucket", "host", "/root", "/key",
+                          dict(ClientConfig.DEFAULT_OPTIONS), [], self.db)
+        generation = self.db.start_scan("host", "/root")
+        writer = FileWriter(self.db, cc, generation)
+        self.db.connection.execute("BEGIN IMMEDIATE")
+        # File systems keep nanoseconds, which the converted times lack
+        writer.upsert("whole.dat", 100, self.SECOND_NS + 123456789, 1, 1)
+        writer.upsert("fraction.dat", 100, self.SECOND_NS + 750000000, 1, 2)
+        writer.upsert("changed.dat", 100, self.SECOND_NS + 2 * 1000000000, 1, 3)
+        writer.upsert("pending.dat", 100, self.NEXT_DAY_NS, 1, 4)
+        writer.flush()
+        self.db.connection.commit()
+        self.db.mark_vanished_files("host", "/root", generation)
+        self.db.update_deleted_files_new_status("host", "/root", generation)
+        self.db.mark_files_for_backup("host", "/root", generation)
+        self.db.end_scan("host", "/root")
+        to_backup = [file.relative_path for page in self.db.get_files_to_backup("host", "/root") for file in page]
+        self.assertEqual(sorted(to_backup), ["changed.dat", "pending.dat"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import tempfile
+import unittest
+
+from unittest import mock
+
+from backup import inotify
+from backup.journal import ChangeJournal, DIRTY, DIRTY_RECURSIVE
+from backup.watcher import Watcher, WatchedRoot
+from db import ClientConfig, Database
+
+
+class WatcherHandleTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database(db_path=os.path.join(self.tmp.name, "catalog.db"))
+        # handle() only reads events: no inotify instance is needed
+        with mock.patch.object(inotify, "Inotify"):
+            self.watcher = Watcher(self.db)
+        cc = ClientConfig("aws", "eu-north-1", "profile", "bucket", "host", "/root", "/key",
+                          dict(ClientConfig.DEFAULT_OPTIONS), [], self.db)
+        self.root = WatchedRoot(cc, ChangeJournal(self.watcher.directory, cc), 0)
+        self.watcher.roots.append(self.root)
+        self.watcher.watches[1] = [(self.root, "")]
+        self.watcher.watches[2] = [(self.root, "/sub")]
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_directory_self_event_marks_the_directory_itself(self):
+        self.watcher.handle(inotify.InotifyEvent(2, inotify.IN_ATTRIB | inotify.IN_ISDIR, 0, ""))
+        self.assertEqual(self.root.pending, [(DIRTY, "/sub")])
+
+    def test_root_self_event_marks_the_root(self):
+        self.watcher.handle(inotify.InotifyEvent(1, inotify.IN_ATTRIB | inotify.IN_ISDIR, 0, ""))
+        self.assertEqual(self.root.pending, [(DIRTY, "")])
+
+    def test_file_event_marks_its_directory(self):
+        self.watcher.handle(inotify.InotifyEvent(2, inotify.IN_CLOSE_WRITE, 0, "file"))
+        self.assertEqual(self.root.pending, [(DIRTY, "/sub")])
+
+    def test_subdirectory_event_marks_its_subtree(self):
+        self.watcher.handle(inotify.InotifyEvent(2, inotify.IN_DELETE | inotify.IN_ISDIR, 0, "child"))
+        self.assertEqual(self.root.pending, [(DIRTY_RECURSIVE, "/sub/child")])
+
+
+if __name__ == "__main__":
+    unittest.main()